@@ -3,10 +3,9 @@
 """
 
 import itertools
+import heapq
 from collections import deque, defaultdict
-from symbol import make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
+from hypergraph import make_hypergraph
 
 
 EMPTY_SET = frozenset()
@@ -39,6 +38,139 @@ class ActiveQueue(object):
         return False
 
 
+class PriorityQueue(object):
+    """
+    Implement a priority queue of active items for best-first intersection.
+    Items leave the queue in decreasing order of priority (ties are broken in order of arrival),
+    and as in ActiveQueue, an item never queues more than once.
+    """
+
+    def __init__(self, priority):
+        """
+        :param priority: a function that scores an item (the higher the score, the sooner the item leaves the queue)
+        """
+        self._priority = priority
+        self._active = []  # a heap of items to be processed
+        self._seen = set()  # items that are queuing (or have already left the queue)
+        self._arrivals = itertools.count()
+
+    def __len__(self):
+        """Number of active items queuing to be processed"""
+        return len(self._active)
+
+    def pop(self):
+        """Returns the item with highest priority"""
+        return heapq.heappop(self._active)[-1]
+
+    def add(self, item):
+        """Add an active item if possible"""
+        if item not in self._seen:
+            heapq.heappush(self._active, (-self._priority(item), next(self._arrivals), item))
+            self._seen.add(item)
+            return True
+        return False
+
+
+class GeneratingSets(object):
+    """
+    Stores the end states of generating symbols as Python sets: (symbol, start) -> set of ends
+    """
+
+    def __init__(self):
+        self._ends = defaultdict(set)
+        self._starts = defaultdict(set)  # symbol -> starts
+
+    def add(self, sym, sfrom, sto):
+        """Adds a generating symbol returning whether it is new"""
+        destinations = self._ends[(sym, sfrom)]
+        n = len(destinations)
+        destinations.add(sto)
+        if len(destinations) > n:
+            self._starts[sym].add(sfrom)
+            return True
+        return False
+
+    def contains(self, sym, sfrom, sto):
+        return sto in self._ends.get((sym, sfrom), EMPTY_SET)
+
+    def any(self, sym, sfrom):
+        """Whether a symbol is generating from a given state (to any state)"""
+        return bool(self._ends.get((sym, sfrom), EMPTY_SET))
+
+    def iterends(self, sym, sfrom):
+        return iter(self._ends.get((sym, sfrom), EMPTY_SET))
+
+    def iterstarts(self, sym):
+        """Returns an iterator to pairs of the kind (start, ends)"""
+        return ((sfrom, self._ends[(sym, sfrom)]) for sfrom in self._starts.get(sym, EMPTY_SET))
+
+
+def bit_positions(bits):
+    """
+    Returns the positions of the bits set in an integer.
+
+    >>> bit_positions(0b10110)
+    (1, 2, 4)
+    """
+    positions = []
+    while bits:
+        lowest = bits & -bits
+        positions.append(lowest.bit_length() - 1)
+        bits ^= lowest
+    return tuple(positions)
+
+
+class GeneratingBitsets(object):
+    """
+    Stores the end states of generating symbols as bitsets: (symbol, start) -> integer whose n-th bit says whether
+    the symbol spans from start to n. This assumes FSA states are (small) nonnegative integers, as in linear FSAs.
+    Membership and "any completions?" checks are single bitwise operations.
+    The positions of the bits of a bitset are memoised for as long as the container lives (that is, one parse).
+    """
+
+    def __init__(self):
+        self._ends = {}
+        self._starts = defaultdict(set)  # symbol -> starts
+        self._positions = {0: ()}  # bitset -> positions of the bits that are set
+
+    def _bit_positions(self, bits):
+        positions = self._positions.get(bits, None)
+        if positions is None:
+            positions = bit_positions(bits)
+            self._positions[bits] = positions
+        return positions
+
+    def add(self, sym, sfrom, sto):
+        """Adds a generating symbol returning whether it is new"""
+        key = (sym, sfrom)
+        bits = self._ends.get(key, 0)
+        bit = 1 << sto
+        if bits & bit:
+            return False
+        if not bits:
+            self._starts[sym].add(sfrom)
+        self._ends[key] = bits | bit
+        return True
+
+    def contains(self, sym, sfrom, sto):
+        return (self._ends.get((sym, sfrom), 0) >> sto) & 1 == 1
+
+    def any(self, sym, sfrom):
+        """Whether a symbol is generating from a given state (to any state)"""
+        return (sym, sfrom) in self._ends
+
+    def bits(self, sym, sfrom):
+        """Returns the bitset of end states"""
+        return self._ends.get((sym, sfrom), 0)
+
+    def iterends(self, sym, sfrom):
+        return iter(self._bit_positions(self._ends.get((sym, sfrom), 0)))
+
+    def iterstarts(self, sym):
+        """Returns an iterator to pairs of the kind (start, ends)"""
+        return ((sfrom, self._bit_positions(self._ends[(sym, sfrom)])) for sfrom in self._starts.get(sym, EMPTY_SET))
+
+
 class Agenda(object):
     """
     This is a CKY agenda which implements the algorithm by Nederhof and Satta (2008).
@@ -49,11 +181,11 @@ class Agenda(object):
         4) a set of complete items
     """
 
-    def __init__(self, active_container_type=ActiveQueue):
+    def __init__(self, active_container_type=ActiveQueue, generating_type=GeneratingBitsets):
         self._active_container_type = active_container_type
         self._active = active_container_type()  # items to be processed
         self._passive = defaultdict(set)  # passive items waiting for completion: (LHS, start) -> items
-        self._generating = defaultdict(lambda: defaultdict(set))  # generating symbols: LHS -> start -> ends
+        self._generating = generating_type()  # generating symbols: (LHS, start) -> ends
         self._complete = defaultdict(set)  # complete items
 
     def __len__(self):
@@ -81,13 +213,14 @@ class Agenda(object):
         Tries to add a newly discovered generating symbol.
         Returns False if the symbol already exists, True otherwise.
         """
-        destinations = self._generating[sym][sfrom]
-        n = len(destinations)
-        destinations.add(sto)
-        return len(destinations) > n
+        return self._generating.add(sym, sfrom, sto)
 
     def is_generating(self, sym, sfrom, sto):
-        return sto in self._generating.get(sym, {}).get(sfrom, set())
+        return self._generating.contains(sym, sfrom, sto)
+
+    def has_completions(self, sym, sfrom):
+        """Whether a symbol is generating from a given state (to any state)"""
+        return self._generating.any(sym, sfrom)
 
     def make_passive(self, item):
         """
@@ -113,8 +246,8 @@ class Agenda(object):
                 pass
 
     def itergenerating(self, sym):
-        """Returns an iterator to pairs of the kind (start, set of ends) for generating items based on a given symbol"""
-        return self._generating.get(sym, {}).iteritems()
+        """Returns an iterator to pairs of the kind (start, ends) for generating items based on a given symbol"""
+        return self._generating.iterstarts(sym)
 
     def itercomplete(self, lhs=None, start=None, end=None):
         """
@@ -129,14 +262,33 @@ class Agenda(object):
 
     def itercompletions(self, sym, start):
         """Return possible completions of the given item"""
-        return iter(self._generating.get(sym, {}).get(start, frozenset()))
+        return self._generating.iterends(sym, start)
 
 
-def get_intersected_rule(item):
-    lhs = make_symbol(item.rule.lhs, item.start, item.dot)
-    positions = item.inner + (item.dot,)
-    rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-    return Rule(lhs, rhs, item.rule.log_prob)
+def get_goal_items(root, fsa, agenda, final_weight=None):
+    """
+    Returns the goal items, that is, pairs ((root, start, end), weight) where start is an initial state
+    and end is a final state of the FSA.
+    :param final_weight: a function that returns the weight of a final state (defaults to the FSA's own final weight)
+    """
+    if final_weight is None:
+        final_weight = fsa.get_final_weight
+    roots = []
+    for start, ends in agenda.itergenerating(root):
+        if not fsa.is_initial(start):
+            continue
+        for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
+            roots.append(((root, start, end), final_weight(end)))
+    return roots
+
+
+def get_forest(goal, root, fsa, agenda):
+    """
+    Constructs the intersected forest as a compact hypergraph (see hypergraph.make_hypergraph).
+    Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items,
+    the hypergraph only contains items reachable from the goal.
+    """
+    return make_hypergraph(goal, get_goal_items(root, fsa, agenda), agenda.itercomplete)
 
 
 def get_cfg(goal, root, fsa, agenda):
@@ -144,33 +296,5 @@ def get_cfg(goal, root, fsa, agenda):
     Constructs the CFG by visiting complete items in a top-down fashion.
     This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
     that could never be reached from the root.
-    Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
-    This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
-    """
-
-    G = WCFG()
-    processed = set()
-
-    def make_rules(lhs, start, end):
-        if (start, lhs, end) in processed:
-            return
-        processed.add((lhs, start, end))
-        for item in agenda.itercomplete(lhs, start, end):
-            G.add(get_intersected_rule(item))
-            fsa_states = item.inner + (item.dot,)
-            for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
-                if (sym, fsa_states[i], fsa_states[
-                        i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
-                    make_rules(sym, fsa_states[i], fsa_states[i + 1])
-
-    # create goal items
-    for start, ends in agenda.itergenerating(root):
-        if not fsa.is_initial(start):
-            continue
-        for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
-            make_rules(root, start, end)
-            final_weight = fsa.get_final_weight(end)
-            G.add(Rule(make_symbol(goal, None, None),
-                       [make_symbol(root, start, end)], final_weight))
-
-    return G
+    """
+    return get_forest(goal, root, fsa, agenda).to_wcfg()
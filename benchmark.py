@@ -0,0 +1,637 @@
+"""
+Micro-benchmarks for the parsing and sampling pipeline.
+
+    python benchmark.py chart examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py kbest examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py startup examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py astar examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py slice examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py init examples/wsj00 examples/sentence --grammarfmt discodop --unkmodel stfd6 --start TOP --log
+    python benchmark.py suite --output benchmark.json --baseline examples/benchmark.json
+
+:Authors: - Wilker Aziz
+"""
+
+import argparse
+import os
+import sys
+import math
+import time
+import logging
+from reader import load_grammar
+from sentence import make_sentence
+from symbol import make_nonterminal
+from agenda import GeneratingSets, GeneratingBitsets
+from nederhof import Nederhof
+from earley import Earley
+from heuristic import OutsideHeuristic
+from inference import viterbi, inside, kbest
+from generalisedSampling import GeneralisedSampling
+
+
+def load(args):
+    """Loads the grammar and returns it along with the sentences (and their extra rules)"""
+    if args.log:
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=math.log)
+    else:
+        wcfg = load_grammar(args.grammar, args.grammarfmt, transform=float)
+    sentences = []
+    for input_str in args.input:
+        input_str = input_str.strip()
+        if not input_str:
+            continue
+        sentence, extra_rules = make_sentence(input_str, wcfg.terminals, args.unkmodel, args.default_symbol,
+                                              split_bars=args.split_input)
+        wcfg.update(extra_rules)
+        sentences.append(sentence)
+    return wcfg, sentences
+
+
+def best_of(repeats, run):
+    """Runs a function a number of times and returns the shortest duration"""
+    durations = []
+    for _ in range(repeats):
+        durations.append(run())
+    return min(durations)
+
+
+def bench_chart(args):
+    """Compares set-backed and bitset-backed generating symbols in Nederhof.inference"""
+    wcfg, sentences = load(args)
+    types = [('sets', GeneratingSets), ('bitsets', GeneratingBitsets)]
+
+    def run(sentence, generating_type):
+        parser = Nederhof(wcfg, sentence.fsa, generating_type=generating_type)
+        parser.axioms()
+        start = time.time()
+        parser.inference()
+        return time.time() - start
+
+    print '# benchmark=chart function=Nederhof.inference repeats=%d' % args.repeats
+    print '%s\t%s\t%s\t%s\t%s' % ('sentence', 'words', 'sets', 'bitsets', 'speedup')
+    totals = [0.0, 0.0]
+    for sid, sentence in enumerate(sentences, 1):
+        durations = [best_of(args.repeats, lambda: run(sentence, t)) for _, t in types]
+        totals = [a + b for a, b in zip(totals, durations)]
+        print '%d\t%d\t%.4f\t%.4f\t%.2f' % (sid, len(sentence), durations[0], durations[1], durations[0] / durations[1])
+    print '%s\t%s\t%.4f\t%.4f\t%.2f' % ('total', '-', totals[0], totals[1], totals[0] / totals[1])
+
+
+def bench_astar(args):
+    """Compares time to the best parse of exhaustive intersection and best-first (A*) intersection"""
+    wcfg, sentences = load(args)
+    root, goal = make_nonterminal(args.start), make_nonterminal(args.goal)
+    heuristic = OutsideHeuristic(wcfg, root)
+    engines = {'nederhof': Nederhof, 'earley': Earley}
+
+    def run(sentence, h, result):
+        start = time.time()
+        parser = engines[args.intersection](wcfg, sentence.fsa, heuristic=h)
+        forest = parser.forest(root, goal)
+        d, best = viterbi(forest)
+        result[:] = [parser.n_items(), float(best[forest.goal])]
+        return time.time() - start
+
+    print '# benchmark=astar intersection=%s repeats=%d' % (args.intersection, args.repeats)
+    print '\t'.join(['sentence', 'words', 'exhaustive', 'items', 'astar', 'items', 'speedup', 'same-score'])
+    totals = [0.0, 0.0]
+    for sid, sentence in enumerate(sentences, 1):
+        exhaustive, astar = [], []
+        durations = [best_of(args.repeats, lambda: run(sentence, None, exhaustive)),
+                     best_of(args.repeats, lambda: run(sentence, heuristic, astar))]
+        totals = [a + b for a, b in zip(totals, durations)]
+        print '%d\t%d\t%.4f\t%d\t%.4f\t%d\t%.2f\t%s' % (sid, len(sentence), durations[0], exhaustive[0],
+                                                        durations[1], astar[0], durations[0] / durations[1],
+                                                        abs(exhaustive[1] - astar[1]) < 1e-6)
+    print '%s\t%s\t%.4f\t%s\t%.4f\t%s\t%.2f\t%s' % ('total', '-', totals[0], '-', totals[1], '-',
+                                                     totals[0] / totals[1], '-')
+
+
+def bench_kbest(args):
+    """Compares lazy k-best extraction with mode finding by sampling (given the forest)"""
+    wcfg, sentences = load(args)
+    root, goal = make_nonterminal(args.start), make_nonterminal(args.goal)
+
+    def run_kbest(forest, result):
+        start = time.time()
+        result[:] = [tuple(d) for _, d in kbest(forest, args.k)]
+        return time.time() - start
+
+    def run_sampling(forest, result):
+        start = time.time()
+        sampler = GeneralisedSampling(forest, inside(forest))
+        counts = sampler.sample_counts(args.samples)
+        result[:] = [tuple(d) for d, _ in counts.most_common(args.k)]
+        return time.time() - start
+
+    print '# benchmark=kbest k=%d samples=%d repeats=%d' % (args.k, args.samples, args.repeats)
+    print '\t'.join(['sentence', 'words', 'edges', 'kbest', 'sampling', 'speedup', 'recall'])
+    totals = [0.0, 0.0]
+    for sid, sentence in enumerate(sentences, 1):
+        forest = Nederhof(wcfg, sentence.fsa).forest(root, goal)
+        exact, sampled = [], []
+        durations = [best_of(args.repeats, lambda: run_kbest(forest, exact)),
+                     best_of(args.repeats, lambda: run_sampling(forest, sampled))]
+        totals = [a + b for a, b in zip(totals, durations)]
+        # how many of the k best derivations the sampler found among its k most frequent ones
+        # (derivations are compared as sets of edges, since the two methods list edges in different orders)
+        recall = len(set(map(frozenset, exact)) & set(map(frozenset, sampled))) / float(len(exact))
+        print '%d\t%d\t%d\t%.4f\t%.4f\t%.2f\t%.2f' % (sid, len(sentence), forest.n_edges, durations[0], durations[1],
+                                                     durations[1] / durations[0], recall)
+    print '%s\t%s\t%s\t%.4f\t%.4f\t%.2f\t%s' % ('total', '-', '-', totals[0], totals[1], totals[1] / totals[0], '-')
+
+
+def bench_startup(args):
+    """Measures the startup cost of the command line tools (in fresh processes): imports and time to parse the first sentence"""
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    first = next(line for line in args.input if line.strip())
+    options = [args.grammar, '--grammarfmt', args.grammarfmt, '--start', args.start, '--goal', args.goal,
+               '--default-symbol', args.default_symbol]
+    if args.log:
+        options.append('--log')
+    if args.split_input:
+        options.append('--split-input')
+    if args.unkmodel:
+        options.extend(['--unkmodel', args.unkmodel])
+    scripts = [('parse', ['--samples', str(args.samples)]),
+               ('mcmcparse', ['--samples', str(args.samples), '--burn', '0'])]
+
+    def run(cmd, stdin=None):
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            process = subprocess.Popen(cmd, cwd=here, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+            process.communicate(stdin)
+            if process.returncode != 0:
+                raise RuntimeError('Command failed: %s' % ' '.join(cmd))
+            return time.time() - start
+
+    print '# benchmark=startup samples=%d repeats=%d' % (args.samples, args.repeats)
+    print '\t'.join(['script', 'interpreter', 'import', 'first-sentence'])
+    interpreter = best_of(args.repeats, lambda: run([sys.executable, '-c', 'pass']))
+    for script, extra in scripts:
+        imports = best_of(args.repeats, lambda: run([sys.executable, '-c', 'import %s' % script]))
+        total = best_of(args.repeats, lambda: run([sys.executable, '%s.py' % script] + options + extra, first))
+        print '%s\t%.4f\t%.4f\t%.4f' % (script, interpreter, imports, total)
+
+
+def bench_slice(args):
+    """Compares slice sampling iterations per second with intersection from scratch and with incremental slicing"""
+    import numpy as np
+    from slice_variable import SliceVariable
+    from sliced_nederhof import SlicedNederhof
+    from sliced_earley import SlicedEarley
+    from sliced_incremental import IncrementalSlicedParser
+    from mcmcparse import sliced_sample
+    wcfg, sentences = load(args)
+    root, goal = make_nonterminal(args.start), make_nonterminal(args.goal)
+    engines = {'nederhof': SlicedNederhof, 'earley': SlicedEarley}
+
+    def run(sentence, incremental, result):
+        np.random.seed(args.seed)
+        slice_vars = SliceVariable(a=args.a, b=args.b)
+        start = time.time()
+        if incremental:
+            parser = IncrementalSlicedParser(wcfg, sentence.fsa, slice_vars, args.intersection)
+        found = 0
+        for _ in xrange(args.iterations):
+            if not incremental:
+                parser = engines[args.intersection](wcfg, sentence.fsa, slice_vars)
+            found += sliced_sample(root, goal, parser) is not None
+            slice_vars.reset()
+        result[:] = [found]
+        return time.time() - start
+
+    print '# benchmark=slice intersection=%s iterations=%d a=%s b=%s repeats=%d' % (args.intersection, args.iterations,
+                                                                                  args.a, args.b, args.repeats)
+    print '\t'.join(['sentence', 'words', 'scratch', 'it/s', 'found', 'incremental', 'it/s', 'found', 'speedup'])
+    totals = [0.0, 0.0]
+    for sid, sentence in enumerate(sentences, 1):
+        scratch, incremental = [], []
+        durations = [best_of(args.repeats, lambda: run(sentence, False, scratch)),
+                     best_of(args.repeats, lambda: run(sentence, True, incremental))]
+        totals = [x + y for x, y in zip(totals, durations)]
+        print '%d\t%d\t%.4f\t%.2f\t%d\t%.4f\t%.2f\t%d\t%.2f' % (sid, len(sentence),
+                                                                 durations[0], args.iterations / durations[0], scratch[0],
+                                                                 durations[1], args.iterations / durations[1],
+                                                                 incremental[0], durations[0] / durations[1])
+    print '%s\t%s\t%.4f\t%s\t%s\t%.4f\t%s\t%s\t%.2f' % ('total', '-', totals[0], '-', '-', totals[1], '-', '-',
+                                                          totals[0] / totals[1])
+
+
+def bench_init(args):
+    """Compares the time to the first valid sample of a slice sampler started cold and started from the best derivation"""
+    import numpy as np
+    from slice_variable import SliceVariable
+    from sliced_nederhof import SlicedNederhof
+    from sliced_earley import SlicedEarley
+    from mcmcparse import initialise, sliced_sample
+    wcfg, sentences = load(args)
+    root, goal = make_nonterminal(args.start), make_nonterminal(args.goal)
+    engines = {'nederhof': SlicedNederhof, 'earley': SlicedEarley}
+
+    def run(sentence, init, result):
+        np.random.seed(args.seed)
+        start = time.time()
+        conditions = initialise(wcfg, sentence.fsa, root, goal) if init else {}
+        if conditions:
+            slice_vars = SliceVariable(a=args.a[1], b=args.b[1], conditions=conditions)
+        else:
+            slice_vars = SliceVariable(a=args.a[0], b=args.b[0])
+        iterations = 0
+        while iterations < args.max:
+            iterations += 1
+            if sliced_sample(root, goal, engines[args.intersection](wcfg, sentence.fsa, slice_vars)) is not None:
+                break
+            slice_vars.reset()
+        else:
+            iterations = None  # no valid sample within the budget
+        result[:] = [iterations]
+        return time.time() - start
+
+    def show(iterations):
+        return '-' if iterations is None else str(iterations)
+
+    print '# benchmark=init intersection=%s a=%s b=%s max=%d repeats=%d' % (args.intersection, args.a, args.b,
+                                                                         args.max, args.repeats)
+    print '\t'.join(['sentence', 'words', 'cold', 'iterations', 'viterbi', 'iterations', 'speedup'])
+    totals = [0.0, 0.0]
+    for sid, sentence in enumerate(sentences, 1):
+        cold, warm = [], []
+        durations = [best_of(args.repeats, lambda: run(sentence, False, cold)),
+                     best_of(args.repeats, lambda: run(sentence, True, warm))]
+        totals = [x + y for x, y in zip(totals, durations)]
+        print '%d\t%d\t%.4f\t%s\t%.4f\t%s\t%.2f' % (sid, len(sentence), durations[0], show(cold[0]),
+                                                     durations[1], show(warm[0]), durations[0] / durations[1])
+    print '%s\t%s\t%.4f\t%s\t%.4f\t%s\t%.2f' % ('total', '-', totals[0], '-', totals[1], '-', totals[0] / totals[1])
+
+
+# workloads of the suite (paths are relative to this file), see `suite`
+WORKLOADS = {
+    'wsj00': dict(grammar='examples/wsj00', inputs=['examples/sentence'], grammarfmt='discodop', log=True,
+                  start='TOP', goal='GOAL', unkmodel='stfd6', default_symbol='X', split_input=False),
+    # the reordering grammar is not distributed (see data/README.md), its path is given with --reordering
+    'reordering': dict(grammar=None, inputs=['data/input/*'], grammarfmt='milos', log=True,
+                       start='ROOT', goal='GOAL', unkmodel='passthrough', default_symbol='UNK', split_input=True),
+}
+
+
+def peak_memory():
+    """Peak resident set size of this process in MB (Linux reports ru_maxrss in KB)"""
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_config(config):
+    """
+    Runs a single configuration of the suite, stage by stage, and returns its measurements:
+    for every stage the total wall time (over sentences) and the peak memory at the end of the stage.
+    The stages are those of parse.exact_sample (MC) and of mcmcparse.sliced_sampling with a single chain (MCMC).
+    """
+    from collections import Counter, defaultdict
+    from glob import glob
+    from parse import make_parser
+    from treeformat import bracketed_tree, bracketed_rules
+    from mcmcparse import initialise, SlicedParsers, Chain
+
+    seconds = Counter()
+    memory = defaultdict(float)
+    sentences = []
+
+    def stage(name, started):
+        seconds[name] += time.time() - started
+        memory[name] = max(memory[name], peak_memory())
+        return time.time()
+
+    start = time.time()
+    wcfg = load_grammar(config['grammar'], config['grammarfmt'], transform=math.log if config['log'] else float)
+    stage('grammar', start)
+    root, goal = make_nonterminal(config['start']), make_nonterminal(config['goal'])
+    paths = sorted(path for pattern in config['inputs'] for path in glob(pattern))
+    for path in paths:
+        lines = [line.strip() for line in open(path) if line.strip()][:config['sentences']]
+        for line, input_str in enumerate(lines, 1):
+            first = start = time.time()
+            sentence, extra_rules = make_sentence(input_str, wcfg.terminals, config['unkmodel'],
+                                                  config['default_symbol'], split_bars=config['split_input'])
+            wcfg.update(extra_rules)
+            start = stage('input', start)
+            if config['method'] == 'mc':
+                forest = make_parser(wcfg, sentence.fsa, config['intersection']).forest(root, goal)
+                start = stage('intersection', start)
+                if not forest:
+                    sentences.append({'input': '%s:%d' % (os.path.basename(path), line), 'words': len(sentence),
+                                      'seconds': time.time() - first, 'derivations': 0})
+                    continue
+                inside_prob = inside(forest)
+                start = stage('inside', start)
+                sampler = GeneralisedSampling(forest, inside_prob)
+                start = stage('tables', start)
+                counts = sampler.parallel_sample_counts(config['samples'], 1, config['seed'])
+                start = stage('sampling', start)
+                trees = [bracketed_tree(forest, d, breadth_first=True) for d, n in counts.most_common()]
+                stage('output', start)
+            else:
+                conditions = initialise(wcfg, sentence.fsa, root, goal)
+                start = stage('init', start)
+                parsers = SlicedParsers(wcfg, sentence.fsa, root, goal, config['intersection'])
+                chain = Chain(0, conditions, config['a'], config['b'], config['burn'], config['seed'])
+                chain.run(parsers, config['samples'], config['max'])
+                # the iterations are split between intersection and sampling by the chain itself
+                for name in ['intersection', 'sampling']:
+                    seconds[name] += chain.timers[name]
+                    memory[name] = max(memory[name], peak_memory())
+                start = time.time()
+                trees = [bracketed_rules(d) for d, n in chain.counts.most_common()]
+                stage('output', start)
+            sentences.append({'input': '%s:%d' % (os.path.basename(path), line), 'words': len(sentence),
+                              'seconds': time.time() - first, 'derivations': len(trees)})
+    return {'stages': {name: {'seconds': seconds[name], 'peak_mb': memory[name]} for name in seconds},
+            'seconds': sum(seconds.itervalues()), 'peak_mb': peak_memory(), 'sentences': sentences}
+
+
+def bench_config(args):
+    """Runs a single configuration (JSON) and prints its measurements as JSON (see bench_suite)"""
+    import json
+    json.dump(run_config(json.loads(args.config)), sys.stdout, sort_keys=True)
+
+
+def compare(baseline, results, threshold, min_seconds=0.1, min_mb=5.0):
+    """
+    Compares the measurements of the suite to a baseline, prints a row per measure (of configurations run by both)
+    and returns the regressions: measures that grew by more than `threshold` (a ratio) and by more than a minimum
+    amount (so that noise on short stages does not count).
+    """
+    regressions = []
+    print '\t'.join(['config', 'measure', 'baseline', 'current', 'ratio', ''])
+    for key in sorted(set(baseline) & set(results)):
+        old, new = baseline[key], results[key]
+        if 'error' in old or 'error' in new:
+            continue
+        rows = [('seconds', old['seconds'], new['seconds'], min_seconds),
+                ('peak_mb', old['peak_mb'], new['peak_mb'], min_mb)]
+        for name in sorted(set(old['stages']) & set(new['stages'])):
+            rows.append(('%s.seconds' % name, old['stages'][name]['seconds'], new['stages'][name]['seconds'],
+                         min_seconds))
+        for measure, before, after, minimum in rows:
+            ratio = after / before if before else float('inf')
+            regressed = ratio > 1 + threshold and after - before > minimum
+            if regressed:
+                regressions.append((key, measure))
+            print '%s\t%s\t%.4f\t%.4f\t%.2f\t%s' % (key, measure, before, after, ratio, 'REGRESSION' if regressed else '')
+    return regressions
+
+
+def bench_suite(args):
+    """
+    End-to-end benchmark: MC and MCMC sampling with both intersection algorithms over each workload.
+    Every configuration runs in a fresh interpreter (see bench_config), thus its peak memory is its own,
+    and it is repeated (we keep the fastest run).
+    The results are written as JSON and optionally compared to a baseline (regressions make the exit status 1).
+    """
+    import json
+    import platform
+    import subprocess
+    if 'reordering' in args.workloads and args.reordering is None:
+        raise ValueError('The reordering workload requires the path to its grammar (--reordering)')
+    here = os.path.dirname(os.path.abspath(__file__))
+    settings = dict(sentences=args.sentences, seed=args.seed, a=args.a, b=args.b, burn=args.burn, max=args.max,
+                    samples=args.samples, mcmc_samples=args.mcmc_samples)
+    results = {}
+    for workload in args.workloads:
+        data = dict(WORKLOADS[workload])
+        if workload == 'reordering':
+            data['grammar'] = os.path.abspath(args.reordering)
+        data['grammar'] = os.path.join(here, data['grammar'])
+        data['inputs'] = [os.path.join(here, pattern) for pattern in data['inputs']]
+        for method in args.methods:
+            for intersection in args.intersections:
+                key = '%s/%s/%s' % (workload, method, intersection)
+                config = dict(data, method=method, intersection=intersection, sentences=args.sentences,
+                              seed=args.seed, a=args.a, b=args.b, burn=args.burn, max=args.max,
+                              samples=args.samples if method == 'mc' else args.mcmc_samples)
+                for repeat in range(args.repeats):
+                    logging.info('Running %s', key)
+                    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'config', json.dumps(config)],
+                                             stdout=subprocess.PIPE)
+                    output = child.communicate()[0]
+                    if child.returncode:
+                        logging.error('%s failed with exit status %d', key, child.returncode)
+                        results[key] = {'error': child.returncode}
+                        break
+                    result = json.loads(output)
+                    logging.info('%s: %.2fs peak=%.1fMB', key, result['seconds'], result['peak_mb'])
+                    if key not in results or result['seconds'] < results[key]['seconds']:
+                        results[key] = result
+    report = {'python': platform.python_version(), 'machine': platform.machine(), 'settings': settings,
+              'results': results}
+    with open(args.output, 'w') as fo:
+        json.dump(report, fo, indent=2, sort_keys=True)
+    logging.info('Results: %s', args.output)
+    if args.baseline:
+        with open(args.baseline) as fi:
+            baseline = json.load(fi)
+        if baseline.get('settings') != settings:
+            logging.warning('The baseline was measured with different settings: %s', baseline.get('settings'))
+        regressions = compare(baseline['results'], results, args.threshold)
+        if regressions:
+            logging.warning('%d regressions (more than %d%% slower or bigger)', len(regressions), 100 * args.threshold)
+            return 1
+    return 0
+
+
+def add_grammar_args(parser):
+    parser.add_argument('grammar',
+            type=str,
+            help='path to CFG rules (or prefix in case of discodop format)')
+    parser.add_argument('input', nargs='?',
+            type=argparse.FileType('r'), default=sys.stdin,
+            help='input corpus (one sentence per line)')
+    parser.add_argument('--grammarfmt',
+            type=str, default='bar', choices=['bar', 'discodop', 'milos'],
+            help="grammar format ('bar' is the native format)")
+    parser.add_argument('--log',
+            action='store_true',
+            help='applies the log transform to the probabilities of the rules')
+    parser.add_argument('--start',
+            type=str, default='S',
+            help="start symbol of the grammar")
+    parser.add_argument('--goal',
+            type=str, default='GOAL',
+            help="goal symbol for intersection")
+    parser.add_argument('--split-input',
+            action='store_true',
+            help='assumes the input is given separated by triple bars')
+    parser.add_argument('--unkmodel',
+            type=str, default=None,
+            choices=['passthrough', 'stfdbase', 'stfd4', 'stfd6'],
+            help="unknown word model")
+    parser.add_argument('--default-symbol',
+            type=str, default='X',
+            help='default nonterminal (use for pass-through rules)')
+    parser.add_argument('--repeats',
+            type=int, default=3,
+            help='number of repetitions (we report the fastest)')
+
+
+def argparser():
+    """parse command line arguments"""
+    parser = argparse.ArgumentParser(prog='benchmark')
+
+    parser.description = 'Benchmarks'
+    parser.formatter_class = argparse.ArgumentDefaultsHelpFormatter
+
+    subparsers = parser.add_subparsers(title='benchmarks')
+
+    chart = subparsers.add_parser('chart',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='set-backed vs bitset-backed generating symbols in Nederhof.inference')
+    add_grammar_args(chart)
+    chart.set_defaults(func=bench_chart)
+
+    kb = subparsers.add_parser('kbest',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='lazy k-best extraction vs mode finding by sampling')
+    add_grammar_args(kb)
+    kb.add_argument('--k',
+            type=int, default=10,
+            help='number of derivations')
+    kb.add_argument('--samples',
+            type=int, default=1000,
+            help='number of samples used to find the modes')
+    kb.set_defaults(func=bench_kbest)
+
+    startup = subparsers.add_parser('startup',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='time to import the command line tools and to parse the first sentence')
+    add_grammar_args(startup)
+    startup.add_argument('--samples',
+            type=int, default=10,
+            help='number of samples drawn for the first sentence')
+    startup.set_defaults(func=bench_startup)
+
+    astar = subparsers.add_parser('astar',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='exhaustive vs best-first (A*) intersection (time to the best parse)')
+    add_grammar_args(astar)
+    astar.add_argument('--intersection',
+            type=str, default='nederhof', choices=['nederhof', 'earley'],
+            help="intersection algorithm (nederhof: bottom-up; earley: top-down)")
+    astar.set_defaults(func=bench_astar)
+
+    sl = subparsers.add_parser('slice',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='slice sampling iterations per second: intersection from scratch vs incremental slicing')
+    add_grammar_args(sl)
+    sl.add_argument('--intersection',
+            type=str, default='nederhof', choices=['nederhof', 'earley'],
+            help="intersection algorithm (nederhof: bottom-up; earley: top-down)")
+    sl.add_argument('--iterations',
+            type=int, default=20,
+            help='number of slice sampling iterations')
+    sl.add_argument('-a',
+            type=float, default=0.1,
+            help='first parameter of the Beta distribution of the slice variables')
+    sl.add_argument('-b',
+            type=float, default=1.0,
+            help='second parameter of the Beta distribution of the slice variables')
+    sl.add_argument('--seed',
+            type=int, default=1,
+            help='random seed')
+    sl.set_defaults(func=bench_slice)
+
+    init = subparsers.add_parser('init',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='time to the first valid slice sample: cold start vs initial derivation found by A*')
+    add_grammar_args(init)
+    init.add_argument('--intersection',
+            type=str, default='nederhof', choices=['nederhof', 'earley'],
+            help="intersection algorithm used by the slice sampler (nederhof: bottom-up; earley: top-down)")
+    init.add_argument('--max',
+            type=int, default=100,
+            help='maximum number of iterations of a cold start')
+    init.add_argument('-a',
+            type=float, nargs=2, default=[0.1, 0.3], metavar='BEFORE AFTER',
+            help='a, first Beta parameter before and after finding the first derivation')
+    init.add_argument('-b',
+            type=float, nargs=2, default=[1.0, 1.0], metavar='BEFORE AFTER',
+            help='b, second Beta parameter before and after finding the first derivation')
+    init.add_argument('--seed',
+            type=int, default=1,
+            help='random seed')
+    init.set_defaults(func=bench_init)
+
+    suite = subparsers.add_parser('suite',
+            formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+            help='end-to-end MC and MCMC sampling (Nederhof and Earley) with per-stage time and peak memory, '
+                 'compared to a baseline')
+    suite.add_argument('--workloads',
+            type=str, nargs='+', default=['wsj00'], choices=sorted(WORKLOADS),
+            help='wsj00: examples/wsj00 on examples/sentence; reordering: data/input/* (requires --reordering)')
+    suite.add_argument('--reordering',
+            type=str, default=None, metavar='GRAMMAR',
+            help='path to the reordering grammar (milos format)')
+    suite.add_argument('--methods',
+            type=str, nargs='+', default=['mc', 'mcmc'], choices=['mc', 'mcmc'],
+            help='exact sampling (mc) and/or slice sampling (mcmc)')
+    suite.add_argument('--intersections',
+            type=str, nargs='+', default=['nederhof', 'earley'], choices=['nederhof', 'earley'],
+            help='intersection algorithms')
+    suite.add_argument('--sentences',
+            type=int, default=1,
+            help='number of sentences (the first ones) of each input file')
+    suite.add_argument('--samples',
+            type=int, default=1000,
+            help='number of MC samples per sentence')
+    suite.add_argument('--mcmc-samples',
+            type=int, default=50,
+            help='number of MCMC samples per sentence')
+    suite.add_argument('--burn',
+            type=int, default=10,
+            help='number of MCMC samples burnt')
+    suite.add_argument('--max',
+            type=int, default=200,
+            help='maximum number of MCMC iterations')
+    suite.add_argument('-a',
+            type=float, nargs=2, default=[0.1, 0.3], metavar='BEFORE AFTER',
+            help='a, first Beta parameter before and after finding the first derivation')
+    suite.add_argument('-b',
+            type=float, nargs=2, default=[1.0, 1.0], metavar='BEFORE AFTER',
+            help='b, second Beta parameter before and after finding the first derivation')
+    suite.add_argument('--seed',
+            type=int, default=1,
+            help='random seed')
+    suite.add_argument('--repeats',
+            type=int, default=1,
+            help='number of runs of each configuration (we keep the fastest)')
+    suite.add_argument('--output',
+            type=str, default='benchmark.json',
+            help='where the results are written (JSON)')
+    suite.add_argument('--baseline',
+            type=str, default=None,
+            help='results of a previous run (JSON) to compare to')
+    suite.add_argument('--threshold',
+            type=float, default=0.2,
+            help='a measure regresses if it grows by more than this ratio of its baseline')
+    suite.set_defaults(func=bench_suite)
+
+    config = subparsers.add_parser('config',
+            help='runs a single configuration of the suite (JSON) and prints its measurements (JSON)')
+    config.add_argument('config',
+            type=str,
+            help='the configuration (see bench_suite)')
+    config.set_defaults(func=bench_config)
+
+    return parser
+
+
+def main(args):
+    if args.func is bench_config:  # stdout is reserved for the measurements, only warnings are logged
+        logging.basicConfig(level=logging.WARNING, format='%(asctime)-15s %(levelname)s %(message)s')
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)-15s %(levelname)s %(message)s')
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(argparser().parse_args()))
@@ -3,14 +3,14 @@
 """
 
 import logging
-import itertools
 import argparse
 import sys
+import random
 from rule import Rule
-from symbol import is_nonterminal, is_terminal
-from wcfg import WCFG, count_derivations
-from wfsa import WDFSA, make_linear_fsa
+from wcfg import WCFG
+from wfsa import make_linear_fsa
 from earley import Earley
+from itg import make_itg_forest, yield_counts, sample_yields
 
 def make_grammar(fsa):
     cfg = WCFG()
@@ -21,31 +21,36 @@ def make_grammar(fsa):
     return cfg
 
 def main(args):
+    rng = random.Random(args.seed)
 
     for input_str in args.input:
+        if args.split_input:
+            input_str = input_str.split(' ||| ')[0]
         fsa = make_linear_fsa(input_str)
         cfg = make_grammar(fsa)
         parser = Earley(cfg, fsa)
-        forest = parser.do('[S]', '[GOAL]')
+        forest = parser.forest('[S]', '[GOAL]')
         if not forest:
             print 'NO PARSE FOUND'
             continue
-        new_rules = []
-        for rule in forest:
-            if len(rule.rhs) > 1 and all(map(is_nonterminal, rule.rhs)):
-                new_rules.append(Rule(rule.lhs, reversed(rule.rhs), rule.log_prob))
-        [forest.add(rule) for rule in new_rules]
-        print '# FOREST'
-        print forest
-        print
+        forest = make_itg_forest(forest)
+        if not args.no_forest:
+            print '# FOREST'
+            print forest.to_wcfg()
+            print
 
         if args.show_permutations:
-            counts = count_derivations(forest, '[GOAL]')
+            counts = yield_counts(forest)
             total = 0
-            for p, n in sorted(counts['p'].iteritems(), key=lambda (k, v): k):
+            for p, n in sorted(counts.iteritems(), key=lambda (k, v): k):
                 print p, n
                 total += n
-            print len(counts['p'].keys()), total
+            print len(counts.keys()), total
+
+        if args.samples > 0:
+            print '# SAMPLES'
+            for p, n in sample_yields(forest, args.samples, rng):
+                print p, n
 
 
 
@@ -66,6 +71,18 @@ def argparser():
     parser.add_argument('--show-permutations', 
             action='store_true',
             help='enumerate permutations (use with care)')
+    parser.add_argument('--samples',
+            type=int, default=0,
+            help='number of permutations sampled uniformly at random')
+    parser.add_argument('--seed',
+            type=int, default=None,
+            help='random seed (for sampling)')
+    parser.add_argument('--no-forest',
+            action='store_true',
+            help='does not print the forest')
+    parser.add_argument('--split-input',
+            action='store_true',
+            help='assumes the input is given separated by triple bars')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
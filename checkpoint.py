@@ -0,0 +1,43 @@
+"""
+Checkpoints of long runs: the state is pickled (binary protocol), compressed with gzip and written atomically,
+that is, to a temporary file in the same directory which is then renamed over the checkpoint,
+thus an interrupted run never leaves a truncated checkpoint behind.
+
+>>> import tempfile, shutil
+>>> tmp = tempfile.mkdtemp()
+>>> path = os.path.join(tmp, 'run.ckpt')
+>>> save_checkpoint(path, {'sentence': 3, 'counts': {('a', 'b'): 2}})
+>>> load_checkpoint(path) == {'sentence': 3, 'counts': {('a', 'b'): 2}}
+True
+>>> os.listdir(tmp)
+['run.ckpt']
+>>> shutil.rmtree(tmp)
+
+:Authors: - Wilker Aziz
+"""
+
+import os
+import gzip
+import tempfile
+import cPickle as pickle
+
+
+def save_checkpoint(path, state):
+    """Pickles and compresses `state`, then atomically replaces the checkpoint at `path`"""
+    fd, tmp = tempfile.mkstemp(prefix=os.path.basename(path) + '.', dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as fo:
+                pickle.dump(state, fo, pickle.HIGHEST_PROTOCOL)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def load_checkpoint(path):
+    """Returns the state saved at `path` (see save_checkpoint)"""
+    with gzip.open(path, 'rb') as fi:
+        return pickle.load(fi)
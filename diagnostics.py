@@ -0,0 +1,101 @@
+"""
+Convergence diagnostics for MCMC: effective sample size, split R-hat and stability of the estimates.
+
+The scalar summary of a derivation we monitor is its score (log probability), thus a chain is represented by the
+trace of the scores of the derivations it sampled (after burn-in).
+See Gelman et al. (2013, Bayesian Data Analysis, 3rd edition, chapter 11) and Geyer (1992, Practical Markov Chain Monte Carlo).
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+
+
+def autocorrelation(x):
+    """
+    Autocorrelation of a trace at every lag (computed with the FFT).
+
+    >>> [round(r, 4) for r in autocorrelation([1.0, 2.0, 1.0, 2.0])]
+    [1.0, -0.75, 0.5, -0.25]
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    if np.all(x == x[0]):  # a constant trace (tested exactly, centring would leave rounding errors)
+        return np.concatenate(([1.0], np.zeros(n - 1)))
+    x = x - x.mean()
+    f = np.fft.rfft(x, 2 * n)  # zero-padding avoids circular correlations
+    acov = np.fft.irfft(f * np.conjugate(f))[:n] / n
+    return acov / acov[0]
+
+
+def effective_sample_size(x):
+    """
+    Effective sample size of a trace with Geyer's initial monotone sequence estimator:
+    autocorrelations are summed in pairs (consecutive lags) while the sums are positive, and the sums are made
+    non-increasing, this truncates the noisy tail of the autocorrelation function.
+    A constant trace carries no evidence of autocorrelation, its effective sample size is its length.
+
+    >>> rng = np.random.RandomState(1)
+    >>> 800 < effective_sample_size(rng.normal(size=1000)) < 1200
+    True
+    >>> effective_sample_size(np.repeat(rng.normal(size=100), 10)) < 200
+    True
+    >>> effective_sample_size(np.zeros(10) - 7.2559)
+    10.0
+    """
+    n = len(x)
+    if n < 4:
+        return float(n)
+    rho = autocorrelation(x)
+    pairs = rho[:n - n % 2].reshape(-1, 2).sum(axis=1)  # Gamma_k = rho_2k + rho_2k+1
+    first = np.flatnonzero(pairs <= 0)  # the first non-positive pair ends the sequence
+    pairs = pairs[:first[0]] if len(first) else pairs
+    pairs = np.minimum.accumulate(pairs)
+    tau = -1.0 + 2.0 * pairs.sum()  # integrated autocorrelation time
+    return n / max(tau, 1.0 / np.log10(n))  # tau is bounded away from 0 (antithetic traces)
+
+
+def split_rhat(traces):
+    """
+    Potential scale reduction factor (R-hat) computed over the two halves of each trace,
+    thus a single chain that has not mixed is detected too.
+    Traces are truncated to the length of the shortest one.
+    Values close to 1 indicate convergence.
+
+    >>> rng = np.random.RandomState(1)
+    >>> round(split_rhat([rng.normal(size=500) for _ in range(3)]), 2)
+    1.0
+    >>> split_rhat([rng.normal(size=500), rng.normal(size=500) + 2]) > 1.1
+    True
+    """
+    n = min(len(x) for x in traces) // 2
+    if n < 2:
+        return float('inf')
+    halves = []
+    for x in traces:
+        x = np.asarray(x, dtype=float)
+        halves.extend([x[:n], x[-n:]])
+    halves = np.array(halves)
+    within = halves.var(axis=1, ddof=1).mean()  # W
+    between = halves.mean(axis=1).var(ddof=1)  # B / n
+    if within == 0:
+        return 1.0 if between == 0 else float('inf')
+    return float(np.sqrt(((n - 1.0) / n * within + between) / within))
+
+
+def top_k_change(previous, current, k=10):
+    """
+    Largest change in the estimated probability of the k most frequent derivations,
+    between two sets of counts (e.g. before and after a round of sampling).
+
+    >>> from collections import Counter
+    >>> top_k_change(Counter({'a': 3, 'b': 1}), Counter({'a': 5, 'b': 3}), 1)
+    0.125
+    >>> top_k_change(Counter(), Counter({'a': 1}))
+    inf
+    """
+    total_previous = float(sum(previous.itervalues()))
+    total_current = float(sum(current.itervalues()))
+    if not total_previous or not total_current:
+        return float('inf')
+    return max(abs(n / total_current - previous.get(d, 0) / total_previous) for d, n in current.most_common(k))
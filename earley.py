@@ -3,34 +3,61 @@
 """
 
 EMPTY_SET = frozenset()
-from agenda import Agenda, ActiveQueue
+from functools import partial
+from agenda import Agenda, ActiveQueue, PriorityQueue, GeneratingBitsets, get_goal_items
+from hypergraph import make_hypergraph
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
-import itertools
+from symbol import is_terminal
 
 
 class Earley(object):
     """
     """
 
-    def __init__(self, wcfg, wfsa):
+    def __init__(self, wcfg, wfsa, generating_type=GeneratingBitsets, heuristic=None):
         """
+        :param heuristic: an admissible outside estimate (see heuristic.OutsideHeuristic),
+            if given, active items are processed best-first (A*) and intersection stops as soon as
+            the best goal item is found
         """
 
         self._wcfg = wcfg
         self._wfsa = wfsa
-        self._agenda = Agenda(active_container_type=ActiveQueue)
         self._predictions = set()  # (LHS, start)
         self._item_factory = ItemFactory()
-
-    def get_item(self, rule, dot, inner=[]):
-        return self._item_factory.get_item(rule, dot, inner)
+        self._heuristic = heuristic
+        if heuristic is None:
+            self._agenda = Agenda(active_container_type=ActiveQueue, generating_type=generating_type)
+        else:
+            self._agenda = Agenda(active_container_type=partial(PriorityQueue, priority=self.priority),
+                                  generating_type=generating_type)
+            self._inside = {}  # item -> Viterbi inside weight
+            self._best = {}  # (sym, start, end) -> Viterbi inside weight
+
+    def get_item(self, rule, dot, inner=[], inside=None):
+        """
+        Returns an item, in best-first mode we also record its Viterbi inside weight
+        (which defaults to the weight of the rule, as for items that have not intersected any symbol yet).
+        """
+        item = self._item_factory.get_item(rule, dot, inner)
+        if self._heuristic is not None and item not in self._inside:
+            self._inside[item] = rule.log_prob if inside is None else inside
+        return item
 
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        if self._heuristic is None:
+            return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        return self.get_item(item.rule, dot, item.inner + (item.dot,),
+                             self._inside[item] + self._best[(item.next, item.dot, dot)])
+
+    def priority(self, item):
+        """The Viterbi inside weight of an item plus an estimate of its outside weight"""
+        return self._inside[item] + self._heuristic(item.rule, len(item.inner))
+
+    def n_items(self):
+        """Number of items created so far"""
+        return len(self._item_factory)
 
     def axioms(self, symbol, start):
         rules = self._wcfg.get(symbol, None)
@@ -62,24 +89,28 @@ class Earley(object):
         If we get to a nondeterminism, we stop scanning and add the relevant items to the agenda.
         """
         states = [item.dot]
+        inside = self._inside[item] if self._heuristic is not None else None  # accumulates the weight of the arcs
         for sym in item.nextsymbols():
             if is_terminal(sym):
                 arcs = self._wfsa.get_arcs(origin=states[-1], symbol=sym)
                 if len(arcs) == 0:  # cannot scan the symbol
                     return False
                 elif len(arcs) == 1:  # symbol is scanned deterministically
-                    sto, _ = arcs[0]
+                    sto, w = arcs[0]
                     states.append(sto)  # we do not create intermediate items, instead we scan as much as we can
+                    if inside is not None:
+                        inside += w
                 else:  # here we found a nondeterminism, we create all relevant items and add them to the agenda
                     # create items
                     for sto, w in arcs:
-                        self._agenda.add(self.get_item(item.rule, sto, item.inner + tuple(states)))
+                        self._agenda.add(self.get_item(item.rule, sto, item.inner + tuple(states),
+                                                       inside + w if inside is not None else None))
                     return True
             else:  # that's it, scan bumped into a nonterminal symbol, time to wrap up
                 break
         # here we should have scanned at least one terminal symbol
         # and we defined a deterministic path
-        self._agenda.add(self.get_item(item.rule, states[-1], item.inner + tuple(states[:-1])))
+        self._agenda.add(self.get_item(item.rule, states[-1], item.inner + tuple(states[:-1]), inside))
         return True
 
     def complete_others(self, item):
@@ -102,7 +133,8 @@ class Earley(object):
         self._agenda.extend(new_items)
         return len(new_items) > 0
 
-    def do(self, root='[S]', goal='[GOAL]'):
+    def forest(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected forest as a compact hypergraph"""
 
         wfsa = self._wfsa
         wcfg = self._wcfg
@@ -118,11 +150,16 @@ class Earley(object):
             item = agenda.pop()  # always returns an active item
 
             if item.is_complete():
+                if self._heuristic is not None:
+                    # the first complete item to leave the queue is the best one for its annotated LHS
+                    self._best.setdefault((item.rule.lhs, item.start, item.dot), self._inside[item])
                 # complete root item spanning from a start wfsa state to a final wfsa state
                 if item.rule.lhs == root and wfsa.is_initial(item.start) and wfsa.is_final(item.dot):
                     agenda.make_complete(item)
                     new_roots.add((root, item.start, item.dot))
                     agenda.make_passive(item)
+                    if self._heuristic is not None:
+                        break  # this is the best goal item
                 else:
                     if self.complete_others(item):
                         agenda.make_complete(item)
@@ -141,57 +178,33 @@ class Earley(object):
                         if not self.prediction(item):  # try to predict, otherwise try to complete itself
                             self.complete_itself(item)
                         agenda.make_passive(item)
-        # converts complete items into rules
-        return self.get_cfg(goal, root)
+        # converts complete items into hyperedges
+        return self.get_forest(goal, root)
 
-    def get_intersected_rule(self, item):
-        lhs = make_symbol(item.rule.lhs, item.start, item.dot)
+    def do(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected CFG"""
+        return self.forest(root, goal).to_wcfg()
+
+    def get_edge_weight(self, item):
+        """Returns the weight of the edge associated with a complete item"""
         positions = item.inner + (item.dot,)
-        rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-        # compute the wfsa contribution (assuming that it is with a log-semiring)
-        wfsa_weight = 0.0
-        for i, sym in enumerate(item.rule.rhs):
-            if is_terminal(sym):
-                # assuming a log from positions[i] to positions[i + 1] with label `sym`
-                wfsa_weight += self._wfsa.arc_weight(positions[i], positions[i + 1], sym)
-        return Rule(lhs, rhs, item.rule.log_prob + wfsa_weight)
+        # the wfsa contribution comes from the arcs from positions[i] to positions[i + 1] with label `sym`
+        arcs = [(positions[i], positions[i + 1], sym) for i, sym in enumerate(item.rule.rhs) if is_terminal(sym)]
+        return item.rule.log_prob + self._wfsa.path_weight(arcs)
+
+    def get_forest(self, goal, root):
+        """
+        Constructs the intersected forest by visiting complete items in a top-down fashion (see agenda.get_forest).
+        """
+        return make_hypergraph(goal,
+                               get_goal_items(root, self._wfsa, self._agenda),
+                               self._agenda.itercomplete,
+                               self.get_edge_weight)
 
     def get_cfg(self, goal, root):
         """
         Constructs the CFG by visiting complete items in a top-down fashion.
         This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
         that could never be reached from the root.
-        Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
-        This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
-        """
-
-        G = WCFG()
-        processed = set()
-        fsa = self._wfsa
-        itergenerating = self._agenda.itergenerating
-        itercomplete = self._agenda.itercomplete
-
-        # create all intersected rules whose lefthand side symbol lhs spans from start to end
-        def make_rules(lhs, start, end):
-            if (start, lhs, end) in processed:
-                return
-            processed.add((lhs, start, end))
-            for item in itercomplete(lhs, start, end):
-                G.add(self.get_intersected_rule(item))
-                fsa_states = item.inner + (item.dot,)
-                for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
-                    if (sym, fsa_states[i], fsa_states[
-                            i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
-                        make_rules(sym, fsa_states[i], fsa_states[i + 1])
-
-        # create goal items
-        for start, ends in itergenerating(root):
-            if not fsa.is_initial(start):
-                continue
-            for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
-                make_rules(root, start, end)
-                final_weight = fsa.get_final_weight(end)
-                G.add(Rule(make_symbol(goal, None, None),
-                           [make_symbol(root, start, end)], final_weight))
-
-        return G
+        """
+        return self.get_forest(goal, root).to_wcfg()
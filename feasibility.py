@@ -0,0 +1,117 @@
+"""
+Early detection of sliced intersections that cannot reach the goal.
+
+With tight slice variables most cells of the chart end up empty, and the sliced parsers only find out that the
+goal is unreachable once the agenda is exhausted.
+If the agenda visits items in order of width, spans become final as deduction goes:
+nothing new will ever be proven for them.
+A span (i, j) can only be proven if it splits into at most R pieces (R is the longest right-hand side of the grammar),
+each piece being either a proven span or a single arc (where a terminal might be matched).
+Final spans are known exactly, the others are assumed provable if they split that way (an optimistic test),
+thus as soon as the span of the goal no longer splits, deduction can be aborted:
+the sliced forest would be empty anyway.
+
+This only applies to linear automata (states 0..n with arcs from i to i + 1) and grammars without empty productions,
+otherwise the test always succeeds.
+
+>>> from rule import Rule
+>>> from wcfg import SortedRules
+>>> from wfsa import make_linear_fsa
+>>> G = SortedRules([Rule('[S]', ['[X]', '[X]'], 0.0), Rule('[X]', ['a'], 0.0)])
+>>> F = Feasibility(G, make_linear_fsa('a a a a'))
+>>> F.prove(0, 1), F.prove(1, 2), F.finish_width(1)
+(None, None, False)
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+
+
+class Feasibility(object):
+    """
+    Keeps track of the spans proven by a sliced parser and of the spans that are final (see `finish_width`).
+    """
+
+    def __init__(self, rules, wfsa):
+        """
+        :param rules: the grammar rules indexed by wcfg.SortedRules (which also summarises the lengths of the RHSs)
+        :param wfsa: the automaton
+        """
+        self._n = self._linear_length(wfsa)
+        self.enabled = self._n is not None and not rules.has_empty
+        if not self.enabled:
+            return
+        n = self._n
+        self._rank = rules.max_length
+        self._terminal_pieces = rules.has_mixed  # whether a single arc may be matched by a terminal amongst other symbols
+        start, end = np.indices((n + 1, n + 1))
+        self._width = end - start
+        self._proven = np.zeros((n + 1, n + 1), dtype=bool)
+        self._final = np.zeros((n + 1, n + 1), dtype=bool)
+        self._feasible = True
+
+    @staticmethod
+    def _linear_length(wfsa):
+        """Returns the number of arcs in the path if the automaton is linear, None otherwise"""
+        n = wfsa.n_states() - 1
+        if n < 1 or list(wfsa.iterinitial()) != [0] or list(wfsa.iterfinal()) != [n]:
+            return None
+        origins = set()
+        for sfrom, sto, sym, w in wfsa.iterarcs():
+            if sto != sfrom + 1:
+                return None
+            origins.add(sfrom)
+        return n if len(origins) == n else None
+
+    def prove(self, start, end):
+        """Records that some symbol spanning from `start` to `end` has been proven"""
+        if self.enabled:
+            self._proven[start, end] = True
+
+    def finish_width(self, width):
+        """Spans up to a certain width are final, returns whether the goal is still reachable"""
+        return self._finish(self._width <= width) if self.enabled else True
+
+    def _finish(self, final):
+        """Marks spans as final (a boolean mask) and checks the span of the goal if necessary"""
+        if not self._feasible:
+            return False
+        # only spans that become final without being proven can change the outcome
+        new = final & ~self._final & ~self._proven & (self._width > 0)
+        if self._terminal_pieces:
+            new &= self._width > 1
+        self._final |= final
+        if new.any():
+            self._feasible = self._splits()
+        return self._feasible
+
+    def _splits(self):
+        """Whether the span of the goal splits into provable pieces (bottom-up by width)"""
+        n, rank = self._n, self._rank
+        final, proven, width = self._final, self._proven, self._width
+        infinity = n + rank + 1
+        # a piece is a proven span or a single arc (unless it is final and terminals cannot be matched there)
+        piece = proven | ((width == 1) & (~final | self._terminal_pieces))
+        pieces = np.where(piece, 1, infinity)  # minimum number of pieces that cover a span
+        for w in xrange(2, n + 1):
+            i = np.arange(n - w + 1)
+            j = i + w
+            m = i[:, None] + np.arange(1, w)[None, :]  # split points
+            split = np.minimum((pieces[i[:, None], m] + pieces[m, j[:, None]]).min(axis=1), infinity)
+            provable = proven[i, j] | (~final[i, j] & (split <= rank))
+            pieces[i, j] = np.where(provable, 1, split)
+        return bool(pieces[0, n] == 1)
+
+
+def root_passes(root, wfsa, rules, slice_vars):
+    """
+    Whether some rule rewriting the root could pass the slice variable of a span from an initial to a final state.
+    If not, no goal item can be proven, whatever the rest of the chart looks like.
+
+    :param rules: the grammar rules indexed by wcfg.SortedRules
+    """
+    return any(rules.any_above(root, first, slice_vars.get(root, start, end))
+               for start in wfsa.iterinitial()
+               for end in wfsa.iterfinal()
+               for first in rules.first_of(root))
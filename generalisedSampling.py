@@ -2,19 +2,204 @@
 :Authors: - Iason
 """
 
-from symbol import is_nonterminal
 import random
+import bisect
 import numpy as np
+from collections import Counter
+from inference import edge_inside
+from hypergraph import _concatenate_ranges
+
+
+class DerivationCounter(object):
+    """
+    Counts derivations (arrays of edge ids) hashing their byte representation,
+    thus memory grows with the number of distinct derivations rather than with the number of samples.
+
+    >>> counts = DerivationCounter()
+    >>> counts.add(np.array([3, 1, 0]))
+    >>> counts.add(np.array([3, 1, 0]))
+    >>> counts.add(np.array([3, 2]))
+    >>> [(d.tolist(), n) for d, n in counts.most_common()]
+    [([3, 1, 0], 2), ([3, 2], 1)]
+    >>> len(counts), counts.total()
+    (2, 3)
+    """
+
+    def __init__(self):
+        self._counts = Counter()
+        self._derivations = {}
+
+    def add(self, d, n=1):
+        key = d.tobytes()
+        if key not in self._derivations:
+            self._derivations[key] = d.copy()
+        self._counts[key] += n
+
+    def update(self, other):
+        """Merges the counts of another DerivationCounter into this one"""
+        for key, n in other._counts.iteritems():
+            if key not in self._derivations:
+                self._derivations[key] = other._derivations[key]
+            self._counts[key] += n
+
+    def __len__(self):
+        """Number of distinct derivations"""
+        return len(self._counts)
+
+    def total(self):
+        """Number of derivations"""
+        return sum(self._counts.itervalues())
+
+    def most_common(self, n=None):
+        """
+        Returns pairs (derivation, count) from the most common derivation to the least common
+        (ties are broken deterministically).
+        """
+        ranked = sorted(self._counts.iteritems(), key=lambda (key, count): (-count, key))
+        return [(self._derivations[key], count) for key, count in ranked[:n]]
+
+
+class SamplingTables(object):
+    """
+    The arrays needed to draw derivations in batches, stripped of any python object (e.g. rules),
+    thus they can be placed in shared memory and used by forked worker processes without copying or pickling.
+        * `goal`: the goal node
+        * `keys`: edge -> head node + cumulative probability of the edge among the edges incoming to its head
+        * `edge_offsets`, `tail`, `tail_offsets`: the structure of the hypergraph (see hypergraph.Hypergraph)
+    """
+
+    def __init__(self, goal, keys, edge_offsets, tail, tail_offsets):
+        self.goal = goal
+        self.keys = keys
+        self.edge_offsets = edge_offsets
+        self.tail = tail
+        self.tail_offsets = tail_offsets
+
+    def share(self):
+        """Returns a copy of the tables backed by shared memory"""
+        return SamplingTables(self.goal, *[_shared_copy(a) for a in [self.keys, self.edge_offsets,
+                                                                       self.tail, self.tail_offsets]])
+
+    def batch(self, n, rng=np.random):
+        """
+        Draws n derivations at once: all samples are expanded top-down in lockstep,
+        at each step every pending node (across the whole batch) selects an incoming edge with a single vectorised
+        search over the sampling tables.
+
+        :param n: number of derivations
+        :param rng: a numpy random state
+        :returns: a sample id per edge, and the edges themselves, grouped by sample id;
+            within a sample, edges are in breadth-first order (thus the first edge is the top one)
+        """
+        offsets = self.edge_offsets
+        arity = np.diff(self.tail_offsets)
+        is_leaf = offsets[:-1] == offsets[1:]
+        frontier_ids = np.arange(n)
+        frontier = np.repeat(self.goal, n)
+        ids, edges = [], []
+        while len(frontier):
+            # one uniform per pending node (rounding errors are absorbed by the node's last edge)
+            selected = np.searchsorted(self.keys, frontier + rng.random_sample(len(frontier)), side='right')
+            selected = np.minimum(selected, offsets[frontier + 1] - 1)
+            ids.append(frontier_ids)
+            edges.append(selected)
+            # the nonterminal children of the selected edges are expanded next (order is preserved)
+            children = self.tail[_concatenate_ranges(self.tail_offsets[selected], arity[selected])]
+            children_ids = np.repeat(frontier_ids, arity[selected])
+            keep = ~is_leaf[children]
+            frontier, frontier_ids = children[keep], children_ids[keep]
+        ids, edges = np.concatenate(ids), np.concatenate(edges)
+        order = np.argsort(ids, kind='mergesort')  # stable, thus breadth-first order is preserved
+        return ids[order], edges[order]
+
+    def sample_counts(self, n, batch_size=1000, rng=np.random, counts=None):
+        """
+        Draws n derivations in batches and counts them.
+        :param n: number of derivations
+        :param batch_size: how many derivations are drawn at once (this bounds memory usage)
+        :param rng: a numpy random state
+        :param counts: a DerivationCounter to be updated (by default we create one)
+        :returns: a DerivationCounter
+        """
+        if counts is None:
+            counts = DerivationCounter()
+        while n > 0:
+            size = min(n, batch_size)
+            ids, edges = self.batch(size, rng)
+            boundaries = np.searchsorted(ids, np.arange(size + 1))
+            for i in xrange(size):
+                counts.add(edges[boundaries[i]:boundaries[i + 1]])
+            n -= size
+        return counts
+
+    def parallel_sample_counts(self, n, workers=1, seed=None, batch_size=1000, on_chunk=None):
+        """
+        Draws n derivations with a pool of worker processes and merges their counts.
+
+        The work is split in fixed-size chunks (of `batch_size` derivations), each chunk has its own random state
+        seeded by the pair (seed, chunk id), thus for a fixed seed the result does not depend on the number of workers.
+        The tables are placed in shared memory before the workers are forked, workers find them in a global variable.
+
+        :param n: number of derivations
+        :param workers: number of processes (with a single worker we sample in the current process)
+        :param seed: an integer seed (by default we draw one)
+        :param batch_size: number of derivations per chunk
+        :param on_chunk: called with the counts merged so far after every chunk (e.g. to report intermediate estimates)
+        :returns: a DerivationCounter
+        """
+        global _TABLES
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        chunks = [(seed, chunk, min(batch_size, n - start)) for chunk, start in enumerate(xrange(0, n, batch_size))]
+        counts = DerivationCounter()
+        if workers > 1:
+            from multiprocessing import Pool  # only needed (and loaded) when sampling in parallel
+            _TABLES = self.share()
+            pool = Pool(workers)
+            try:
+                for partial in pool.imap(_sample_chunk, chunks):
+                    counts.update(partial)
+                    if on_chunk is not None:
+                        on_chunk(counts)
+            finally:
+                pool.close()
+                pool.join()
+                _TABLES = None
+        else:
+            for seed, chunk, size in chunks:
+                self.sample_counts(size, batch_size, np.random.RandomState([seed, chunk]), counts)
+                if on_chunk is not None:
+                    on_chunk(counts)
+        return counts
+
+
+# the tables used by forked workers (see SamplingTables.parallel_sample_counts)
+_TABLES = None
+
+
+def _sample_chunk((seed, chunk, size)):
+    """Draws a chunk of derivations in a worker process"""
+    return _TABLES.sample_counts(size, size, np.random.RandomState([seed, chunk]))
+
+
+def _shared_copy(array):
+    """Copies an array of int64 or float64 into shared memory"""
+    import ctypes
+    from multiprocessing.sharedctypes import RawArray
+    ctype = ctypes.c_double if array.dtype == np.float64 else ctypes.c_int64
+    shared = np.frombuffer(RawArray(ctype, max(len(array), 1)), dtype=array.dtype)[:len(array)]
+    shared[:] = array
+    return shared
 
 
 class GeneralisedSampling(object):
 
-    def __init__(self, forest, inside_node, omega=lambda edge: edge.log_prob):
+    def __init__(self, forest, inside_node, omega=None):
         """
 
-        :param forest: an acyclic hypergraph
-        :param inside_node: a dictionary mapping nodes to their inside weights.
-        :param omega: a function that returns the weight of an edge.
+        :param forest: an acyclic hypergraph (see hypergraph.Hypergraph)
+        :param inside_node: an array mapping nodes to their inside weights.
+        :param omega: an array of edge weights indexed by edge id.
             By default we return the edge's log probability, but omega
             can be used in situations where we must compute a function of that weight, for example,
             when we want to convert from a semiring to another,
@@ -23,73 +208,98 @@ class GeneralisedSampling(object):
 
         self.forest = forest
         self.inside_node = inside_node
-        self.inside_edge = dict()  # cache for the inside weight of edges
-        self.omega = omega
+        self.omega = omega if omega is not None else forest.weight
+        self._tables()
+
+    def _tables(self):
+        """
+        Builds the sampling tables once per forest:
+        for each node, the cumulative distribution of its incoming edges (edges are grouped by head node).
+        Edge probabilities are normalised in log-domain, i.e. exp(inside(edge) - inside(head)),
+        thus they do not underflow even when the inside weights themselves would.
+        """
+        forest = self.forest
+        with np.errstate(invalid='ignore'):
+            p = np.exp(edge_inside(forest, self.inside_node, self.omega) - self.inside_node[forest.head])
+        p[np.isnan(p)] = 0.0  # edges incoming to nodes with no derivation (never visited)
+        # cumulative sums restarted at the first edge of each node
+        cdf = np.cumsum(p)
+        offsets = forest.edge_offsets
+        before = np.concatenate(([0.0], cdf))[offsets[:-1]]
+        cdf -= np.repeat(before, np.diff(offsets))
+        # renormalise so that each node's distribution ends exactly at 1
+        totals = np.repeat(cdf[np.maximum(offsets[1:] - 1, 0)] if len(cdf) else np.zeros(0), np.diff(offsets))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cdf /= totals
+        cdf[np.isnan(cdf)] = 1.0  # nodes with no derivation
+        self.cdf = cdf.tolist()
+        self.tables = SamplingTables(forest.goal, forest.head + cdf, offsets, forest.tail, forest.tail_offsets)
+        self._edge_offsets = offsets.tolist()
+        self._tail = forest.tail.tolist()
+        self._tail_offsets = forest.tail_offsets.tolist()
 
-    def sample(self, goal='[GOAL]'):
+    def sample(self, goal=None, rng=random):
         """
         the generalised sample algorithm
+        :param goal: the node from which we sample (defaults to the forest's goal node)
+        :param rng: a python random state (by default the global one)
+        :returns: a derivation as a list of edge ids (in pre-order)
         """
 
         # an empty partial derivation
         d = []
 
         # Q, a queue of nodes to be visited, starting from [GOAL]
-        Q = [goal]
+        Q = [self.forest.goal if goal is None else goal]
 
+        edge_offsets = self._edge_offsets
         while Q:
             parent = Q.pop()
 
             # select an edge
-            edge = self.select(parent)
+            edge = self.select(parent, rng)
 
             # add the edge to the partial derivation
             d.append(edge)
 
             # queue the non-terminal nodes in the tail of the selected edge
-            for child in edge.rhs:
-                if is_nonterminal(child):
+            # (in reverse, thus the derivation comes out in pre-order, left to right)
+            for child in reversed(self._tail[self._tail_offsets[edge]:self._tail_offsets[edge + 1]]):
+                if edge_offsets[child] < edge_offsets[child + 1]:
                     Q.append(child)
 
         return d
 
-    def get_edge_inside(self, edge):
-        """Compute the inside weight of an edge (caching the result)."""
-        w = self.inside_edge.get(edge, None)
-        if w is None:
-            # starting from the edge's own weight
-            # and including the inside of each child node
-            # accumulate (log-domain) all contributions
-            w = sum((self.inside_node[child] for child in edge.rhs), self.omega(edge))
-            self.inside_edge[edge] = w
-        return w
-
-    def select(self, parent):
+    def select(self, parent, rng=random):
         """
         select method, draws a random edge with respect to the Inside weight distribution
+        by bisecting the parent's cumulative distribution (O(log k) for a node with k incoming edges)
+        :param rng: a python random state (by default the global one)
         """
-        # self.iq = dict()
-        incoming = self.forest.get(parent, frozenset())
+        first, last = self._edge_offsets[parent], self._edge_offsets[parent + 1]
 
-        if not incoming:
+        if first == last:
             raise ValueError('I cannot sample an incoming edge to a terminal node')
 
-        # the inside weight of the parent node
-        ip = self.inside_node[parent]
-
-        # select an edge randomly with respect to the distribution of the edges
-        # threshold for selecting an edge
-        threshold = np.log(random.uniform(0, np.exp(ip)))
-
-        acc = -float("inf")
-        for e in incoming:
-            # acc = math.log(math.exp(acc) + math.exp(self.get_edge_inside(e)))
-            acc = np.logaddexp(acc, self.get_edge_inside(e))
-            if acc > threshold:
-                return e
+        # the first edge whose cumulative probability exceeds the threshold
+        # (rounding errors are absorbed by the last edge)
+        return min(bisect.bisect_right(self.cdf, rng.random(), first, last), last - 1)
 
-        # if there is not yet an edge returned for some rare rounding error,
-        # return the last edge, hence that is the edge closest to the threshold
-        return e
+    def batch(self, n, rng=np.random):
+        """Draws n derivations at once (see SamplingTables.batch)"""
+        return self.tables.batch(n, rng)
 
+    def sample_counts(self, n, batch_size=1000, rng=np.random, counts=None):
+        """
+        Draws n derivations in batches and counts them.
+        :param n: number of derivations
+        :param batch_size: how many derivations are drawn at once (this bounds memory usage)
+        :param rng: a numpy random state
+        :param counts: a DerivationCounter to be updated (by default we create one)
+        :returns: a DerivationCounter
+        """
+        return self.tables.sample_counts(n, batch_size, rng, counts)
 
+    def parallel_sample_counts(self, n, workers=1, seed=None, batch_size=1000, on_chunk=None):
+        """Draws n derivations in parallel and counts them (see SamplingTables.parallel_sample_counts)"""
+        return self.tables.parallel_sample_counts(n, workers, seed, batch_size, on_chunk)
@@ -0,0 +1,105 @@
+"""
+Admissible outside estimates for best-first (A*) intersection.
+
+These are context summary estimates computed from the grammar alone (Klein and Manning, 2003):
+    1) an upper bound on the (Viterbi) inside weight of a symbol, that is, the best derivation rooted by the symbol
+    over any string
+    2) an upper bound on the (Viterbi) outside weight of a symbol, that is, the best context in which the symbol
+    can be embedded under the root
+Both are computed with Knuth's generalisation of Dijkstra's algorithm, which requires weights to be
+log-probabilities (thus non-positive).
+
+:Authors: - Wilker Aziz
+"""
+
+import heapq
+from collections import defaultdict
+from symbol import is_terminal
+
+
+class OutsideHeuristic(object):
+    """
+    An admissible (and consistent) estimate of the outside weight of an item.
+
+    >>> from rule import Rule
+    >>> from wcfg import WCFG
+    >>> G = WCFG([Rule('[S]', ['[X]', '[Y]'], -1.0), Rule('[X]', ['a'], -0.5), Rule('[X]', ['[X]', '[X]'], -0.1), Rule('[Y]', ['b'], -2.0)])
+    >>> h = OutsideHeuristic(G, '[S]')
+    >>> h.inside('[S]'), h.inside('[X]'), h.inside('a')
+    (-3.5, -0.5, 0.0)
+    >>> h.outside('[S]'), h.outside('[X]'), h.outside('[Y]')
+    (0.0, -3.0, -1.5)
+    """
+
+    def __init__(self, wcfg, root):
+        if any(rule.log_prob > 0 for rule in wcfg):
+            raise ValueError('Outside estimates require non-positive (log-probability) weights')
+        self._inside = self._inside_bounds(wcfg)
+        self._outside = self._outside_bounds(wcfg, root, self._inside)
+        self._estimates = {}  # (rule, number of symbols already intersected) -> estimate
+
+    def inside(self, sym):
+        """Upper bound on the inside weight of a symbol (terminals have inside weight 1, i.e. 0 in log-domain)"""
+        return 0.0 if is_terminal(sym) else self._inside.get(sym, -float('inf'))
+
+    def outside(self, sym):
+        """Upper bound on the outside weight of a nonterminal symbol"""
+        return self._outside.get(sym, -float('inf'))
+
+    def __call__(self, rule, n):
+        """
+        Upper bound on the weight of everything an item still needs in order to become part of a goal derivation,
+        that is, the RHS symbols not yet intersected and the context of the LHS symbol.
+        :param rule: the item's rule
+        :param n: how many RHS symbols have been intersected already
+        """
+        key = (rule, n)
+        estimate = self._estimates.get(key, None)
+        if estimate is None:
+            estimate = sum((self.inside(sym) for sym in rule.rhs[n:]), self.outside(rule.lhs))
+            self._estimates[key] = estimate
+        return estimate
+
+    @staticmethod
+    def _inside_bounds(wcfg):
+        pending = {}  # rule -> number of RHS nonterminals whose inside bound is not yet known
+        waiting = defaultdict(list)  # nonterminal -> rules in whose RHS it occurs
+        agenda = []
+        for rule in wcfg:
+            nonterminals = set(sym for sym in rule.rhs if not is_terminal(sym))
+            pending[rule] = len(nonterminals)
+            for sym in nonterminals:
+                waiting[sym].append(rule)
+            if not nonterminals:
+                heapq.heappush(agenda, (-rule.log_prob, rule.lhs))
+        bounds = {}
+        while agenda:
+            w, sym = heapq.heappop(agenda)
+            if sym in bounds:
+                continue
+            bounds[sym] = 0.0 - w  # the best derivation is the first to leave the agenda
+            for rule in waiting.get(sym, []):
+                pending[rule] -= 1
+                if pending[rule] == 0 and rule.lhs not in bounds:
+                    total = sum((bounds[s] for s in rule.rhs if not is_terminal(s)), rule.log_prob)
+                    heapq.heappush(agenda, (-total, rule.lhs))
+        return bounds
+
+    @staticmethod
+    def _outside_bounds(wcfg, root, inside):
+        bounds = {}
+        agenda = [(0.0, root)]
+        while agenda:
+            w, sym = heapq.heappop(agenda)
+            if sym in bounds:
+                continue
+            bounds[sym] = 0.0 - w  # the best context is the first to leave the agenda
+            for rule in wcfg.get(sym):
+                rhs = [inside.get(s, -float('inf')) if not is_terminal(s) else 0.0 for s in rule.rhs]
+                total = sum(rhs, bounds[sym] + rule.log_prob)
+                if total == -float('inf'):  # the rule is not productive
+                    continue
+                for s, w_s in zip(rule.rhs, rhs):
+                    if not is_terminal(s) and s not in bounds:
+                        heapq.heappush(agenda, (-(total - w_s), s))
+        return bounds
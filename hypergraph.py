@@ -0,0 +1,373 @@
+"""
+A compact (array-backed) representation of intersected forests.
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+from collections import defaultdict
+from symbol import make_symbol, is_nonterminal
+from topsort import strongly_connected_components
+from rule import Rule
+from wcfg import WCFG
+
+
+class Hypergraph(object):
+    """
+    A hypergraph (possibly cyclic) stored in flat arrays:
+        1) a node table: node id -> (symbol, start, end)
+        2) edge -> head node
+        3) edge -> tail nodes (a flat array of node ids indexed by `tail_offsets`)
+        4) edge -> weight (log-domain)
+
+    Nodes are numbered in topological order of their strongly connected components (leaves first, goal last),
+    thus in an acyclic hypergraph children are numbered before their parents (see `is_acyclic`),
+    whereas the nodes of a cycle (e.g. due to unary or epsilon rules, or to cyclic automata) depend on one another
+    and are numbered consecutively (see `levels`).
+    Edges are grouped by head node, that is,
+    the edges incoming to node `v` are `edge_offsets[v]` ... `edge_offsets[v + 1] - 1`.
+    """
+
+    def __init__(self, nodes, head, tail, tail_offsets, weight, rules):
+        """
+        :param nodes: list of (symbol, start, end) triplets in topological order
+        :param head: edge -> head node (sorted)
+        :param tail: concatenation of the tails of all edges
+        :param tail_offsets: edge -> first position in `tail` (with one extra entry at the end)
+        :param weight: edge -> log weight
+        :param rules: edge -> grammar rule that originated it
+        """
+        self._nodes = nodes
+        self._node_index = {node: i for i, node in enumerate(nodes)}
+        self.head = np.asarray(head, dtype=np.int64)
+        self.tail = np.asarray(tail, dtype=np.int64)
+        self.tail_offsets = np.asarray(tail_offsets, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=float)
+        self.edge_offsets = np.searchsorted(self.head, np.arange(len(nodes) + 1)).astype(np.int64)
+        self._rules = rules
+        self._levels = None
+        self._acyclic = None
+
+    def __len__(self):
+        """Number of edges"""
+        return len(self.head)
+
+    def __nonzero__(self):
+        return len(self.head) > 0
+
+    @property
+    def n_nodes(self):
+        return len(self._nodes)
+
+    @property
+    def n_edges(self):
+        return len(self.head)
+
+    @property
+    def goal(self):
+        """The goal node is the last node in topological order"""
+        return len(self._nodes) - 1
+
+    def node(self, v):
+        """Returns the triplet (symbol, start, end) associated with a node"""
+        return self._nodes[v]
+
+    def fetch(self, sym, start=None, end=None):
+        """Returns the id of a node (or None if the node does not exist)"""
+        return self._node_index.get((sym, start, end), None)
+
+    def label(self, v):
+        """Returns the annotated symbol of a node (e.g. [NP,0-2])"""
+        return make_symbol(*self._nodes[v])
+
+    def is_terminal(self, v):
+        """Whether a node is a leaf (has no incoming edges)"""
+        return self.edge_offsets[v] == self.edge_offsets[v + 1]
+
+    def iterincoming(self, v):
+        """Iterates through the ids of the edges incoming to a node"""
+        return xrange(self.edge_offsets[v], self.edge_offsets[v + 1])
+
+    def children(self, e):
+        """Returns the tail of an edge (an array of node ids)"""
+        return self.tail[self.tail_offsets[e]:self.tail_offsets[e + 1]]
+
+    def arity(self):
+        """Returns an array mapping an edge to the number of nodes in its tail"""
+        return np.diff(self.tail_offsets)
+
+    def is_acyclic(self):
+        """Whether no node depends on itself (in which case children are numbered before their parents)"""
+        if self._acyclic is None:
+            self._acyclic = bool(np.all(self.tail < np.repeat(self.head, self.arity())))
+        return self._acyclic
+
+    def levels(self):
+        """
+        Groups the nonterminal nodes by level, where a node's level is the length of the longest path from it
+        down to a leaf. Nodes in a level only depend on nodes in lower levels, thus they can be processed in batch.
+
+        In a cyclic forest, levels are assigned to strongly connected components instead
+        and each cyclic component makes a level of its own (marked `cyclic`), whose nodes depend on one another.
+
+        :returns: a list of Level objects (from level 1 upwards), the list is computed once and cached
+        """
+        if self._levels is None:
+            self._levels = _make_levels(self) if self.is_acyclic() else _make_cyclic_levels(self)
+        return self._levels
+
+    def rule(self, e):
+        """Returns the grammar rule that originated an edge"""
+        return self._rules[e]
+
+    def make_rule(self, e):
+        """Constructs an annotated Rule for a given edge"""
+        return Rule(self.label(self.head[e]),
+                    [self.label(c) for c in self.children(e)],
+                    self.weight[e])
+
+    def subgraph(self, edges, weight=None):
+        """
+        Returns the hypergraph made of a subset of the edges and of the nodes they connect.
+        Nodes keep their relative order, thus the goal node remains the last one (as long as some edge is kept).
+
+        :param edges: ids of the edges to keep (in increasing order)
+        :param weight: log weights of the kept edges (defaults to their current weights)
+        """
+        edges = np.asarray(edges, dtype=np.int64)
+        if len(edges) == 0:
+            return Hypergraph([], [], [], [0], [], [])
+        arity = self.arity()[edges]
+        head = self.head[edges]
+        tail = self.tail[_concatenate_ranges(self.tail_offsets[edges], arity)]
+        used = np.zeros(self.n_nodes, dtype=bool)
+        used[head] = True
+        used[tail] = True
+        renumber = np.cumsum(used) - 1
+        return Hypergraph([self._nodes[v] for v in np.flatnonzero(used)],
+                          renumber[head],
+                          renumber[tail],
+                          np.concatenate(([0], np.cumsum(arity))),
+                          self.weight[edges] if weight is None else weight,
+                          [self._rules[e] for e in edges])
+
+    def to_wcfg(self):
+        """Converts the hypergraph into a CFG whose nonterminals are annotated with FSA states"""
+        G = WCFG()
+        for e in xrange(self.n_edges):
+            G.add(self.make_rule(e))
+        return G
+
+
+class Level(object):
+    """
+    A batch of nodes that can be processed together in bottom-up (or top-down) passes:
+        * `nodes`: the head nodes in the level
+        * `edges`: the edges incoming to those nodes (grouped by head node)
+        * `edge_starts`: where each node's group of edges starts in `edges`
+        * `tail`: the concatenation of the tails of those edges
+        * `tail_starts`: where each edge's tail starts in `tail`
+        * `arity`: the length of each edge's tail
+        * `cyclic`: whether the nodes form a cyclic component (i.e. they depend on one another)
+    """
+
+    def __init__(self, nodes, edges, edge_starts, tail, tail_starts, arity, cyclic=False):
+        self.nodes = nodes
+        self.edges = edges
+        self.edge_starts = edge_starts
+        self.tail = tail
+        self.tail_starts = tail_starts
+        self.arity = arity
+        self.cyclic = cyclic
+
+
+def _make_levels(forest):
+    """Computes the level of each node (leaves have level 0) and groups nodes and edges by level"""
+    tail = forest.tail.tolist()
+    tail_offsets = forest.tail_offsets.tolist()
+    edge_offsets = forest.edge_offsets.tolist()
+    level = [0] * forest.n_nodes
+    for v in xrange(forest.n_nodes):  # nodes are topologically sorted
+        for e in xrange(edge_offsets[v], edge_offsets[v + 1]):
+            for c in tail[tail_offsets[e]:tail_offsets[e + 1]]:
+                if level[c] >= level[v]:
+                    level[v] = level[c] + 1
+        if level[v] == 0 and edge_offsets[v] < edge_offsets[v + 1]:  # only nullary edges
+            level[v] = 1
+    level = np.array(level, dtype=np.int64)
+    # nodes sorted by level (the sort is stable, thus within a level nodes remain sorted by id)
+    order = np.argsort(level, kind='mergesort')
+    boundaries = np.searchsorted(level[order], np.arange(level.max() + 2) if len(level) else [0])
+    levels = []
+    for lvl in xrange(1, len(boundaries) - 1):
+        nodes = order[boundaries[lvl]:boundaries[lvl + 1]]
+        if len(nodes) > 0:
+            levels.append(_make_level(forest, nodes))
+    return levels
+
+
+def _make_level(forest, nodes, cyclic=False):
+    """Gathers the edges incoming to a batch of nodes and their tails"""
+    # edges incoming to these nodes, grouped by head
+    counts = forest.edge_offsets[nodes + 1] - forest.edge_offsets[nodes]
+    edges = _concatenate_ranges(forest.edge_offsets[nodes], counts)
+    edge_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    # their tails
+    edge_arity = forest.arity()[edges]
+    tail_nodes = forest.tail[_concatenate_ranges(forest.tail_offsets[edges], edge_arity)]
+    tail_starts = np.concatenate(([0], np.cumsum(edge_arity)[:-1]))
+    return Level(nodes, edges, edge_starts, tail_nodes, tail_starts, edge_arity, cyclic)
+
+
+def _make_cyclic_levels(forest):
+    """
+    Computes the strongly connected components of a cyclic forest and assigns levels to them:
+    a component's level is one plus the highest level amongst the components it depends on.
+    Acyclic nodes with the same level are batched together, cyclic components make levels of their own.
+    """
+    tail = forest.tail.tolist()
+    tail_offsets = forest.tail_offsets.tolist()
+    edge_offsets = forest.edge_offsets.tolist()
+
+    def children(v):
+        return (c for e in xrange(edge_offsets[v], edge_offsets[v + 1])
+                for c in tail[tail_offsets[e]:tail_offsets[e + 1]])
+
+    component_of = [0] * forest.n_nodes
+    components = strongly_connected_components(forest.n_nodes, children)
+    level = [0] * len(components)
+    batches = defaultdict(list)  # level -> acyclic nodes
+    cyclic = defaultdict(list)  # level -> cyclic components
+    for i, component in enumerate(components):  # components come after those they depend on
+        for v in component:
+            component_of[v] = i
+        lvl = 0
+        is_cyclic = len(component) > 1
+        for v in component:
+            for c in children(v):
+                if component_of[c] != i:
+                    lvl = max(lvl, level[component_of[c]] + 1)
+                else:
+                    is_cyclic = True
+                    lvl = max(lvl, 1)
+            if edge_offsets[v] < edge_offsets[v + 1]:
+                lvl = max(lvl, 1)
+        level[i] = lvl
+        if lvl == 0:  # leaves
+            continue
+        if is_cyclic:
+            cyclic[lvl].append(np.array(sorted(component), dtype=np.int64))
+        else:
+            batches[lvl].extend(component)
+    levels = []
+    for lvl in xrange(1, max(level) + 1 if level else 1):
+        if batches[lvl]:
+            levels.append(_make_level(forest, np.array(sorted(batches[lvl]), dtype=np.int64)))
+        for nodes in cyclic[lvl]:
+            levels.append(_make_level(forest, nodes, cyclic=True))
+    return levels
+
+
+def _concatenate_ranges(starts, lengths):
+    """
+    Concatenates the ranges [starts[i], starts[i] + lengths[i]) into a single array of indices.
+
+    >>> _concatenate_ranges(np.array([5, 0, 2]), np.array([2, 0, 3]))
+    array([5, 6, 2, 3, 4])
+    """
+    total = lengths.sum()
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    # each position is the start of its range plus its offset within that range
+    ends = np.cumsum(lengths)
+    offsets = np.arange(total) - np.repeat(ends - lengths, lengths)
+    return np.repeat(starts, lengths) + offsets
+
+
+def _annotated_rhs(item):
+    """Returns the tail of an item as a list of (symbol, start, end) triplets"""
+    positions = item.inner + (item.dot,)
+    return [(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
+
+
+def make_hypergraph(goal, roots, itercomplete, edge_weight=lambda item: item.rule.log_prob):
+    """
+    Constructs a compact hypergraph by visiting complete items in a top-down fashion.
+    This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
+    that could never be reached from the root.
+
+    This is an iterative version of the recursive procedure described in the paper (Nederhof and Satta, 2008),
+    thus it is not bound by Python's recursion limit.
+    Nodes are numbered in post-order, which makes them topologically sorted (leaves first).
+
+    :param goal: the goal symbol
+    :param roots: a sequence of pairs ((root, start, end), final weight)
+    :param itercomplete: a function that returns the complete items associated with (lhs, start, end)
+    :param edge_weight: a function that computes the weight of the edge associated with a complete item
+    :returns: a Hypergraph
+    """
+
+    nodes = []  # node id -> (sym, start, end)
+    node_id = {}  # (sym, start, end) -> node id
+    incoming = []  # node id -> complete items
+    visiting = set()
+
+    def expand(node):
+        """Returns a frame of the depth-first search"""
+        visiting.add(node)
+        items = list(itercomplete(*node)) if is_nonterminal(node[0]) else []
+        pending = (child for item in items for child in _annotated_rhs(item))
+        return node, items, pending
+
+    for root, _ in roots:
+        if root in node_id:
+            continue
+        stack = [expand(root)]
+        while stack:
+            node, items, pending = stack[-1]
+            for child in pending:
+                if child not in visiting:  # this also skips nodes already numbered
+                    stack.append(expand(child))
+                    break
+            else:  # all children have been numbered (post-order)
+                stack.pop()
+                node_id[node] = len(nodes)
+                nodes.append(node)
+                incoming.append(items)
+
+    if not nodes:
+        return Hypergraph([], [], [], [0], [], [])
+
+    # in a cyclic forest the post-order is not topological, thus we renumber nodes by strongly connected component
+    tails = [[[node_id[child] for child in _annotated_rhs(item)] for item in complete] for complete in incoming]
+    if any(c >= v for v, edges in enumerate(tails) for children in edges for c in children):
+        successors = lambda v: (c for children in tails[v] for c in children)
+        order = [v for component in strongly_connected_components(len(nodes), successors) for v in component]
+        renumber = [0] * len(nodes)
+        for new, old in enumerate(order):
+            renumber[old] = new
+        nodes = [nodes[old] for old in order]
+        node_id = dict((node, v) for v, node in enumerate(nodes))
+        incoming = [incoming[old] for old in order]
+        tails = [[[renumber[c] for c in children] for children in tails[old]] for old in order]
+
+    head, tail, tail_offsets, weight, rules = [], [], [0], [], []
+    for v, items in enumerate(incoming):
+        for item, children in zip(items, tails[v]):
+            head.append(v)
+            tail.extend(children)
+            tail_offsets.append(len(tail))
+            weight.append(edge_weight(item))
+            rules.append(item.rule)
+
+    # the goal node comes last
+    v = len(nodes)
+    nodes.append((goal, None, None))
+    for root, final_weight in roots:
+        head.append(v)
+        tail.append(node_id[root])
+        tail_offsets.append(len(tail))
+        weight.append(final_weight)
+        rules.append(Rule(goal, [root[0]], final_weight))
+
+    return Hypergraph(nodes, head, tail, tail_offsets, weight, rules)
@@ -2,40 +2,322 @@
 :Authors: - Iason
 """
 
-from collections import defaultdict
+import heapq
+import logging
 import numpy as np
+from semiring import LogSemiring, ViterbiSemiring
 
 
-def inside(forest, topsort, omega=lambda edge: edge.log_prob):
+# fixed-point iteration for cyclic components stops when no value changes by more than this (in log-domain)
+TOLERANCE = 1e-10
+MAX_ITERATIONS = 10000
+
+
+def inside(forest, omega=None, semiring=LogSemiring(), tolerance=TOLERANCE, max_iterations=MAX_ITERATIONS):
     """
     Inside recursion.
-    :param forest: an acyclic hypergraph.
-    :param topsort: a partial ordering of the nodes in the forest.
-    :param omega: a function that computes the weight of an edge (defaults to the edge's own log probability)
-    :return: a dictionary mapping a symbol to its inside weight.
+
+    For semirings that support segmented reductions (e.g. LogSemiring and ViterbiSemiring) this is vectorised:
+    nodes are processed level by level (see hypergraph.Hypergraph.levels), the inside weights of the children
+    of all edges in a level are gathered at once and reduced per edge (times) and per head node (plus).
+    Other semirings fall back to a loop over nodes (and require an acyclic forest).
+
+    In a cyclic forest (e.g. due to unary or epsilon cycles) levels are made of strongly connected components,
+    the inside weights of the nodes in a cyclic component are solved by fixed-point iteration:
+    starting from zero, we recompute the component's inside weights until they change by no more than `tolerance`.
+
+    :param forest: a hypergraph whose nodes are topologically sorted (see hypergraph.Hypergraph).
+    :param omega: an array of (log) edge weights indexed by edge id (defaults to the edges' own log probabilities)
+    :param semiring: the semiring in which we accumulate inside weights (log-sum-exp by default)
+    :param tolerance: convergence criterion for cyclic components
+    :param max_iterations: maximum number of iterations per cyclic component
+    :return: an array mapping a node id to its inside weight.
     """
-    inside_prob = defaultdict(float)
+    if omega is None:
+        omega = forest.weight
+
+    if not hasattr(semiring, 'segment_sum'):
+        return _inside_loop(forest, omega, semiring)
+
+    # leaves have inside weight 1
+    inside_prob = semiring.ones(forest.n_nodes)
+
+    def update(level, values):
+        inside_prob[level.nodes] = values
+        w = semiring.times(semiring.from_log(omega[level.edges]),
+                           semiring.segment_product(inside_prob[level.tail], level.tail_starts, level.arity))
+        return semiring.segment_sum(w, level.edge_starts)
+
+    # visit levels bottom up
+    for level in forest.levels():
+        if level.cyclic:
+            inside_prob[level.nodes] = _fixed_point(lambda values: update(level, values),
+                                                    semiring.zeros(len(level.nodes)), tolerance, max_iterations)
+        else:
+            inside_prob[level.nodes] = update(level, inside_prob[level.nodes])
+
+    return inside_prob
+
+
+def _fixed_point(update, values, tolerance, max_iterations):
+    """Iterates values = update(values) until no value changes by more than the tolerance"""
+    for _ in xrange(max_iterations):
+        new = update(values)
+        with np.errstate(invalid='ignore'):
+            if np.all((new == values) | (np.abs(new - values) <= tolerance)):
+                return new
+        values = new
+    logging.warning('Fixed-point iteration did not converge after %d iterations', max_iterations)
+    return values
+
+
+def edge_inside(forest, inside_prob, omega=None, semiring=LogSemiring()):
+    """
+    The inside weight of every edge, that is, the edge's weight times the inside weight of its children.
+    :param forest: a hypergraph
+    :param inside_prob: the inside weight of each node
+    :param omega: an array of (log) edge weights (defaults to the edges' own log probabilities)
+    :param semiring: a semiring that supports segmented reductions
+    :return: an array mapping an edge id to its inside weight
+    """
+    if omega is None:
+        omega = forest.weight
+    return semiring.times(semiring.from_log(omega),
+                          semiring.segment_product(inside_prob[forest.tail], forest.tail_offsets[:-1],
+                                                   forest.arity()))
+
+
+def outside(forest, inside_prob, omega=None, semiring=LogSemiring(), tolerance=TOLERANCE,
+            max_iterations=MAX_ITERATIONS):
+    """
+    Outside recursion, vectorised level by level (top-down).
+
+    The outside weight of a node accumulates, over every edge in which it occurs as a child,
+    the outside weight of the edge's head times the edge's weight times the inside weight of its siblings.
+    Siblings are accounted for by removing the child's own inside weight from the edge's inside weight,
+    thus we only support semirings whose values live in log-domain (LogSemiring and ViterbiSemiring).
+    Nodes whose inside weight is zero do not contribute to any derivation, their outside weight is left as zero.
+    Cyclic components are solved by fixed-point iteration (see `inside`).
+
+    :param forest: a hypergraph, possibly cyclic, whose nodes are topologically sorted (see hypergraph.Hypergraph).
+    :param inside_prob: the inside weight of each node (computed in the same semiring)
+    :param omega: an array of (log) edge weights indexed by edge id (defaults to the edges' own log probabilities)
+    :param semiring: LogSemiring (default) or ViterbiSemiring
+    :param tolerance: convergence criterion for cyclic components
+    :param max_iterations: maximum number of iterations per cyclic component
+    :return: an array mapping a node id to its outside weight.
+    """
+    if omega is None:
+        omega = forest.weight
+
+    outside_prob = semiring.zeros(forest.n_nodes)
+    if not forest:
+        return outside_prob
+    outside_prob[forest.goal] = semiring.one
+
+    def messages(level, w):
+        """The outside weight of each edge's head times the edge's inside weight, once per child"""
+        message = np.repeat(semiring.times(outside_prob[forest.head[level.edges]], w), level.arity)
+        children = inside_prob[level.tail]
+        with np.errstate(invalid='ignore'):
+            message = message - children  # divide by the child's own inside weight
+        message[np.isinf(children)] = semiring.zero
+        return message
+
+    # visit levels top down
+    for level in reversed(forest.levels()):
+        w = semiring.times(semiring.from_log(omega[level.edges]),
+                           semiring.segment_product(inside_prob[level.tail], level.tail_starts, level.arity))
+        if level.cyclic:
+            # nodes in the component contribute to each other's outside weight
+            internal = np.in1d(level.tail, level.nodes)
+            positions = np.searchsorted(level.nodes, level.tail[internal])
+            external = outside_prob[level.nodes].copy()  # contributions from higher levels
+
+            def update(values):
+                outside_prob[level.nodes] = values
+                totals = external.copy()
+                semiring.accumulate(totals, positions, messages(level, w)[internal])
+                return totals
+
+            outside_prob[level.nodes] = _fixed_point(update, external, tolerance, max_iterations)
+            semiring.accumulate(outside_prob, level.tail[~internal], messages(level, w)[~internal])
+        else:
+            semiring.accumulate(outside_prob, level.tail, messages(level, w))
+
+    return outside_prob
+
+
+def posteriors(forest, omega=None):
+    """
+    Posterior marginal probabilities of nodes and edges, that is, the probability that a derivation
+    sampled from the forest contains a given node (or edge).
+    In a cyclic forest a derivation may use a node (or edge) more than once, these are then expected counts.
+    :param forest: a hypergraph, possibly cyclic, whose nodes are topologically sorted (see hypergraph.Hypergraph).
+    :param omega: an array of (log) edge weights indexed by edge id (defaults to the edges' own log probabilities)
+    :return: node posteriors (array indexed by node id) and edge posteriors (array indexed by edge id)
+    """
+    if omega is None:
+        omega = forest.weight
+    inside_prob = inside(forest, omega)
+    outside_prob = outside(forest, inside_prob, omega)
+    Z = inside_prob[forest.goal]
+    node_posterior = np.exp(inside_prob + outside_prob - Z)
+    edge_posterior = np.exp(edge_inside(forest, inside_prob, omega) + outside_prob[forest.head] - Z)
+    return node_posterior, edge_posterior
+
+
+def _inside_loop(forest, omega, semiring):
+    """Inside recursion for arbitrary semirings (one node at a time)"""
+    if not forest.is_acyclic():
+        raise ValueError('%s requires an acyclic forest' % type(semiring).__name__)
+    inside_prob = semiring.zeros(forest.n_nodes)
 
     # visit nodes bottom up
-    for parent in topsort:
+    for parent in xrange(forest.n_nodes):
 
-        incoming = forest.get(parent, frozenset())
+        incoming = forest.iterincoming(parent)
 
         # leaves have inside weight 1
         if not incoming:
-            # log(1) = 0
-            inside_prob[parent] = 0
+            inside_prob[parent] = semiring.one
         else:
-            # log(0) = -inf
-            total = -float("inf")
+            total = semiring.zero
 
             for edge in incoming:
-                w = sum((inside_prob[child] for child in edge.rhs), omega(edge))
-                # log(a) + log(b) = log(exp(a) + exp(b))
-                # total = log(exp(total) + exp(w))
-                total = np.logaddexp(total, w)
+                w = semiring.from_log(omega[edge])
+                for child in forest.children(edge):
+                    w = semiring.times(w, inside_prob[child])
+                total = semiring.plus(total, w)
 
             inside_prob[parent] = total
 
     return inside_prob
 
+
+def viterbi(forest, omega=None):
+    """
+    Viterbi (max-times) inside recursion followed by a top-down pass that recovers the best derivation.
+    :param forest: an acyclic hypergraph whose nodes are topologically sorted (see hypergraph.Hypergraph).
+    :param omega: an array of (log) edge weights indexed by edge id (defaults to the edges' own log probabilities)
+    :return: the best derivation as a list of edge ids (in pre-order) and the array of Viterbi inside weights
+    """
+    if omega is None:
+        omega = forest.weight
+
+    best = inside(forest, omega, ViterbiSemiring())
+
+    d = []
+    Q = [forest.goal]
+    while Q:
+        parent = Q.pop()
+        # the incoming edge that achieves the node's Viterbi weight
+        edge = max(forest.iterincoming(parent),
+                   key=lambda e: sum((best[child] for child in forest.children(e)), omega[e]))
+        d.append(edge)
+        # children are pushed in reverse so that the derivation comes out in pre-order (left to right)
+        Q.extend(child for child in reversed(forest.children(edge)) if not forest.is_terminal(child))
+
+    return d, best
+
+
+def kbest(forest, k, omega=None):
+    """
+    Lazy k-best extraction (Huang and Chiang, 2005, algorithm 3).
+
+    Each node keeps the list of its best derivations found so far and a heap of candidates.
+    A derivation of a node is a pair (edge, j) where j[i] is the rank of the derivation used for the i-th child.
+    Candidates are only generated as successors of a derivation already popped, that is, by incrementing one of
+    the ranks in j, thus the work is proportional to the number of derivations actually requested.
+    Requests are served with an explicit stack, thus we are not bound by Python's recursion limit.
+
+    :param forest: an acyclic hypergraph whose nodes are topologically sorted (see hypergraph.Hypergraph).
+    :param k: number of derivations
+    :param omega: an array of (log) edge weights indexed by edge id (defaults to the edges' own log probabilities)
+    :return: a list of at most k pairs (score, derivation), best first, where a derivation is a list of edge ids
+        (in pre-order)
+    """
+    if omega is None:
+        omega = forest.weight
+    if not forest:
+        return []
+    if not forest.is_acyclic():
+        raise ValueError('k-best extraction requires an acyclic forest')
+
+    best = inside(forest, omega, ViterbiSemiring()).tolist()
+    tail = forest.tail.tolist()
+    tail_offsets = forest.tail_offsets.tolist()
+    omega = omega.tolist()
+    D = {}  # node -> derivations found so far (score, edge, j) best first
+    cand = {}  # node -> heap of candidates (-score, edge, j)
+    seen = {}  # node -> candidates ever pushed (edge, j)
+    expanded = set()  # nodes whose last derivation has had its successors pushed
+
+    def children(e):
+        return tail[tail_offsets[e]:tail_offsets[e + 1]]
+
+    def initialise(v):
+        if forest.is_terminal(v):
+            D[v] = [(0.0, None, ())]
+            cand[v] = []
+            expanded.add(v)
+        else:
+            D[v] = []
+            # the best derivation through each incoming edge
+            cand[v] = [(-sum((best[c] for c in children(e)), omega[e]), e, (0,) * len(children(e)))
+                       for e in forest.iterincoming(v)]
+            heapq.heapify(cand[v])
+            seen[v] = set((e, j) for _, e, j in cand[v])
+            expanded.add(v)
+
+    def request(v, k):
+        """Finds the k-best derivations of v (or as many as there are)"""
+        stack = [(v, k)]
+        while stack:
+            v, k = stack[-1]
+            if v not in D:
+                initialise(v)
+            if len(D[v]) >= k:
+                stack.pop()
+                continue
+            if v not in expanded:
+                # the successors of the last derivation require one more derivation of one of the children
+                _, e, j = D[v][-1]
+                missing = [(c, j[i] + 2) for i, c in enumerate(children(e))
+                           if (c not in D or len(D[c]) < j[i] + 2) and not exhausted(c, j[i] + 2)]
+                if missing:
+                    stack.extend(missing)
+                    continue
+                for i, c in enumerate(children(e)):
+                    if j[i] + 1 < len(D[c]):
+                        successor = j[:i] + (j[i] + 1,) + j[i + 1:]
+                        if (e, successor) not in seen[v]:
+                            seen[v].add((e, successor))
+                            score = sum((D[tail_c][r][0] for tail_c, r in zip(children(e), successor)), omega[e])
+                            heapq.heappush(cand[v], (-score, e, successor))
+                expanded.add(v)
+            if not cand[v]:  # there are no more derivations
+                stack.pop()
+                continue
+            score, e, j = heapq.heappop(cand[v])
+            D[v].append((-score, e, j))
+            expanded.discard(v)
+
+    def exhausted(v, k):
+        """Whether we know that v has fewer than k derivations"""
+        return v in D and len(D[v]) < k and not cand[v] and v in expanded
+
+    def derivation(v, r):
+        """Top-down list of edges of the r-th best derivation of v"""
+        d = []
+        Q = [(v, r)]
+        while Q:
+            v, r = Q.pop()
+            request(v, r + 1)  # the 1-best derivations of nodes are implicit (see initialise)
+            _, e, j = D[v][r]
+            d.append(e)
+            Q.extend((c, rc) for c, rc in reversed(zip(children(e), j)) if not forest.is_terminal(c))
+        return d
+
+    request(forest.goal, k)
+    return [(D[forest.goal][r][0], derivation(forest.goal, r)) for r in xrange(len(D[forest.goal]))]
@@ -83,3 +83,6 @@ class ItemFactory(object):
 
     def __getitem__(self, uid):
         return self._items[uid]
+
+    def __len__(self):
+        return len(self._items)
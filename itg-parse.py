@@ -3,46 +3,48 @@
 """
 
 import logging
-import itertools
 import argparse
 import sys
-from rule import Rule
-from symbol import is_nonterminal, is_terminal
-from wcfg import WCFG, read_grammar_rules, count_derivations
-from wfsa import WDFSA, make_linear_fsa
+import random
+import math
+from wcfg import WCFG, read_grammar_rules
+from wfsa import make_linear_fsa
 from earley import Earley
+from itg import make_itg_forest, yield_counts, sample_yields
 
 def main(args):
-    wcfg = WCFG(read_grammar_rules(args.grammar))
-    #print 'GRAMMAR'
-    #print wcfg
+    wcfg = WCFG(read_grammar_rules(args.grammar, transform=math.log if args.log else float))
+    rng = random.Random(args.seed)
 
     for input_str in args.input:
+        if args.split_input:
+            input_str = input_str.split(' ||| ')[0]
         wfsa = make_linear_fsa(input_str)
-        #print 'FSA'
-        #print wfsa
         parser = Earley(wcfg, wfsa)
-        forest = parser.do('[S]', '[GOAL]')
+        forest = parser.forest('[S]', '[GOAL]')
         if not forest:
             print 'NO PARSE FOUND'
             continue
-        new_rules = []
-        for rule in forest:
-            if len(rule.rhs) > 1 and all(map(is_nonterminal, rule.rhs)):
-                new_rules.append(Rule(rule.lhs, reversed(rule.rhs), rule.log_prob))
-        [forest.add(rule) for rule in new_rules]
-        print '# FOREST'
-        print forest
-        print
+        forest = make_itg_forest(forest)
+        if not args.no_forest:
+            print '# FOREST'
+            print forest.to_wcfg()
+            print
 
         if args.show_permutations:
             print '# PERMUTATIONS'
-            counts = count_derivations(forest, '[GOAL]')
+            counts = yield_counts(forest)
             total = 0
-            for p, n in sorted(counts['p'].iteritems(), key=lambda (k, v): k):
+            for p, n in sorted(counts.iteritems(), key=lambda (k, v): k):
                 print 'permutation=(%s) derivations=%d' % (' '.join(str(i) for i in p), n)
                 total += n
-            print 'permutations=%d derivations=%d' % (len(counts['p'].keys()), total)
+            print 'permutations=%d derivations=%d' % (len(counts.keys()), total)
+            print
+
+        if args.samples > 0:
+            print '# SAMPLES'
+            for p, n in sample_yields(forest, args.samples, rng):
+                print 'permutation=(%s) derivations=%d' % (' '.join(str(i) for i in p), n)
             print
 
 
@@ -61,9 +63,24 @@ def argparser():
     parser.add_argument('input', nargs='?', 
             type=argparse.FileType('r'), default=sys.stdin,
             help='input corpus (one sentence per line)')
+    parser.add_argument('--log',
+            action='store_true',
+            help='applies the log transform to the probabilities of the rules')
     parser.add_argument('--show-permutations',
             action='store_true',
             help='dumps all permutations (use with caution)')
+    parser.add_argument('--samples',
+            type=int, default=0,
+            help='number of permutations sampled uniformly at random')
+    parser.add_argument('--seed',
+            type=int, default=None,
+            help='random seed (for sampling)')
+    parser.add_argument('--no-forest',
+            action='store_true',
+            help='does not print the forest')
+    parser.add_argument('--split-input',
+            action='store_true',
+            help='assumes the input is given separated by triple bars')
     parser.add_argument('--verbose', '-v',
             action='store_true',
             help='increase the verbosity level')
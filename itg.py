@@ -0,0 +1,314 @@
+"""
+Inversion transduction forests: counting and uniform sampling of derivations and of permutations.
+
+The forest of a bracketing grammar over a linear automaton is made an ITG forest by adding, for every edge whose
+tail is made of two or more nonterminal nodes, an inverted copy of the edge (see `make_itg_forest`).
+A derivation of an ITG forest yields a permutation of the input positions.
+
+Counting is done by dynamic programming over the forest (with arbitrary-precision integers), thus it is
+polynomial in the size of the forest, rather than in the number of derivations.
+Distinct permutations are counted (and sampled) through a normal form that rules out spurious ambiguity:
+the first child of an oriented edge (straight or inverted) must not be rewritten by an edge of the same orientation,
+that is, chains of blocks sharing an orientation branch to the right (Wu, 1997; Zens and Ney, 2003).
+For the bracketing grammar (a single nonterminal) every permutation has exactly one normal-form derivation,
+other grammars (e.g. with several nonterminals or unary rules) may derive a permutation in more than one normal-form
+way, in which case distinct permutations can only be found by enumerating derivations (see `is_bracketing`).
+
+:Authors: - Wilker Aziz
+"""
+
+import random
+import logging
+import numpy as np
+from collections import defaultdict
+from symbol import is_nonterminal
+from hypergraph import Hypergraph
+from rule import Rule
+
+
+NONE, STRAIGHT, INVERTED = 0, 1, 2
+
+
+def make_itg_forest(forest):
+    """
+    Returns a copy of the forest in which every edge whose tail has two or more nonterminal nodes
+    is accompanied by an inverted edge (same head and weight, reversed tail).
+    """
+    head, tail, tail_offsets, weight, rules = [], [], [0], [], []
+
+    def add(v, children, w, rule):
+        head.append(v)
+        tail.extend(children)
+        tail_offsets.append(len(tail))
+        weight.append(w)
+        rules.append(rule)
+
+    for v in xrange(forest.n_nodes):
+        inverted = []
+        for e in forest.iterincoming(v):
+            children = forest.children(e).tolist()
+            rule = forest.rule(e)
+            add(v, children, forest.weight[e], rule)
+            if len(children) > 1 and all(is_nonterminal(forest.node(c)[0]) for c in children):
+                inverted.append((children[::-1], forest.weight[e], Rule(rule.lhs, reversed(rule.rhs), rule.log_prob)))
+        for children, w, rule in inverted:  # edges remain grouped by head
+            add(v, children, w, rule)
+    return Hypergraph([forest.node(v) for v in xrange(forest.n_nodes)], head, tail, tail_offsets, weight, rules)
+
+
+def orientations(forest):
+    """
+    Returns an array mapping an edge to its orientation: STRAIGHT (or INVERTED) if its tail has two or more
+    nonterminal nodes whose spans are in increasing (or decreasing) order, NONE otherwise.
+    """
+    orientation = np.zeros(forest.n_edges, dtype=np.int64)
+    for e in xrange(forest.n_edges):
+        children = forest.children(e)
+        if len(children) < 2 or not all(is_nonterminal(forest.node(c)[0]) for c in children):
+            continue
+        starts = [forest.node(c)[1] for c in children]
+        if all(a < b for a, b in zip(starts, starts[1:])):
+            orientation[e] = STRAIGHT
+        elif all(a > b for a, b in zip(starts, starts[1:])):
+            orientation[e] = INVERTED
+    return orientation
+
+
+def is_bracketing(forest):
+    """
+    Whether the forest is that of a bracketing grammar: below a chain of unary edges from the goal
+    (e.g. [GOAL] -> [S] -> [X]), a single nonterminal rewrites either as two copies of itself or as a single terminal.
+
+    >>> from wcfg import WCFG
+    >>> from wfsa import make_linear_fsa
+    >>> from earley import Earley
+    >>> G = WCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['[X]', '[X]'], 0.0)] + [Rule('[X]', [str(i)], 0.0) for i in range(1, 4)])
+    >>> is_bracketing(make_itg_forest(Earley(G, make_linear_fsa('1 2 3')).forest('[S]', '[GOAL]')))
+    True
+    >>> G.add(Rule('[X]', ['[Z]'], 0.0))
+    >>> G.add(Rule('[Z]', ['[X]', '[X]'], 0.0))
+    >>> is_bracketing(make_itg_forest(Earley(G, make_linear_fsa('1 2 3')).forest('[S]', '[GOAL]')))
+    False
+    """
+    if not forest:
+        return True
+    top = set()
+    v = forest.goal
+    while len(forest.iterincoming(v)) == 1:
+        children = forest.children(forest.iterincoming(v)[0])
+        if len(children) != 1 or forest.is_terminal(children[0]):
+            break
+        top.add(v)
+        v = children[0]
+    label = forest.node(v)[0]
+    for e in xrange(forest.n_edges):
+        if forest.head[e] in top:
+            continue
+        children = forest.children(e)
+        if forest.node(forest.head[e])[0] != label:
+            return False
+        if len(children) == 1 and forest.is_terminal(children[0]):
+            continue
+        if len(children) != 2 or any(forest.is_terminal(c) or forest.node(c)[0] != label for c in children):
+            return False
+    return True
+
+
+class UniformSampler(object):
+    """
+    Samples derivations uniformly at random: a node is rewritten by an edge with probability proportional to
+    the number of derivations rooted at the edge.
+    In normal form, derivations stand for distinct permutations, thus permutations are sampled uniformly,
+    this requires the forest of a bracketing grammar (see `is_bracketing`).
+
+    >>> from wcfg import WCFG
+    >>> from wfsa import make_linear_fsa
+    >>> from earley import Earley
+    >>> G = WCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['[X]', '[X]'], 0.0)] + [Rule('[X]', [str(i)], 0.0) for i in range(1, 5)])
+    >>> forest = make_itg_forest(Earley(G, make_linear_fsa('1 2 3 4')).forest('[S]', '[GOAL]'))
+    >>> UniformSampler(forest).total, UniformSampler(forest, normal_form=True).total
+    (40, 22)
+    """
+
+    def __init__(self, forest, normal_form=False):
+        if not forest.is_acyclic():
+            raise ValueError('Counting requires an acyclic forest')
+        if normal_form and not is_bracketing(forest):
+            raise ValueError('The normal form only counts permutations of a bracketing grammar')
+        self._forest = forest
+        self._normal_form = normal_form
+        self._orientation = orientations(forest) if normal_form else np.zeros(forest.n_edges, dtype=np.int64)
+        self._edge_counts, self._node_counts = self._count()
+
+    @property
+    def total(self):
+        """Number of derivations (or of permutations, in normal form)"""
+        return sum(self._node_counts[self._forest.goal]) if self._forest else 0
+
+    def count(self, e):
+        """Number of derivations rooted at an edge"""
+        return self._edge_counts[e]
+
+    def _count(self):
+        """
+        Counts derivations bottom-up: for each node, the number of derivations rooted at it
+        whose top edge has a given orientation.
+        """
+        forest = self._forest
+        orientation = self._orientation.tolist()
+        edge_counts = [0] * forest.n_edges
+        node_counts = [[0, 0, 0] for _ in xrange(forest.n_nodes)]
+        for v in xrange(forest.n_nodes):  # nodes are topologically sorted
+            if forest.is_terminal(v):
+                node_counts[v][NONE] = 1
+                continue
+            for e in forest.iterincoming(v):
+                n = 1
+                for i, c in enumerate(forest.children(e)):
+                    allowed = sum(node_counts[c])
+                    if i == 0 and orientation[e] != NONE:  # the first child cannot share the edge's orientation
+                        allowed -= node_counts[c][orientation[e]]
+                    n *= allowed
+                edge_counts[e] = n
+                node_counts[v][orientation[e]] += n
+        return edge_counts, node_counts
+
+    def sample(self, rng=random):
+        """
+        Returns a derivation (as a list of edges in pre-order) drawn uniformly at random,
+        or None if the forest is empty.
+        """
+        total = self.total
+        return self.unrank(rng.randrange(total)) if total else None
+
+    def unrank(self, rank):
+        """
+        Returns the derivation of a given rank (0 <= rank < total) as a list of edges in pre-order (left to right).
+        At each node, the rank selects an edge (edges take consecutive ranges of ranks, as many as derivations
+        they root) and the remainder is decomposed in a mixed radix whose digits select the children's derivations.
+        """
+        forest = self._forest
+        orientation = self._orientation
+        node_counts = self._node_counts
+        derivation = []
+        stack = [(forest.goal, NONE, rank)]  # (node, orientation its edge cannot have, rank)
+        while stack:
+            v, forbidden, rank = stack.pop()
+            if forest.is_terminal(v):
+                continue
+            for e in forest.iterincoming(v):
+                if forbidden != NONE and orientation[e] == forbidden:
+                    continue
+                if rank < self._edge_counts[e]:
+                    break
+                rank -= self._edge_counts[e]
+            derivation.append(e)
+            frames = []
+            for i, c in enumerate(forest.children(e)):
+                constraint = orientation[e] if i == 0 else NONE
+                allowed = sum(node_counts[c]) - (node_counts[c][constraint] if constraint != NONE else 0)
+                rank, digit = divmod(rank, allowed)
+                frames.append((c, constraint, digit))
+            stack.extend(reversed(frames))
+        return derivation
+
+def _leaves(forest, derivation):
+    """Returns the terminal nodes of a derivation (given in pre-order) from left to right"""
+    leaves = []
+    edges = iter(derivation)
+    stack = [forest.head[derivation[0]]] if len(derivation) else []
+    while stack:
+        v = stack.pop()
+        if forest.is_terminal(v):
+            leaves.append(v)
+        else:  # in pre-order, the next edge is the one that rewrites this node
+            stack.extend(reversed(forest.children(next(edges)).tolist()))
+    return leaves
+
+
+def permutation(forest, derivation):
+    """
+    Returns the permutation yielded by a derivation (given in pre-order), that is,
+    the input positions (starting from 1) of the terminal nodes from left to right.
+    """
+    return tuple(forest.node(v)[1] + 1 for v in _leaves(forest, derivation))
+
+
+def yield_of(forest, derivation):
+    """Returns the terminal symbols of a derivation (given in pre-order) from left to right"""
+    return tuple(forest.node(v)[0] for v in _leaves(forest, derivation))
+
+
+def count_derivations_of(forest, perm):
+    """
+    Counts the derivations that yield a given permutation.
+    A node spanning positions [start, end) must yield a contiguous block of the permutation,
+    and the children of an edge must yield consecutive blocks, in the order of the edge's tail.
+    This takes a single bottom-up pass over the forest.
+
+    :param forest: an acyclic ITG forest over a linear automaton
+    :param perm: a sequence of input positions (starting from 1)
+    """
+    where = dict((p - 1, i) for i, p in enumerate(perm))  # input position -> position in the permutation
+    block = [None] * forest.n_nodes  # node -> (first, last) position in the permutation
+    counts = [0] * forest.n_nodes
+    for v in xrange(forest.n_nodes):
+        if forest.is_terminal(v):
+            start = forest.node(v)[1]
+            if start in where:
+                block[v] = (where[start], where[start])
+                counts[v] = 1
+            continue
+        for e in forest.iterincoming(v):
+            children = forest.children(e)
+            if any(counts[c] == 0 for c in children):
+                continue
+            if any(block[a][1] + 1 != block[b][0] for a, b in zip(children, children[1:])):
+                continue
+            n = 1
+            for c in children:
+                n *= counts[c]
+            block[v] = (block[children[0]][0], block[children[-1]][1])
+            counts[v] += n
+    return counts[forest.goal] if forest else 0
+
+
+def yield_counts(forest):
+    """
+    Returns a dict mapping each distinct yield (a tuple of terminal symbols) to the number of its derivations.
+    In the forest of a bracketing grammar we visit one derivation per permutation,
+    otherwise we have to enumerate every derivation.
+    """
+    counts = defaultdict(int)
+    if is_bracketing(forest):
+        permutations = UniformSampler(forest, normal_form=True)
+        rank = 0
+        while rank < permutations.total:  # counts may exceed the range of xrange
+            d = permutations.unrank(rank)
+            counts[yield_of(forest, d)] += count_derivations_of(forest, permutation(forest, d))
+            rank += 1
+    else:
+        logging.warning('Not a bracketing grammar: distinct permutations are found by enumerating derivations')
+        derivations = UniformSampler(forest)
+        rank = 0
+        while rank < derivations.total:
+            counts[yield_of(forest, derivations.unrank(rank))] += 1
+            rank += 1
+    return counts
+
+
+def sample_yields(forest, n, rng=random):
+    """
+    Returns `n` pairs (yield, derivations) whose permutations are drawn uniformly at random
+    (in the forest of a bracketing grammar, permutations of positions sharing a yield are drawn separately).
+    Without a bracketing grammar, distinct yields have to be enumerated first (see `yield_counts`).
+    """
+    if is_bracketing(forest):
+        permutations = UniformSampler(forest, normal_form=True)
+        samples = []
+        for _ in xrange(n):
+            d = permutations.sample(rng)
+            samples.append((yield_of(forest, d), count_derivations_of(forest, permutation(forest, d))))
+        return samples
+    population = sorted(yield_counts(forest).iteritems())
+    return [rng.choice(population) for _ in xrange(n)]
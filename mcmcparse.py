@@ -3,43 +3,27 @@
 """
 
 import argparse
+import os
 import sys
+import random
 import logging
 import math
+import numpy as np
 from reader import load_grammar
-from collections import defaultdict, Counter
+from collections import Counter
+from functools import partial
+from fractions import gcd
 from sentence import make_sentence
-from slice_variable import SliceVariable
-from sliced_earley import SlicedEarley
-from sliced_nederhof import SlicedNederhof
-from topsort import top_sort
-from inference import inside
+from slice_variable import SliceVariable, AdaptiveBeta
+from inference import inside, viterbi
 from generalisedSampling import GeneralisedSampling
 from symbol import parse_annotated_nonterminal, make_nonterminal
 import time
-import re
-from wcfg import WCFG
-from earley import Earley
-from nederhof import Nederhof
-from nltk import Tree
-
-
-def inlinetree(t):
-    s = str(t).replace('\n','')
-    return re.sub(' +', ' ', s)
-
-
-def make_nltk_tree(derivation):
-    """
-    Recursively constructs an nlt Tree from a list of rules.
-    @param top: index to the top rule (0 and -1 are the most common values)
-    """
-    d = defaultdict(None, ((r.lhs, r) for r in derivation))
-
-    def make_tree(sym):
-        r = d[sym]
-        return Tree(str(r.lhs), (str(child) if child not in d else make_tree(child) for child in r.rhs))
-    return make_tree(derivation[0].lhs)
+from wcfg import SortedRules
+from treeformat import bracketed_rules
+from diagnostics import effective_sample_size, split_rhat, top_k_change
+from checkpoint import save_checkpoint, load_checkpoint
+from report import jsonl_records, write_jsonl
 
 
 def get_conditions(d):
@@ -50,184 +34,444 @@ def get_conditions(d):
     return {parse_annotated_nonterminal(rule.lhs): rule.log_prob for rule in d}
 
 
-def permutation_length(nonterminal):
+def initialise(wcfg, wfsa, root, goal):
     """
-    :param nonterminal: a non-terminal of the form: '[P1234*2_1]
-    :return: the length of the permutations within the non-terminal
+    Finds the best derivation and returns its conditions, so that the chain starts from a derivation
+    rather than from slice variables drawn blindly (which often rule out every derivation for many iterations).
+    Intersection is bottom-up and best-first (A*, see heuristic.OutsideHeuristic), it stops as soon as the best goal
+    item is found, then a single max-times pass over the partial forest recovers the derivation.
+    This works for any grammar format, though if the rules are not log probabilities there is no admissible heuristic
+    and intersection is exhaustive.
     """
-
-    NT_PERMUTATION = re.compile(r'P([0-9]+)')
-    matches = NT_PERMUTATION.search(nonterminal)
-    if matches is not None:
-        assert matches is not None, 'bad format %s' % nonterminal
-        permutation = matches.group(1)
-        return len(permutation)
-    else:
-        return 0
-
-
-def initialise(wcfg, wfsa, root, goal, intersection):
-    """
-    Calculate a first derivation based on a simpler (thus smaller/faster) version of the grammar
-    Thereby determining the initial conditions.
-    Only applicable with the 'milos' grammar format, i.e. non-terminals have the form: '[P1234*2_1]'
-    """
-    smaller = WCFG([])
-
-    logging.debug('Creating a smaller grammar for initial conditions...')
-    for line in wcfg:
-        if 0 < permutation_length(line.lhs) <= 2:
-            smaller.add(line)
-        elif line.lhs == root or line.lhs == '[UNK]':
-            smaller.add(line)
-
-    if intersection == 'nederhof':
-        init_parser = Nederhof(smaller, wfsa)
-    elif intersection == 'earley':
-        init_parser = Earley(smaller, wfsa)
-    else:
-        raise NotImplementedError('I do not know this algorithm: %s' % intersection)
+    from nederhof import Nederhof
+    from heuristic import OutsideHeuristic
+    try:
+        heuristic = OutsideHeuristic(wcfg, root)
+    except ValueError:
+        logging.info('No admissible heuristic for this grammar, the initial derivation requires a full intersection')
+        heuristic = None
+    # the best derivation does not depend on the intersection algorithm used for sampling,
+    # and best-first Nederhof is much faster than best-first Earley
+    init_parser = Nederhof(wcfg, wfsa, heuristic=heuristic)
 
     logging.debug('Init Parsing...')
-    init_forest = init_parser.do(root, goal)
+    init_forest = init_parser.forest(root, goal)
 
     if not init_forest:
-        print 'NO PARSE FOUND'
+        logging.info('NO PARSE FOUND for the initial conditions')
         return {}
-    else:
-        logging.debug('Forest: rules=%d', len(init_forest))
 
-        logging.debug('Init Topsorting...')
-        # sort the forest
-        sorted_nodes = top_sort(init_forest)
+    logging.debug('Init Forest: nodes=%d edges=%d items=%d', init_forest.n_nodes, init_forest.n_edges,
+                  init_parser.n_items())
+    logging.debug('Init Viterbi...')
+    init_d, _ = viterbi(init_forest)
+    return get_conditions(init_forest.make_rule(e) for e in init_d)
 
-        # calculate the inside weight of the sorted forest
-        logging.debug('Init Inside...')
-        init_inside_prob = inside(init_forest, sorted_nodes)
 
-        logging.debug('Init Sampling...')
-        gen_sampling = GeneralisedSampling(init_forest, init_inside_prob)
-        init_d = gen_sampling.sample(goal)
+class SlicedParsers(object):
+    """
+    Makes the sliced parsers of a sentence, sharing what does not depend on the slice variables
+    across iterations and across chains (the rule index, or the unsliced forest in incremental mode).
+    """
 
-    return get_conditions(init_d)
+    def __init__(self, wcfg, wfsa, root='[S]', goal='[GOAL]', intersection='nederhof', incremental=False):
+        self.wcfg = wcfg
+        self.wfsa = wfsa
+        self.root = root
+        self.goal = goal
+        if incremental:
+            from sliced_incremental import IncrementalSlicedParser
+            self._incremental = IncrementalSlicedParser(wcfg, wfsa, None, intersection)
+            self._incremental.intersect(root, goal)  # before chains are forked, thus they share the unsliced forest
+        else:
+            self._incremental = None
+            # intersection modules are only loaded when they are used
+            if intersection == 'nederhof':
+                from sliced_nederhof import SlicedNederhof
+                self._parser_type = SlicedNederhof
+            elif intersection == 'earley':
+                from sliced_earley import SlicedEarley
+                self._parser_type = SlicedEarley
+            else:
+                raise NotImplementedError('I do not know this algorithm: %s' % intersection)
+            self._rules = SortedRules(wcfg)  # the sliced parsers share this index
 
+    def get(self, slice_vars):
+        """Returns a parser for the given slice variables"""
+        if self._incremental is not None:
+            self._incremental.slice_vars = slice_vars
+            return self._incremental
+        return self._parser_type(self.wcfg, self.wfsa, slice_vars, self._rules)
 
-def sliced_sampling(wcfg, wfsa, root='[S]', goal='[GOAL]', n_samples=100, n_burn=100, max_iterations=1000, a=[0.1, 0.1],
-                    b=[1.0, 1.0], intersection='nederhof', grammarfmt='milos'):
+
+class Chain(object):
     """
-    Sample N derivations in maximum K iterations with Slice Sampling
+    A Markov chain of derivations (slice sampling).
+    A chain owns its whole state, thus chains are independent of one another and may run in separate processes:
+        * the slice variables, conditioned on the last derivation of the chain, and the parameters of the Beta
+        * its random states: numpy's for the slice variables, python's for sampling from sliced forests
+          (both derive from the pair (seed, chain id))
+        * how many derivations it still has to burn, and the counts of the derivations it kept
+    With an `adaptive` controller (see slice_variable.AdaptiveBeta), the first parameter of the Beta in use is tuned
+    during burn-in (before the first derivation, and until `n_burn` derivations have been burnt),
+    then it is frozen, since adapting it any longer would not leave the distribution of derivations invariant.
+    With `trace`, the chain also records the score of every derivation it keeps (see run_until_converged),
+    otherwise its size does not grow with the number of samples (chains are pickled by workers and checkpoints).
     """
-    
-    if intersection == 'nederhof':
-        logging.info('Using Nederhof parser')
-        parser_type = SlicedNederhof
-    elif intersection == 'earley':
-        parser_type = SlicedEarley
-        logging.info('Using Earley parser')
-    else:
-        raise NotImplementedError('I do not know this algorithm: %s' % intersection)
-    
-    samples = []
-
-    # the initial conditions function is only implemented for the 'milos' grammarformat,
-    # this could be extended to other grammar formats as well.
-    if grammarfmt == 'milos':
-        logging.debug('Calculating initial conditions...')
-        # calculate the initial conditions (first derivation (i.e. seed))
-        initial_conditions = initialise(wcfg, wfsa, root, goal, intersection)
-
-        # begin with sampling with respect to the initial conditions
-        slice_vars = SliceVariable(a=a[1], b=b[1], conditions=initial_conditions)
-    else:
-        slice_vars = SliceVariable(a=a[0], b=b[0])
 
-    it = 0
-    while len(samples) < n_samples and it < max_iterations:
-        it += 1
-        if it % 10 == 0:
-            logging.info('it=%d samples=%d', it, len(samples))
-        
-        d = sliced_sample(root, goal, parser_type(wcfg, wfsa, slice_vars))
+    def __init__(self, cid, conditions={}, a=[0.1, 0.1], b=[1.0, 1.0], n_burn=0, seed=0, adaptive=None, trace=False):
+        self.cid = cid
+        self.a = list(a)
+        self.b = list(b)
+        rng = np.random.RandomState([seed, cid])
+        self.random = random.Random(rng.randint(2 ** 31))
+        # the first pair of parameters is used until the chain finds a derivation
+        first = 1 if conditions else 0
+        self.slice_vars = SliceVariable(a=a[first], b=b[first], conditions=conditions, rng=rng)
+        self.n_burn = n_burn
+        self.adaptive = adaptive
+        self.counts = Counter()  # derivation (a tuple of rules) -> how many times it was sampled (after burn-in)
+        self.trace = [] if trace else None  # scores of the derivations kept (in order), for convergence diagnostics
+        self.iterations = 0
+        self.wasted = Counter()  # iterations that did not produce a derivation: 'aborted' (early) or 'empty' (after intersection)
+        self.wasted_time = 0.0
+        self.timers = Counter()  # seconds spent in 'intersection' and in 'sampling' (from sliced forests)
+
+    @property
+    def n_samples(self):
+        """Number of derivations kept so far"""
+        return sum(self.counts.itervalues())
+
+    @property
+    def acceptance(self):
+        """Rate of iterations that produced a derivation (i.e. a non-empty sliced forest)"""
+        if not self.iterations:
+            return 0.0
+        return float(self.iterations - sum(self.wasted.itervalues())) / self.iterations
+
+    def step(self, parsers):
+        """Runs one iteration with a parser made by `parsers` (see SlicedParsers)"""
+        self.iterations += 1
+        started = time.time()
+        parser = parsers.get(self.slice_vars)
+        forest = parser.forest(parsers.root, parsers.goal)
+        parsed = time.time()
+        d = sample_sliced_forest(forest, self.slice_vars, self.random)
+        self.timers['intersection'] += parsed - started
+        self.timers['sampling'] += time.time() - parsed
+        phase = 1 if self.slice_vars.conditions else 0  # which pair of parameters is in use
+        if self.adaptive is not None:
+            self._adapt(phase, forest.n_edges, time.time() - started)
 
         if d is not None:
-            if n_burn > 0:  # in case we are burning derivations, we do not add them to the list
-                n_burn -= 1  # but we still use them to update the slice variables
+            if self.n_burn > 0:  # in case we are burning derivations, we do not count them
+                self.n_burn -= 1  # but we still use them to update the slice variables
+                if self.n_burn == 0 and self.adaptive is not None:
+                    logging.info('chain=%d burn-in over, frozen parameters a=%s b=%s', self.cid, self.a, self.b)
             else:
-                samples.append(d)
+                self.counts[tuple(d)] += 1
+                if self.trace is not None:
+                    self.trace.append(sum(r.log_prob for r in d))
 
             # because we have a derivation
             # we reset the assignments of the slice variables
             # we fix new conditions
             # and we move on to the second pair of parameters of the beta
-            conditions = get_conditions(d)
-            slice_vars.reset(conditions, a[1], b[1])
+            self.slice_vars.reset(get_conditions(d), self.a[1], self.b[1])
         else:
+            self.wasted['aborted' if parser.aborted else 'empty'] += 1
+            self.wasted_time += time.time() - started
             # because we do not have a derivation
             # but we are indeed finishing one iteration
             # we reset the assignments of the slice variables
             # however we leave the conditions unchanged
-            # similarly, we do not change the parameters of the beta
-            slice_vars.reset()
+            # similarly, we do not change the parameters of the beta (unless they are being adapted)
+            self.slice_vars.reset(a=self.a[phase], b=self.b[phase])
+        return d
+
+    def _adapt(self, phase, edges, duration):
+        """Tunes the parameter `a` in use, as long as the chain is burning derivations (or has none yet)"""
+        if self.n_burn == 0 and phase == 1:  # frozen
+            return
+        self.a[phase] = self.adaptive.update(self.a[phase], edges=edges, duration=duration)
+        logging.debug('chain=%d it=%d edges=%d time=%.4f a=%s', self.cid, self.iterations, edges, duration, self.a)
+
+    def run(self, parsers, n_samples, max_iterations):
+        """Runs until the chain has kept `n_samples` derivations or has run for `max_iterations` iterations"""
+        while self.n_samples < n_samples and self.iterations < max_iterations:
+            self.step(parsers)
+            if self.iterations % 10 == 0:
+                logging.info('chain=%d it=%d samples=%d a=%s b=%s', self.cid, self.iterations, self.n_samples,
+                             self.a, self.b)
+        return self
 
-    counts = Counter(tuple(d) for d in samples)
-    for d, n in counts.most_common():
-        score = sum(r.log_prob for r in d)
-        print '# n=%s estimate=%s score=%s' % (n, float(n)/len(samples), score)
-        tree = make_nltk_tree(d)
-        inline_tree = inlinetree(tree)
-        print inline_tree, "\n"
 
+# the parsers used by forked chains (see run_chains)
+_PARSERS = None
 
-def edge_uniform_weight(edge, goal, slicevars):
+
+def _run_chain((chain, n_samples, max_iterations)):
+    """Runs a chain in a worker process and sends it back"""
+    return chain.run(_PARSERS, n_samples, max_iterations)
+
+
+def run_chains(parsers, jobs):
     """
-    Return a uniform view of the edge's log-probability.
-    :param edge: an edge
-    :param goal: the goal node (gets a special treatment because there are no slice variables for it)
-    :param slicevars: a SliceVariable object
-    :returns: 1/beta.pdf(u_s; a, b)
+    Runs chains, one process per chain if there are several of them.
+    The parsers are made before the workers are forked, workers find them in a global variable.
+
+    :param parsers: a SlicedParsers object
+    :param jobs: a list of triplets (chain, number of samples, maximum number of iterations)
+    :returns: the chains in their final states
     """
-    if edge.lhs == goal:
-        # rules rooted by the goal symbol have probability 1 (or 0 in log-domain) and there is no slice variable for the goal symbol
-        return 0.0
+    global _PARSERS
+    if len(jobs) == 1:
+        chain, n_samples, max_iterations = jobs[0]
+        return [chain.run(parsers, n_samples, max_iterations)]
+    from multiprocessing import Pool  # only needed (and loaded) when running several chains
+    _PARSERS = parsers
+    pool = Pool(len(jobs))
+    try:
+        return pool.map(_run_chain, jobs)
+    finally:
+        pool.close()
+        pool.join()
+        _PARSERS = None
+
+
+class Periodic(object):
+    """
+    Calls functions periodically between rounds of iterations (e.g. to save checkpoints or report estimates).
+    A function with period N is called with the chains and the counts of the last convergence check
+    after the first round that takes the chains past a multiple of N iterations.
+    Rounds of `period` iterations (the gcd of the periods) hit every multiple exactly.
+
+    >>> from collections import namedtuple
+    >>> Progress = namedtuple('Progress', 'iterations')
+    >>> calls = []
+    >>> periodic = Periodic([(20, lambda chains, previous: calls.append(chains[0].iterations)), (30, None)])
+    >>> periodic.period
+    20
+    >>> for done in [15, 30, 45, 60]:  # rounds of 15 iterations
+    ...     periodic([Progress(done)], None)
+    >>> calls
+    [30, 45, 60]
+    """
+
+    def __init__(self, tasks, done=0):
+        """
+        :param tasks: pairs (period, function), those whose function is None or whose period is 0 are ignored
+        :param done: number of iterations done so far (when resuming)
+        """
+        self.tasks = [(every, function) for every, function in tasks if function is not None and every > 0]
+        self.period = reduce(gcd, [every for every, _ in self.tasks]) if self.tasks else None
+        self._done = done
+
+    def __call__(self, chains, previous):
+        done = max(chain.iterations for chain in chains)
+        for every, function in self.tasks:
+            if done // every > self._done // every:
+                function(chains, previous)
+        self._done = done
+
+
+def run_in_rounds(parsers, chains, targets, max_iterations, every, on_round=None):
+    """
+    Runs chains until each one has kept its target number of derivations or has run for `max_iterations` iterations.
+    Chains run in rounds of (at most) `every` iterations and `on_round(chains, Counter())` is called between rounds
+    (e.g. to save a checkpoint), since a chain carries its whole state, the result does not depend on `every`.
+
+    :returns: the chains in their final states
+    """
+    while True:
+        chains = run_chains(parsers, [(chain, n, min(chain.iterations + every, max_iterations))
+                                      for chain, n in zip(chains, targets)])
+        if all(chain.n_samples >= n or chain.iterations >= max_iterations for chain, n in zip(chains, targets)):
+            return chains
+        if on_round is not None:
+            on_round(chains, Counter())
+
+
+def merge_counts(chains):
+    """Merges the derivation counts of several chains"""
+    counts = Counter()
+    for chain in chains:
+        counts.update(chain.counts)
+    return counts
+
+
+def run_until_converged(parsers, chains, max_iterations, every=50, min_ess=None, max_rhat=1.1, tolerance=None, k=10,
+                        previous=None, on_round=None):
+    """
+    Runs chains in rounds of `every` iterations (a chain runs for at most `max_iterations` iterations) until
+        * the effective sample size of the scores of the derivations (summed over chains) reaches `min_ess`,
+          provided split R-hat (over all chains) is below `max_rhat`;
+        * or the estimated probabilities of the k most frequent derivations change by less than `tolerance`
+          in one round.
+    See diagnostics.
+    `previous` are the counts of the last check (when resuming),
+    `on_round(chains, counts)` is called after every round that does not stop the chains (e.g. to save a checkpoint).
+
+    :returns: the chains in their final states
+    """
+    if previous is None:
+        previous = Counter()
+    for chain in chains:
+        if chain.trace is None:  # e.g. resumed from a run without a stopping rule
+            chain.trace = []
+    while True:
+        chains = run_chains(parsers, [(chain, float('inf'), min(chain.iterations + every, max_iterations))
+                                      for chain in chains])
+        counts = merge_counts(chains)
+        traces = [chain.trace for chain in chains]
+        ess = sum(effective_sample_size(trace) for trace in traces)
+        rhat = split_rhat(traces)
+        change = top_k_change(previous, counts, k)
+        logging.info('Round: iterations=%d samples=%d ess=%.1f rhat=%.3f change=%.4f',
+                     sum(chain.iterations for chain in chains), sum(counts.itervalues()), ess, rhat, change)
+        if min_ess is not None and ess >= min_ess and rhat <= max_rhat:
+            logging.info('Converged: the effective sample size reached %s', min_ess)
+            break
+        if tolerance is not None and change < tolerance:
+            logging.info('Converged: the estimates changed by less than %s', tolerance)
+            break
+        if all(chain.iterations >= max_iterations for chain in chains):
+            logging.info('Not converged after %d iterations per chain', max_iterations)
+            break
+        previous = counts
+        if on_round is not None:
+            on_round(chains, counts)
+    return chains
+
+
+def sliced_sampling(wcfg, wfsa, root='[S]', goal='[GOAL]', n_samples=100, n_burn=100, max_iterations=1000, a=[0.1, 0.1],
+                    b=[1.0, 1.0], intersection='nederhof', init='viterbi', incremental=False, n_chains=1, seed=None,
+                    min_ess=None, max_rhat=1.1, tolerance=None, top_k=10, check_every=50, adaptive=None,
+                    state=None, checkpoint=None, checkpoint_every=100, jsonl=False, sid=1, report_every=0):
+    """
+    Sample N derivations in maximum K iterations with Slice Sampling.
+    With init='viterbi', the chain starts from the best derivation (see `initialise`) and with the second pair of
+    parameters of the Beta, otherwise (init='none') it starts from slice variables drawn with the first pair.
+    With `incremental`, the unsliced forest is computed once and sliced at every iteration
+    (see sliced_incremental), instead of redoing the sliced intersection from scratch.
+    With several chains, samples are split amongst independent chains (each with its own burn-in and at most K
+    iterations) which run in parallel, their counts are then merged.
+    For a fixed seed, the result does not depend on how chains are scheduled.
+    With a stopping rule (`min_ess` and/or `tolerance`), the number of samples is not fixed, instead chains run
+    until they converge (see `run_until_converged`) or run out of iterations.
+    With an `adaptive` controller (see slice_variable.AdaptiveBeta), chains tune `a` during burn-in (see Chain).
+    With a `checkpoint` function, chains run in rounds and every `checkpoint_every` iterations (see Periodic)
+    the function is called with the chains and the counts of the last convergence check,
+    a run then resumes from this `state` (a dict with keys 'chains' and 'previous').
+    With `jsonl`, the estimates are written as JSON lines (see report) for sentence `sid`,
+    and with `report_every` a snapshot is also written every as many iterations.
+    """
+    if intersection == 'nederhof':
+        logging.info('Using Nederhof parser')
+    elif intersection == 'earley':
+        logging.info('Using Earley parser')
+
+    if state is not None:
+        # chains carry everything else: conditions, parameters of the Beta, random states and counts
+        chains, previous = state['chains'], state['previous']
+        logging.info('Resuming %d chains after %s iterations', len(chains), [chain.iterations for chain in chains])
+    else:
+        initial_conditions = {}
+        if init == 'viterbi':
+            logging.debug('Calculating initial conditions...')
+            start = time.time()
+            initial_conditions = initialise(wcfg, wfsa, root, goal)
+            logging.info('Initial conditions: %ss', time.time() - start)
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        converging = min_ess is not None or tolerance is not None
+        chains = [Chain(cid, initial_conditions, a, b, n_burn, seed, adaptive, converging) for cid in range(n_chains)]
+        previous = Counter()
+
+    def rows(counts):
+        for d, n in counts.most_common():
+            yield bracketed_rules(d), n, {'score': sum(r.log_prob for r in d)}
+
+    def report(chains, previous):
+        counts = merge_counts(chains)
+        write_jsonl(jsonl_records(sid, rows(counts), sum(counts.itervalues()), final=False))
+
+    periodic = Periodic([(report_every, report if jsonl else None), (checkpoint_every, checkpoint)],
+                        max(chain.iterations for chain in chains))
+    on_round = periodic if periodic.tasks else None
+
+    parsers = SlicedParsers(wcfg, wfsa, root, goal, intersection, incremental)
+    if min_ess is None and tolerance is None:
+        targets = [n_samples // len(chains) + (cid < n_samples % len(chains)) for cid in range(len(chains))]
+        chains = run_in_rounds(parsers, chains, targets, max_iterations, periodic.period or max_iterations, on_round)
     else:
-        sym, start, end = parse_annotated_nonterminal(edge.lhs)
-        return slicevars.weight(sym, start, end, edge.log_prob)
+        chains = run_until_converged(parsers, chains, max_iterations,
+                                     check_every, min_ess, max_rhat, tolerance, top_k, previous, on_round)
+
+    for chain in chains:
+        logging.info('Chain %d: iterations=%d samples=%d acceptance=%.4f aborted=%d empty=%d (%.2fs wasted) a=%s b=%s '
+                     'intersection=%.2fs sampling=%.2fs',
+                     chain.cid, chain.iterations, chain.n_samples, chain.acceptance,
+                     chain.wasted['aborted'], chain.wasted['empty'], chain.wasted_time, chain.a, chain.b,
+                     chain.timers['intersection'], chain.timers['sampling'])
+    counts = merge_counts(chains)
+
+    total = sum(counts.itervalues())
+    if jsonl:
+        write_jsonl(jsonl_records(sid, rows(counts), total))
+    else:
+        for tree, n, fields in rows(counts):
+            print '# n=%s estimate=%s score=%s' % (n, float(n)/total, fields['score'])
+            print tree, "\n"
 
 
-def sliced_sample(root, goal, parser):
+def sliced_sample(root, goal, parser, rng=random):
     """
     Sample a derivation given a wcfg and a wfsa, with Slice Sampling, a
     form of MCMC-sampling
+    :param rng: a python random state used to sample from the sliced forest (by default the global one)
     """
 
     logging.debug('Parsing...')
-    forest = parser.do(root, goal)
+    forest = parser.forest(root, goal)
+    logging.debug('Items: %d', parser.n_items())
+    return sample_sliced_forest(forest, parser.slice_vars, rng)
+
+
+def sample_sliced_forest(forest, slice_vars, rng=random):
+    """
+    Sample a derivation from a sliced forest (or return None if the forest is empty).
+    :param rng: a python random state (by default the global one)
+    """
 
     if not forest:
         logging.debug('NO PARSE FOUND')
         return None
 
     else:
-        logging.debug('Forest: rules=%d', len(forest))
-        logging.debug('Topsorting...')
+        logging.debug('Forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
 
-        # sort the forest
-        sorted_nodes = top_sort(forest)
-
-        # calculate the inside weight of the sorted forest
+        # calculate the inside weight of the forest (whose nodes are already sorted)
         logging.debug('Inside...')
         # here we compute inside weights, however with a new uniform weight function over edges
-        inside_prob = inside(forest, sorted_nodes, omega=lambda edge: edge_uniform_weight(edge, goal, parser.slice_vars))
+        omega = slice_vars.weights(forest)
+        inside_prob = inside(forest, omega=omega)
 
         logging.debug('Sampling...')
         # retrieve a random derivation, with respect to the inside weight distribution
         # again, we sample with respect to a uniform function over edges
-        gen_sampling = GeneralisedSampling(forest, inside_prob, omega=lambda edge: edge_uniform_weight(edge, goal, parser.slice_vars))
-        d = gen_sampling.sample(goal)
+        gen_sampling = GeneralisedSampling(forest, inside_prob, omega=omega)
+        d = [forest.make_rule(e) for e in gen_sampling.sample(rng=rng)]
 
         return d
 
 
+def save_sentence(path, jid, input_str, chains, previous):
+    """Saves a checkpoint of the chains of a sentence (`jid` counts from 1)"""
+    save_checkpoint(path, {'sentence': jid, 'input': input_str, 'chains': chains, 'previous': previous})
+    logging.info('Checkpoint: sentence=%d iterations=%s', jid, [chain.iterations for chain in chains])
+
+
 def main(args):
     if args.profile:
         import cProfile
@@ -254,12 +498,35 @@ def core(args):
 
     logging.info(' %d rules', len(wcfg))
 
-    jobs = [input_str.strip() for input_str in args.input]
+    resumed = {'sentence': 1}  # the sentence to resume from (possibly along with the state of its chains)
+    if args.resume:
+        if os.path.exists(args.checkpoint):
+            resumed = load_checkpoint(args.checkpoint)
+            logging.info('Resuming from sentence %d (%s)', resumed['sentence'], args.checkpoint)
+        else:
+            logging.warning('Checkpoint not found, starting from scratch: %s', args.checkpoint)
+
+    adaptive = None
+    if args.adapt_edges is not None or args.adapt_time is not None:
+        adaptive = AdaptiveBeta(args.adapt_edges, args.adapt_time, args.adapt_rate)
 
-    for jid, input_str in enumerate(jobs, 1):
+    # the input is streamed: a sentence is parsed as soon as its line is read
+    for jid, input_str in enumerate(iter(args.input.readline, ''), 1):
+        input_str = input_str.strip()
         sentence, extra_rules = make_sentence(input_str, wcfg.terminals, args.unkmodel, args.default_symbol, split_bars=args.split_input)
-        logging.info('[%d/%d] Parsing %d words: %s', jid, len(jobs), len(sentence), ' '.join(sentence.words))
-        wcfg.update(extra_rules)
+        logging.info('[%d] Parsing %d words: %s', jid, len(sentence), ' '.join(sentence.words))
+        wcfg.update(extra_rules)  # unknown words still extend the grammar when sentences are skipped
+        if jid < resumed['sentence']:
+            continue
+        state = None
+        if jid == resumed['sentence'] and resumed.get('chains'):
+            if resumed['input'] != input_str:
+                raise ValueError('The checkpoint does not match sentence %d: %s' % (jid, resumed['input']))
+            state = resumed
+
+        save = None
+        if args.checkpoint:
+            save = partial(save_sentence, args.checkpoint, jid, input_str)
 
         start = time.time()
 
@@ -269,7 +536,25 @@ def core(args):
                         args.samples, args.burn, args.max,
                         args.a, args.b,
                         args.intersection,
-                        args.grammarfmt)
+                        args.init,
+                        args.incremental,
+                        args.chains,
+                        args.seed,
+                        args.min_ess,
+                        args.max_rhat,
+                        args.tolerance,
+                        args.top_k,
+                        args.check_every,
+                        adaptive,
+                        state,
+                        save,
+                        args.checkpoint_every,
+                        args.jsonl,
+                        jid,
+                        args.report_every)
+        if args.checkpoint:  # the samples are out, the next run may skip this sentence
+            sys.stdout.flush()
+            save_checkpoint(args.checkpoint, {'sentence': jid + 1})
 
         end = time.time()
         logging.info("Duration %ss", end - start)
@@ -294,6 +579,12 @@ def argparser():
     parser.add_argument('--intersection',
             type=str, default='nederhof', choices=['nederhof', 'earley'],
             help="intersection algorithm (nederhof: bottom-up; earley: top-down)")
+    parser.add_argument('--incremental',
+            action='store_true',
+            help='intersects once and slices the forest at every iteration (rather than intersecting at every iteration)')
+    parser.add_argument('--init',
+            type=str, default='viterbi', choices=['viterbi', 'none'],
+            help="initial derivation of the chain (viterbi: best derivation found by A*; none: start from the Beta)")
     parser.add_argument('--log',
             action='store_true',
             help='applies the log transform to the probabilities of the rules')
@@ -312,12 +603,63 @@ def argparser():
     parser.add_argument('--max',
                         type=int, default=1000,
                         help='The maximum number of iterations')
+    parser.add_argument('--chains',
+                        type=int, default=1,
+                        help='The number of independent chains (run in parallel, samples are split amongst them)')
+    parser.add_argument('--seed',
+                        type=int, default=None,
+                        help='Random seed (chain k has its own random states derived from the pair (seed, k))')
+    parser.add_argument('--min-ess',
+                        type=float, default=None,
+                        help='Stops once the effective sample size (summed over chains) reaches this value '
+                             '(and split R-hat is below --max-rhat), --samples is then ignored')
+    parser.add_argument('--max-rhat',
+                        type=float, default=1.1,
+                        help='Largest split R-hat compatible with convergence (see --min-ess)')
+    parser.add_argument('--tolerance',
+                        type=float, default=None,
+                        help='Stops once the estimates of the --top-k derivations change by less than this value '
+                             'in a round of --check-every iterations, --samples is then ignored')
+    parser.add_argument('--top-k',
+                        type=int, default=10,
+                        help='Number of derivations whose estimates are monitored (see --tolerance)')
+    parser.add_argument('--check-every',
+                        type=int, default=50,
+                        help='Number of iterations (per chain) between convergence checks')
     parser.add_argument('-a',
                         type=float, nargs=2, default=[0.1, 0.3], metavar='BEFORE AFTER',
                         help='a, first Beta parameter before and after finding the first derivation')
     parser.add_argument('-b',
                         type=float, nargs=2, default=[1.0, 1.0], metavar='BEFORE AFTER',
                         help='b, second Beta parameter before and after finding the first derivation')
+    budget = parser.add_mutually_exclusive_group()
+    budget.add_argument('--adapt-edges',
+                        type=int, default=None, metavar='N',
+                        help='tune a (during burn-in) so that sliced forests have about N edges')
+    budget.add_argument('--adapt-time',
+                        type=float, default=None, metavar='SECONDS',
+                        help='tune a (during burn-in) so that an iteration takes about SECONDS')
+    parser.add_argument('--adapt-rate',
+                        type=float, default=0.1,
+                        help='step size of the adaptation of a (in log-domain)')
+    parser.add_argument('--jsonl',
+                        action='store_true',
+                        help='writes samples as JSON lines (sentence, tree, count, estimate, score), '
+                             'one per distinct derivation')
+    parser.add_argument('--report-every',
+                        type=int, default=0, metavar='N',
+                        help='with --jsonl, also writes a snapshot of the estimates every N iterations (per chain), '
+                             'records are marked "final": false')
+    parser.add_argument('--checkpoint',
+                        type=str, default=None, metavar='PATH',
+                        help='periodically save the state of the run to PATH (see --resume)')
+    parser.add_argument('--checkpoint-every',
+                        type=int, default=100, metavar='N',
+                        help='iterations (per chain) between checkpoints '
+                             '(with a stopping rule, at the first convergence check past every N iterations)')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='continue the run saved in --checkpoint (sentences already done are skipped)')
     parser.add_argument('--unkmodel',
             type=str, default=None,
             choices=['passthrough', 'stfdbase', 'stfd4', 'stfd6'],
@@ -337,4 +679,8 @@ def argparser():
     return parser
 
 if __name__ == '__main__':
-    main(argparser().parse_args())
+    parser = argparser()
+    args = parser.parse_args()
+    if args.resume and not args.checkpoint:
+        parser.error('--resume requires --checkpoint')
+    main(args)
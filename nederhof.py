@@ -17,7 +17,8 @@ This is an implementation of the bottom-up intersection by Nederhof and Satta (2
 
 from collections import defaultdict, deque
 from itertools import ifilter
-from agenda import Agenda, ActiveQueue, get_cfg
+from functools import partial
+from agenda import Agenda, ActiveQueue, PriorityQueue, GeneratingBitsets, get_forest
 from item import ItemFactory
 from symbol import is_terminal, make_symbol, is_nonterminal
 from rule import Rule
@@ -30,19 +31,42 @@ class Nederhof(object):
     This is an implementation of the CKY-inspired intersection due to Nederhof and Satta (2008).
     """
 
-    def __init__(self, wcfg, wfsa):
+    def __init__(self, wcfg, wfsa, generating_type=GeneratingBitsets, heuristic=None):
+        """
+        :param heuristic: an admissible outside estimate (see heuristic.OutsideHeuristic),
+            if given, active items are processed best-first (A*) and intersection stops as soon as
+            the best goal item is found
+        """
         self._wcfg = wcfg
         self._wfsa = wfsa
-        self._agenda = Agenda(active_container_type=ActiveQueue)
         self._firstsym = defaultdict(set)  # index rules by their first RHS symbol
         self._item_factory = ItemFactory()
+        self._heuristic = heuristic
+        if heuristic is None:
+            self._agenda = Agenda(active_container_type=ActiveQueue, generating_type=generating_type)
+        else:
+            self._agenda = Agenda(active_container_type=partial(PriorityQueue, priority=self.priority),
+                                  generating_type=generating_type)
+            self._inside = {}  # item -> Viterbi inside weight
+            self._best = {}  # (sym, start, end) -> Viterbi inside weight
 
     def get_item(self, rule, dot, inner=[]):
         return self._item_factory.get_item(rule, dot, inner)
     
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
-        return self.get_item(item.rule, dot, item.inner + (item.dot,))
+        new = self.get_item(item.rule, dot, item.inner + (item.dot,))
+        if self._heuristic is not None and new not in self._inside:
+            self._inside[new] = self._inside[item] + self._best.get((item.next, item.dot, dot), 0.0)
+        return new
+
+    def priority(self, item):
+        """The Viterbi inside weight of an item plus an estimate of its outside weight"""
+        return self._inside[item] + self._heuristic(item.rule, len(item.inner))
+
+    def n_items(self):
+        """Number of items created so far"""
+        return len(self._item_factory)
         
     def add_symbol(self, sym, sfrom, sto):
         """
@@ -62,7 +86,10 @@ class Nederhof(object):
         # you may interpret this as a delayed axiom
         # every compatible rule in the grammar
         for r in self._firstsym.get(sym, set()):  
-            self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
+            item = self.get_item(r, sto, inner=(sfrom,))  # can be interpreted as a lazy axiom
+            if self._heuristic is not None and item not in self._inside:
+                self._inside[item] = r.log_prob + self._best.get((sym, sfrom, sto), 0.0)
+            self._agenda.add(item)
 
         return True
 
@@ -77,23 +104,36 @@ class Nederhof(object):
         for sfrom, sto, sym, w in self._wfsa.iterarcs():
             self.add_symbol(sym, sfrom, sto)  
 
-    def inference(self):
-        """Exhausts the queue of active items"""
+    def inference(self, root=None):
+        """
+        Exhausts the queue of active items.
+        In best-first mode, it stops as soon as a complete item for `root` spans from an initial to a final state.
+        """
         agenda = self._agenda
         while agenda:
             item = agenda.pop()  # always returns an ACTIVE item
             # complete other items (by calling add_symbol), in case the input item is complete
             if item.is_complete():
+                if self._heuristic is not None:
+                    # the first complete item to leave the queue is the best one for its annotated LHS
+                    self._best.setdefault((item.rule.lhs, item.start, item.dot), self._inside[item])
                 self.add_symbol(item.rule.lhs, item.start, item.dot)  # prove the symbol
                 agenda.make_complete(item)  # mark the item as complete
+                if self._heuristic is not None and item.rule.lhs == root \
+                        and self._wfsa.is_initial(item.start) and self._wfsa.is_final(item.dot):
+                    break  # this is the best goal item
             else:
                 # merges the input item with previously completed items effectively moving the input item's dot forward
                 agenda.make_passive(item)
                 for sto in agenda.itercompletions(item.next, item.dot):
                     agenda.add(self.advance(item, sto))  # move the dot forward
 
+    def forest(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected forest as a compact hypergraph"""
+        self.axioms()
+        self.inference(root)
+        return get_forest(goal, root, self._wfsa, self._agenda)
+
     def do(self, root='[S]', goal='[GOAL]'):
         """Runs the program and returns the intersected CFG"""
-        self.axioms()
-        self.inference()
-        return get_cfg(goal, root, self._wfsa, self._agenda)
+        return self.forest(root, goal).to_wcfg()
@@ -2,98 +2,197 @@
 :Authors: - Iason
 """
 
-import re
 import time
 import argparse
 import logging
 import sys
 import math
 from reader import load_grammar
-from collections import Counter, defaultdict
 from symbol import make_nonterminal
-from earley import Earley
-from nederhof import Nederhof
-from topsort import top_sort
 from sentence import make_sentence
-from inference import inside
-from generalisedSampling import GeneralisedSampling
-from nltk import Tree
+from inference import inside, viterbi, posteriors, kbest
+from semiring import CountingSemiring
+from treeformat import bracketed_tree
+from report import jsonl_records, write_jsonl
 
 
-def inlinetree(t):
-    s = str(t).replace('\n','')
-    return re.sub(' +', ' ', s)
+def make_parser(wcfg, wfsa, intersection='nederhof', heuristic=None):
+    # intersection modules are only loaded when they are used
+    if intersection == 'nederhof':
+        from nederhof import Nederhof
+        parser = Nederhof(wcfg, wfsa, heuristic=heuristic)
+        logging.info('Using Nederhof parser')
+    elif intersection == 'earley':
+        from earley import Earley
+        parser = Earley(wcfg, wfsa, heuristic=heuristic)
+        logging.info('Using Earley parser')
+    else:
+        raise NotImplementedError('I do not know this algorithm: %s' % intersection)
+    return parser
 
 
-def make_nltk_tree(derivation):
+def count_derivations(forest):
+    """Counts the derivations in the forest with a single pass of the counting semiring"""
+    return inside(forest, semiring=CountingSemiring())[forest.goal]
+
+
+def viterbi_decode(wcfg, wfsa, root='[S]', goal='[GOAL]', intersection='nederhof', count=False, heuristic=None):
     """
-    Recursively constructs an nlt Tree from a list of rules.
-    @param top: index to the top rule (0 and -1 are the most common values)
+    Find the best derivation given a wcfg and a wfsa, with a single max-times inside pass.
+    With an admissible heuristic, intersection is best-first (A*) and stops as soon as the best goal item is found,
+    the forest is then partial, thus we can neither normalise the Viterbi score nor count derivations.
     """
-    d = defaultdict(None, ((r.lhs, r) for r in derivation))
 
-    def make_tree(sym):
-        r = d[sym]
-        return Tree(str(r.lhs), (str(child) if child not in d else make_tree(child) for child in r.rhs))
-    return make_tree(derivation[0].lhs)
+    parser = make_parser(wcfg, wfsa, intersection, heuristic)
+
+    logging.debug('Parsing...')
+    start = time.time()
+    forest = parser.forest(root, goal)
+    logging.info('Intersection: %ss items=%d', time.time() - start, parser.n_items())
+
+    if not forest:
+        print 'NO PARSE FOUND'
+        return False
+    else:
+        logging.debug('Forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
+
+        if count and heuristic is None:
+            print '# derivations=%d' % count_derivations(forest)
+
+        logging.debug('Viterbi...')
+        d, best = viterbi(forest)
+        score = float(best[forest.goal])
+        logging.info('Best parse: %ss', time.time() - start)
+        if heuristic is None:
+            prob = math.exp(score - inside(forest)[forest.goal])
+            print '# viterbi prob=%s score=%s' % (prob, score)
+        else:
+            print '# viterbi score=%s' % score
+        print bracketed_tree(forest, d), "\n"
 
 
-def exact_sample(wcfg, wfsa, root='[S]', goal='[GOAL]', n=1, intersection='nederhof'):
+def kbest_decode(wcfg, wfsa, root='[S]', goal='[GOAL]', intersection='nederhof', k=1):
     """
-    Sample a derivation given a wcfg and a wfsa, with exact sampling, a
-    form of MC-sampling
+    Find the k best derivations given a wcfg and a wfsa, with lazy k-best extraction
     """
-    samples = []
 
-    if intersection == 'nederhof':
-        parser = Nederhof(wcfg, wfsa)
-        logging.info('Using Nederhof parser')
-    elif intersection == 'earley':
-        parser = Earley(wcfg, wfsa)
-        logging.info('Using Earley parser')
+    parser = make_parser(wcfg, wfsa, intersection)
+
+    logging.debug('Parsing...')
+    forest = parser.forest(root, goal)
+
+    if not forest:
+        print 'NO PARSE FOUND'
+        return False
     else:
-        raise NotImplementedError('I do not know this algorithm: %s' % intersection)
+        logging.debug('Forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
+
+        logging.debug('K-best...')
+        Z = inside(forest)[forest.goal]
+        for i, (score, d) in enumerate(kbest(forest, k), 1):
+            print '# k=%d prob=%s score=%s' % (i, math.exp(score - Z), score)
+            print bracketed_tree(forest, d), "\n"
+
+
+def exact_posteriors(wcfg, wfsa, root='[S]', goal='[GOAL]', intersection='nederhof', threshold=0.0):
+    """
+    Computes the posterior probability of every span (annotated nonterminal) and every rule (hyperedge)
+    in the forest with a single inside-outside pass, this is what we would estimate by counting samples.
+    :param threshold: we only print spans and rules whose posterior is greater than the threshold
+    """
+
+    parser = make_parser(wcfg, wfsa, intersection)
 
     logging.debug('Parsing...')
-    forest = parser.do(root, goal)
+    forest = parser.forest(root, goal)
 
     if not forest:
         print 'NO PARSE FOUND'
         return False
     else:
+        logging.debug('Forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
+
+        logging.debug('Inside-outside...')
+        node_posterior, edge_posterior = posteriors(forest)
+
+        for v in sorted(xrange(forest.n_nodes - 1), key=lambda v: -node_posterior[v]):  # skip the goal node
+            if forest.is_terminal(v) or not node_posterior[v] > threshold:
+                continue
+            print '# span=%s posterior=%s' % (forest.label(v), node_posterior[v])
+        for e in sorted(xrange(forest.n_edges), key=lambda e: -edge_posterior[e]):
+            if forest.head[e] == forest.goal or not edge_posterior[e] > threshold:
+                continue
+            print '# rule=%s -> %s posterior=%s' % (forest.label(forest.head[e]),
+                                                    ' '.join(forest.label(c) for c in forest.children(e)),
+                                                    edge_posterior[e])
+        print
+
+
+def exact_sample(wcfg, wfsa, root='[S]', goal='[GOAL]', n=1, intersection='nederhof', count=False, batch_size=1000,
+                 workers=1, seed=None, jsonl=False, sid=1, report_every=0):
+    """
+    Sample a derivation given a wcfg and a wfsa, with exact sampling, a
+    form of MC-sampling
+    With `jsonl`, the estimates are written as JSON lines (see report) for sentence `sid`,
+    and with `report_every` a snapshot is also written every time as many more samples have been drawn
+    (this happens between chunks of `batch_size` samples).
+    """
+
+    parser = make_parser(wcfg, wfsa, intersection)
+
+    logging.debug('Parsing...')
+    forest = parser.forest(root, goal)
+
+    if not forest:
+        if jsonl:
+            write_jsonl(jsonl_records(sid, [], 0))
+        else:
+            print 'NO PARSE FOUND'
+        return False
+    else:
 
-        logging.debug('Forest: rules=%d', len(forest))
+        logging.debug('Forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
 
-        logging.debug('Topsorting...')
-        # sort the forest
-        sorted_nodes = top_sort(forest)
+        if count:
+            if jsonl:  # stdout is reserved for records
+                logging.info('Derivations: %d', count_derivations(forest))
+            else:
+                print '# derivations=%d' % count_derivations(forest)
 
-        # calculate the inside weight of the sorted forest
+        # calculate the inside weight of the forest (whose nodes are already sorted)
         logging.debug('Inside...')
-        inside_prob = inside(forest, sorted_nodes)
+        inside_prob = inside(forest)
 
+        from generalisedSampling import GeneralisedSampling
         gen_sampling = GeneralisedSampling(forest, inside_prob)
 
-        logging.debug('Sampling...')
-        it = 0
-        while len(samples) < n:
-            it += 1
-            if it % 10 == 0:
-                logging.info('%d/%d', it, n)
+        def rows(counts):
+            # distinct derivations (arrays of edge ids) are only turned into trees when they are written
+            for d, k in counts.most_common():
+                score = float(forest.weight[d].sum())
+                prob = math.exp(score - inside_prob[forest.goal])
+                yield bracketed_tree(forest, d, breadth_first=True), k, {'prob': prob, 'score': score}
 
-            # retrieve a random derivation, with respect to the inside weight distribution
-            d = gen_sampling.sample(goal)
+        reported = [0]  # number of samples at the last snapshot
 
-            samples.append(d)
+        def snapshot(counts):
+            total = counts.total()
+            if total // report_every > reported[0] // report_every and total < n:
+                write_jsonl(jsonl_records(sid, rows(counts), total, final=False))
+                reported[0] = total
 
-        counts = Counter(tuple(d) for d in samples)
-        for d, n in counts.most_common():
-            score = sum(r.log_prob for r in d)
-            prob = math.exp(score - inside_prob[goal])
-            print '# n=%s estimate=%s prob=%s score=%s' % (n, float(n)/len(samples), prob, score)
-            tree = make_nltk_tree(d)
-            inline_tree = inlinetree(tree)
-            print inline_tree, "\n"
+        logging.debug('Sampling...')
+        # retrieve random derivations (in batches, possibly in parallel), with respect to the inside weight distribution
+        counts = gen_sampling.parallel_sample_counts(n, workers, seed, batch_size,
+                                                     snapshot if jsonl and report_every > 0 else None)
+        logging.debug('%d distinct derivations', len(counts))
+
+        if jsonl:
+            write_jsonl(jsonl_records(sid, rows(counts), n))
+        else:
+            for tree, k, fields in rows(counts):
+                print '# n=%s estimate=%s prob=%s score=%s' % (k, float(k)/n, fields['prob'], fields['score'])
+                print tree, "\n"
 
 
 def main(args):
@@ -123,15 +222,29 @@ def core(args):
 
     start_symbol = make_nonterminal(args.start)
     goal_symbol = make_nonterminal(args.goal)
-    jobs = [input_str.strip() for input_str in args.input]
-
-    for jid, input_str in enumerate(jobs, 1):
+    # the input is streamed: a sentence is parsed as soon as its line is read
+    for jid, input_str in enumerate(iter(args.input.readline, ''), 1):
+        input_str = input_str.strip()
         sentence, extra_rules = make_sentence(input_str, wcfg.terminals, args.unkmodel, args.default_symbol, split_bars=args.split_input)
-        logging.info('[%d/%d] Parsing %d words: %s', jid, len(jobs), len(sentence), ' '.join(sentence.words))
+        logging.info('[%d] Parsing %d words: %s', jid, len(sentence), ' '.join(sentence.words))
         wcfg.update(extra_rules)
 
         start = time.time()
-        exact_sample(wcfg, sentence.fsa, start_symbol, goal_symbol, args.samples, args.intersection)
+        if args.astar:
+            from heuristic import OutsideHeuristic
+            heuristic = OutsideHeuristic(wcfg, start_symbol)
+            logging.info('Heuristic: %ss', time.time() - start)
+            viterbi_decode(wcfg, sentence.fsa, start_symbol, goal_symbol, args.intersection, heuristic=heuristic)
+        elif args.kbest:
+            kbest_decode(wcfg, sentence.fsa, start_symbol, goal_symbol, args.intersection, args.kbest)
+        elif args.viterbi:
+            viterbi_decode(wcfg, sentence.fsa, start_symbol, goal_symbol, args.intersection, args.count_derivations)
+        elif args.posteriors:
+            exact_posteriors(wcfg, sentence.fsa, start_symbol, goal_symbol, args.intersection, args.min_posterior)
+        else:
+            exact_sample(wcfg, sentence.fsa, start_symbol, goal_symbol, args.samples, args.intersection,
+                         args.count_derivations, args.batch_size, args.workers, args.seed,
+                         args.jsonl, jid, args.report_every)
         end = time.time()
         logging.info("Duration %ss", end - start)
 
@@ -184,6 +297,43 @@ def argparser():
     parser.add_argument('--samples',
                         type=int, default=100,
                         help='The number of samples')
+    parser.add_argument('--batch-size',
+                        type=int, default=1000,
+                        help='The number of samples drawn at once (larger batches are faster but use more memory)')
+    parser.add_argument('--workers',
+                        type=int, default=1,
+                        help='The number of processes sampling from the forest')
+    parser.add_argument('--seed',
+                        type=int, default=None,
+                        help='Random seed (for a fixed seed, samples do not depend on the number of workers)')
+    parser.add_argument('--jsonl',
+                        action='store_true',
+                        help='writes samples as JSON lines (sentence, tree, count, estimate, prob, score), '
+                             'one per distinct derivation')
+    parser.add_argument('--report-every',
+                        type=int, default=0, metavar='N',
+                        help='with --jsonl, also writes a snapshot of the estimates every N samples '
+                             '(snapshots happen between batches, records are marked "final": false)')
+    parser.add_argument('--viterbi',
+            action='store_true',
+            help='outputs the best derivation (a single max-times pass) instead of sampling')
+    parser.add_argument('--astar',
+            action='store_true',
+            help='outputs the best derivation using best-first (A*) intersection, '
+                 'which stops as soon as the best parse is found (compare the logged durations to --viterbi)')
+    parser.add_argument('--kbest',
+            type=int, default=0, metavar='K',
+            help='outputs the K best derivations (lazy k-best extraction) instead of sampling')
+    parser.add_argument('--posteriors',
+            action='store_true',
+            help='outputs the exact posterior probability of spans and rules (a single inside-outside pass) '
+                 'instead of sampling')
+    parser.add_argument('--min-posterior',
+            type=float, default=1e-4,
+            help='with --posteriors, only spans and rules whose posterior exceeds this value are printed')
+    parser.add_argument('--count-derivations',
+            action='store_true',
+            help='outputs the number of derivations in the forest (a single pass of the counting semiring)')
     parser.add_argument('--profile',
             help='enables profiling')
 
@@ -0,0 +1,51 @@
+"""
+Sampling results as JSON lines: one record per distinct derivation of a sentence, e.g.
+
+    {"count": 12, "estimate": 0.12, "final": true, "samples": 100, "score": -41.52, "sentence": 1, "tree": "(S ...)"}
+
+Long runs may write intermediate snapshots of their estimates ("final": false) before the final one,
+every snapshot lists every distinct derivation found so far.
+A sentence without samples (e.g. no parse) has a single record whose tree is null.
+
+>>> import sys
+>>> write_jsonl(jsonl_records(1, [('(S a)', 3, {'score': -0.5}), ('(S b)', 1, {'score': -1.0})], 4), sys.stdout)
+{"count": 3, "estimate": 0.75, "final": true, "samples": 4, "score": -0.5, "sentence": 1, "tree": "(S a)"}
+{"count": 1, "estimate": 0.25, "final": true, "samples": 4, "score": -1.0, "sentence": 1, "tree": "(S b)"}
+>>> write_jsonl(jsonl_records(2, [], 0), sys.stdout)
+{"final": true, "samples": 0, "sentence": 2, "tree": null}
+
+:Authors: - Wilker Aziz
+"""
+
+import sys
+import json
+
+
+def jsonl_records(sentence, rows, total, final=True):
+    """
+    Makes one record per distinct derivation.
+
+    :param sentence: the sentence id
+    :param rows: triplets (tree, count, fields), where fields is a dict of additional fields (e.g. the score)
+    :param total: the number of samples
+    :param final: whether these are the final estimates (rather than a snapshot)
+    """
+    empty = True
+    for tree, count, fields in rows:
+        empty = False
+        record = {'sentence': sentence, 'final': final, 'samples': total,
+                  'tree': tree, 'count': count, 'estimate': float(count) / total}
+        record.update(fields)
+        yield record
+    if empty:
+        yield {'sentence': sentence, 'final': final, 'samples': total, 'tree': None}
+
+
+def write_jsonl(records, ostream=None):
+    """Writes one record per line (keys are sorted) and flushes the stream (by default stdout)"""
+    if ostream is None:
+        ostream = sys.stdout
+    for record in records:
+        ostream.write(json.dumps(record, sort_keys=True))
+        ostream.write('\n')
+    ostream.flush()
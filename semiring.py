@@ -0,0 +1,258 @@
+"""
+Semirings for intersection and forest inference.
+
+Weights are stored in log-domain throughout the project (e.g. rules carry log probabilities),
+thus every semiring knows how to lift a log weight into its own domain (see `from_log`).
+Each semiring implements scalar operations (`plus`, `times`) as well as their array counterparts
+(`sum` and `product` reduce an array of values, `zeros` and `ones` allocate arrays of values).
+Semirings over floats also implement segmented reductions (`segment_sum` and `segment_product`),
+which reduce contiguous segments of an array at once, and scattered sums (`accumulate`),
+these enable vectorised passes over a forest.
+
+:Authors: - Wilker Aziz
+"""
+
+import numpy as np
+
+
+def _object_array(value, n):
+    """Allocates an array of n (python) objects all set to the same value"""
+    values = np.empty(n, dtype=object)
+    for i in xrange(n):
+        values[i] = value
+    return values
+
+
+class LogSemiring(object):
+    """
+    The log-probability semiring: plus is log-sum-exp and times is addition.
+
+    >>> S = LogSemiring()
+    >>> S.plus(S.from_log(-1.0), S.zero)
+    -1.0
+    >>> round(S.sum(np.log([0.25, 0.25, 0.5])), 4)
+    0.0
+    >>> S.product(np.array([-1.0, -2.0]))
+    -3.0
+    """
+
+    zero = -np.inf
+    one = 0.0
+    dtype = float
+
+    def from_log(self, w):
+        return w
+
+    def plus(self, a, b):
+        return np.logaddexp(a, b)
+
+    def times(self, a, b):
+        return a + b
+
+    def sum(self, values):
+        if len(values) == 0:
+            return self.zero
+        return np.logaddexp.reduce(values)
+
+    def product(self, values):
+        return np.sum(values) if len(values) else self.one
+
+    def zeros(self, n):
+        return np.full(n, self.zero, dtype=self.dtype)
+
+    def ones(self, n):
+        return np.full(n, self.one, dtype=self.dtype)
+
+    def segment_sum(self, values, starts):
+        """
+        Log-sum-exp of contiguous (non-empty) segments of an array, stable thanks to a max-shift per segment.
+
+        >>> S = LogSemiring()
+        >>> np.round(S.segment_sum(np.log([0.25, 0.25, 0.5, 0.1]), np.array([0, 2, 3])), 4)
+        array([-0.6931, -0.6931, -2.3026])
+        >>> S.segment_sum(np.array([-np.inf, -np.inf, -1.0]), np.array([0, 2]))
+        array([-inf,  -1.])
+        """
+        top = np.maximum.reduceat(values, starts)
+        top[np.isinf(top)] = 0.0  # segments whose values are all zero (in log-domain) are not shifted
+        lengths = np.diff(np.append(starts, len(values)))
+        with np.errstate(divide='ignore'):
+            return np.log(np.add.reduceat(np.exp(values - np.repeat(top, lengths)), starts)) + top
+
+    def segment_product(self, values, starts, lengths):
+        """
+        Products of contiguous segments of an array, empty segments have product one.
+
+        >>> S = LogSemiring()
+        >>> S.segment_product(np.array([-1.0, -2.0, -3.0]), np.array([0, 2, 3]), np.array([2, 1, 0]))
+        array([-3., -3.,  0.])
+        """
+        if len(starts) == 0:
+            return self.ones(0)
+        totals = np.add.reduceat(np.append(values, self.one), starts)
+        return np.where(lengths > 0, totals, self.one)
+
+    def accumulate(self, totals, indices, values):
+        """In-place totals[indices] = plus(totals[indices], values), where indices may repeat"""
+        np.logaddexp.at(totals, indices, values)
+
+
+class ViterbiSemiring(LogSemiring):
+    """
+    The max-times semiring (in log-domain): plus is max and times is addition.
+
+    >>> S = ViterbiSemiring()
+    >>> S.plus(-1.0, -2.0)
+    -1.0
+    >>> S.sum(np.array([-3.0, -1.0, -2.0]))
+    -1.0
+    """
+
+    def plus(self, a, b):
+        return max(a, b)
+
+    def sum(self, values):
+        return np.max(values) if len(values) else self.zero
+
+    def segment_sum(self, values, starts):
+        """
+        >>> ViterbiSemiring().segment_sum(np.array([-3.0, -1.0, -2.0]), np.array([0, 2]))
+        array([-1., -2.])
+        """
+        return np.maximum.reduceat(values, starts)
+
+    def accumulate(self, totals, indices, values):
+        np.maximum.at(totals, indices, values)
+
+
+class CountingSemiring(object):
+    """
+    The counting semiring over arbitrary-precision integers: every edge counts as one.
+
+    >>> S = CountingSemiring()
+    >>> S.from_log(-0.5)
+    1
+    >>> S.product(np.array([10 ** 20, 10 ** 20], dtype=object)) == 10 ** 40
+    True
+    """
+
+    zero = 0
+    one = 1
+    dtype = object
+
+    def from_log(self, w):
+        return 1
+
+    def plus(self, a, b):
+        return a + b
+
+    def times(self, a, b):
+        return a * b
+
+    def sum(self, values):
+        return sum(values, self.zero)
+
+    def product(self, values):
+        total = self.one
+        for v in values:
+            total *= v
+        return total
+
+    def zeros(self, n):
+        return _object_array(self.zero, n)
+
+    def ones(self, n):
+        return _object_array(self.one, n)
+
+
+class KBestSemiring(object):
+    """
+    The k-best semiring (in log-domain): values are sorted tuples of (at most) k best scores.
+
+    >>> S = KBestSemiring(2)
+    >>> S.plus((-1.0, -3.0), (-2.0,))
+    (-1.0, -2.0)
+    >>> S.times((-1.0, -3.0), (-2.0, -4.0))
+    (-3.0, -5.0)
+    """
+
+    zero = ()
+    one = (0.0,)
+    dtype = object
+
+    def __init__(self, k=1):
+        self.k = k
+
+    def from_log(self, w):
+        return (w,)
+
+    def plus(self, a, b):
+        return tuple(sorted(a + b, reverse=True)[:self.k])
+
+    def times(self, a, b):
+        return tuple(sorted((x + y for x in a for y in b), reverse=True)[:self.k])
+
+    def sum(self, values):
+        return tuple(sorted((x for v in values for x in v), reverse=True)[:self.k])
+
+    def product(self, values):
+        total = self.one
+        for v in values:
+            total = self.times(total, v)
+        return total
+
+    def zeros(self, n):
+        return _object_array(self.zero, n)
+
+    def ones(self, n):
+        return _object_array(self.one, n)
+
+
+class ExpectationSemiring(object):
+    """
+    The expectation semiring (Eisner, 2002) of the log weights themselves.
+
+    A value is a pair (log p, x) standing for the pair (p, p * x) of the original semiring,
+    that is, x is the expected value of the total log weight of a derivation under the distribution
+    that the inside weight p normalises. This representation is stable in log-domain.
+    At the goal node, x is the expected score of a derivation and log p - x is the entropy.
+
+    >>> S = ExpectationSemiring()
+    >>> a, b = S.from_log(np.log(0.5)), S.from_log(np.log(0.5))
+    >>> total = S.plus(a, b)
+    >>> round(total[0], 4), round(total[0] - total[1], 4)  # log Z and entropy
+    (0.0, 0.6931)
+    >>> S.times(a, b)[1] == 2 * np.log(0.5)
+    True
+    """
+
+    zero = np.array([-np.inf, 0.0])
+    one = np.array([0.0, 0.0])
+    dtype = float
+
+    def from_log(self, w):
+        return np.array([w, w])
+
+    def plus(self, a, b):
+        return self.sum(np.array([a, b]))
+
+    def times(self, a, b):
+        return a + b
+
+    def sum(self, values):
+        values = np.asarray(values)
+        if len(values) == 0:
+            return self.zero.copy()
+        logz = np.logaddexp.reduce(values[:, 0])
+        if logz == -np.inf:
+            return self.zero.copy()
+        return np.array([logz, np.sum(np.exp(values[:, 0] - logz) * values[:, 1])])
+
+    def product(self, values):
+        return np.sum(values, axis=0) if len(values) else self.one.copy()
+
+    def zeros(self, n):
+        return np.tile(self.zero, (n, 1))
+
+    def ones(self, n):
+        return np.tile(self.one, (n, 1))
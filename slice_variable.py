@@ -4,18 +4,92 @@
 
 import numpy
 import math
-from scipy.stats import beta
-from collections import defaultdict
 import logging
 
 
+def beta_logpdf(x, a, b):
+    """
+    Log density of the Beta distribution (closed form, this is what scipy.stats.beta.logpdf computes).
+    `x` may be a scalar or an array.
+
+    >>> round(beta_logpdf(0.5, 2.0, 2.0), 6)  # 6 x (1 - x) at x = 0.5
+    0.405465
+    >>> beta_logpdf(0.25, 1.0, 1.0)
+    0.0
+    >>> numpy.round(beta_logpdf(numpy.array([0.25, 0.5]), 2.0, 2.0), 6).tolist()
+    [0.117783, 0.405465]
+    """
+    return _log_beta_density(numpy.log(x), a, b)
+
+
+def _log_beta_density(log_x, a, b):
+    """Log density of the Beta distribution as a function of log x (scalar or array)"""
+    logp = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+    # the terms are skipped when the exponent is 0 (so that x = 0 or x = 1 do not produce 0 * -inf)
+    if a != 1:
+        logp = logp + (a - 1) * log_x
+    if b != 1:
+        with numpy.errstate(divide='ignore'):
+            logp = logp + (b - 1) * numpy.log1p(-numpy.exp(log_x))
+    return logp
+
+
 class SliceVariable(object):
+    """
+    Slice variables (in log-domain) indexed by annotated LHS symbols (sym, start, end).
+
+    Assignments are stored in a flat list: the first time a state is seen it gets the next id (in the order parsing
+    visits states) and its assignment is appended to the list, which `weights` reads as an array.
+    Random variates are drawn in blocks (Beta variates for unconstrained states, standard uniform variates for states
+    constrained by a condition), which saves a call to numpy.random per state.
+    They come from `rng`, a numpy random state (by default numpy's global one), thus chains can have their own streams.
 
-    def __init__(self, slice_variables={}, conditions={}, a=0.1, b=1):
-        self.slice_variables = defaultdict(None, slice_variables)
-        self.conditions = defaultdict(None, conditions)
+    >>> numpy.random.seed(1)
+    >>> S = SliceVariable(conditions={('[X]', 0, 1): -1.0}, a=0.1, b=1.0)
+    >>> S.get('[X]', 0, 1) < -1.0  # a condition bounds the slice variable
+    True
+    >>> S.get('[X]', 0, 1) == S.get('[X]', 0, 1), len(S)
+    (True, 1)
+    >>> S.reset()
+    >>> len(S), S.conditions
+    (0, {('[X]', 0, 1): -1.0})
+    """
+
+    def __init__(self, slice_variables={}, conditions={}, a=0.1, b=1, block_size=1024, rng=numpy.random):
+        self.conditions = dict(conditions)
+        self.rng = rng
         self.a = a
         self.b = b
+        self._block_size = block_size
+        self._index = {}  # (sym, start, end) -> id
+        self._u = []  # id -> assignment
+        self._bounds = {}  # (sym, start) -> smallest assignment over ends (see lower_bound)
+        self._betas = []  # pre-drawn log Beta(a, b) variates
+        self._uniforms = []  # pre-drawn log Uniform(0, 1) variates
+        for state, u in slice_variables.iteritems():
+            self._store(state, u)
+
+    def __len__(self):
+        """Number of slice variables assigned so far"""
+        return len(self._index)
+
+    def _store(self, state, u):
+        """Assigns the next id to a state and stores its assignment"""
+        self._index[state] = len(self._u)
+        self._u.append(u)
+        return u
+
+    def _next_beta(self):
+        if not self._betas:
+            with numpy.errstate(divide='ignore'):
+                self._betas = numpy.log(self.rng.beta(self.a, self.b, self._block_size)).tolist()
+        return self._betas.pop()
+
+    def _next_uniform(self):
+        if not self._uniforms:
+            with numpy.errstate(divide='ignore'):
+                self._uniforms = numpy.log(self.rng.uniform(0, 1, self._block_size)).tolist()
+        return self._uniforms.pop()
 
     def get(self, sym, start, end):
         """
@@ -25,40 +99,158 @@ class SliceVariable(object):
         # slice variables are indexed by the annotated LHS symbol as shown below
         state = (sym, start, end)
         # try to retrieve an assignment of the slice variable
-        u = self.slice_variables.get(state, None)
-        if u is None:  # if we have never computed such an assignment
-            theta = self.conditions.get(state, None)  # first we try to retrieve a condition
-            if theta is None:  # if there is none
-                u = math.log(numpy.random.beta(self.a, self.b))  # the option is to sample u from a beta
-            else:  # otherwise
-                u = math.log(numpy.random.uniform(0, math.exp(theta)))  # we must sample u uniformly in the interval [0, theta)
-            self.slice_variables[state] = u  # finally we store u for next time
-        return u
+        i = self._index.get(state, None)
+        if i is not None:
+            return self._u[i]
+        # if we have never computed such an assignment
+        theta = self.conditions.get(state, None)  # first we try to retrieve a condition
+        if theta is None:  # if there is none
+            u = self._next_beta()  # the option is to sample u from a beta
+        else:  # otherwise
+            u = theta + self._next_uniform()  # we must sample u uniformly in the interval [0, theta)
+        return self._store(state, u)  # finally we store u for next time
+
+    def lower_bound(self, sym, start, ends, floor=float('-inf')):
+        """
+        Returns the smallest slice variable amongst the states (sym, start, end) for every possible end.
+        A rule rewriting `sym` from `start` cannot pass the slice unless it scores above this bound.
+        The bound is computed once per (sym, start) and forgotten on reset.
+
+        Slice variables are drawn end by end, and we stop as soon as the bound falls below `floor`
+        (the lowest score of a rule rewriting `sym`): a lower bound would not prune any rule either,
+        thus loose slices do not pay for drawing a slice variable per span.
+
+        >>> S = SliceVariable({('[X]', 0, 1): -3.0, ('[X]', 0, 2): -1.0, ('[X]', 0, 3): -5.0})
+        >>> S.lower_bound('[X]', 0, [1, 2, 3])
+        -5.0
+        >>> S = SliceVariable({('[X]', 0, 1): -3.0, ('[X]', 0, 2): -1.0, ('[X]', 0, 3): -5.0})
+        >>> S.lower_bound('[X]', 0, [1, 2, 3], floor=-2.0)  # every rule passes (-3.0 < -2.0) without looking further
+        -3.0
+        """
+        bound = self._bounds.get((sym, start), None)
+        if bound is None:
+            bound = float('inf')
+            for end in ends:
+                bound = min(bound, self.get(sym, start, end))
+                if bound < floor:
+                    break
+            self._bounds[(sym, start)] = bound
+        return bound
+
+    def assign(self, states):
+        """
+        Assigns slice variables to a sequence of distinct states at once
+        (states already assigned keep their assignments), drawing all the variates with a single call per distribution.
+        :returns: an array with the slice variable of each state
+        """
+        new = [state for state in states if state not in self._index]
+        theta = numpy.array([self.conditions.get(state, numpy.nan) for state in new], dtype=float)
+        free = numpy.isnan(theta)
+        u = numpy.empty(len(new))
+        with numpy.errstate(divide='ignore'):
+            u[free] = numpy.log(self.rng.beta(self.a, self.b, free.sum()))
+            u[~free] = theta[~free] + numpy.log(self.rng.uniform(0, 1, len(new) - free.sum()))
+        for state, x in zip(new, u.tolist()):
+            self._store(state, x)
+        index = self._index
+        return numpy.array([self._u[index[state]] for state in states], dtype=float)
 
     def reset(self, conditions=None, a=None, b=None):
         """
-        
+        Forgets the assignments of the slice variables (this always happens),
+        and optionally replaces the conditions and the parameters of the Beta distribution.
         """
-        self.slice_variables = defaultdict(None)  # the actual slice variables always get reset
+        self._index = {}  # the actual slice variables always get reset
+        self._u = []
+        self._bounds = {}
         if conditions is not None:  # we overwrite conditions only if necessary
-            self.conditions = defaultdict(None, conditions)
-        # similarly for the parameters
-        if a is not None:
+            self.conditions = dict(conditions)
+        # similarly for the parameters (variates drawn with the old parameters are discarded)
+        if a is not None and a != self.a:
             self.a = a
-        if b is not None:
+            self._betas = []
+        if b is not None and b != self.b:
             self.b = b
+            self._betas = []
 
     def weight(self, sym, start, end, theta):
         state = (sym, start, end)
         try:
-            u = self.slice_variables[state]
-        except:
+            u = self._u[self._index[state]]
+        except KeyError:
             raise ValueError('I do not expect to reweight a rule for an unseen state: %s' % str(state))
 
         if theta > u:
-            return - beta.logpdf(math.exp(u), self.a, self.b)
+            return - _log_beta_density(u, self.a, self.b)
 
         else:
             raise ValueError('I do not expect to reweight rules scoring less than the threshold')
 
+    def weights(self, forest):
+        """
+        Reweights every edge of a sliced forest at once: an edge gets weight 1/Beta.pdf(u; a, b),
+        where u is the slice variable of its head node, except for edges rooted by the goal node,
+        which have weight 1 (there is no slice variable for the goal symbol).
+
+        :param forest: a hypergraph (see hypergraph.Hypergraph) whose nodes have all been assigned slice variables
+        :returns: an array of edge weights (in log-domain)
+        """
+        if not forest:
+            return numpy.zeros(0)
+        head = forest.head
+        inner = head != forest.goal
+        heads = numpy.unique(head[inner])
+        index = self._index
+        try:
+            ids = [index[forest.node(v)] for v in heads]
+        except KeyError as e:
+            raise ValueError('I do not expect to reweight a rule for an unseen state: %s' % str(e.args[0]))
+        node_u = numpy.zeros(forest.n_nodes)  # node -> slice variable
+        node_u[heads] = numpy.array(self._u)[ids]
+        u = node_u[head[inner]]
+        if not numpy.all(forest.weight[inner] > u):
+            raise ValueError('I do not expect to reweight rules scoring less than the threshold')
+        omega = numpy.zeros(forest.n_edges)
+        omega[inner] = - _log_beta_density(u, self.a, self.b)
+        return omega
+
+
+class AdaptiveBeta(object):
+    """
+    Tunes the first parameter of the Beta distribution towards a budget per iteration:
+    either a number of edges in the sliced forest or a number of seconds spent parsing.
 
+    A larger `a` pushes the slice variables towards 1 (0 in log-domain), thus slices get tighter and forests smaller.
+    After every iteration log(a) moves by `rate` times the log ratio between the measured and the target sizes,
+    and an empty forest counts as a slice too tight (log(a) decreases by `rate`).
+    The result is clipped to `bounds`.
+    Adapting the parameters breaks detailed balance, thus this is only meant for burn-in.
+
+    >>> A = AdaptiveBeta(edges=100, rate=0.5)
+    >>> round(A.update(0.1, edges=100 * math.e ** 2), 4)  # too many edges: tighter
+    0.2718
+    >>> round(A.update(0.1, edges=0), 4)  # empty forest: looser
+    0.0607
+    >>> A.update(1e3, edges=1e6)  # clipped
+    1000.0
+    >>> round(AdaptiveBeta(seconds=0.5, rate=1.0).update(1.0, edges=10, duration=0.25), 4)
+    0.5
+    """
+
+    def __init__(self, edges=None, seconds=None, rate=0.1, bounds=(1e-3, 1e3)):
+        if (edges is None) == (seconds is None):
+            raise ValueError('I need a budget of either edges or seconds')
+        self.edges = edges
+        self.seconds = seconds
+        self.rate = rate
+        self.bounds = bounds
+
+    def update(self, a, edges=0, duration=0.0):
+        """Returns the new value of `a` given the size of the last sliced forest and the time it took"""
+        if not edges:
+            step = -self.rate
+        elif self.edges is not None:
+            step = self.rate * math.log(float(edges) / self.edges)
+        else:
+            step = self.rate * math.log(max(duration, 1e-6) / self.seconds)
+        return min(max(a * math.exp(step), self.bounds[0]), self.bounds[1])
@@ -9,33 +9,57 @@ And extended with Slice Sampling by Iason
 
 EMPTY_SET = frozenset()
 import logging
-from agenda import Agenda, ActiveQueue
+from agenda import Agenda, ActiveQueue, get_goal_items
+from hypergraph import make_hypergraph
 from item import ItemFactory
-from symbol import is_terminal, make_symbol, is_nonterminal
-from rule import Rule
-from wcfg import WCFG
-import itertools
+from symbol import is_terminal
 from slice_variable import SliceVariable
+from wcfg import SortedRules
+from feasibility import root_passes
 
 
 class SlicedEarley(object):
     """
+    Deduction is skipped altogether when no rule rewriting the root could pass the slice (see feasibility).
     """
 
-    def __init__(self, wcfg, wfsa, slice_vars):
+    def __init__(self, wcfg, wfsa, slice_vars, rules=None):
         """
+        :param rules: the grammar rules indexed by LHS and first RHS symbol (see wcfg.SortedRules),
+            pass it in order to reuse it across iterations (otherwise the index is computed here)
         """
 
         self._wcfg = wcfg
         self._wfsa = wfsa
         self._agenda = Agenda(active_container_type=ActiveQueue)
+        self.aborted = False  # whether deduction was skipped because the goal could not be reached
         self._predictions = set()  # (LHS, start)
+        self._rules = rules if rules is not None else SortedRules(wcfg)
+        self._ends = wfsa.reachable()  # state -> states that may end a span starting at it
+        if self._rules.has_empty:  # epsilon rules also span from a state to itself
+            self._ends = [sorted(set(ends) | set([state])) for state, ends in enumerate(self._ends)]
         self._item_factory = ItemFactory()
         self.slice_vars = slice_vars
 
     def get_item(self, rule, dot, inner=[]):
         return self._item_factory.get_item(rule, dot, inner)
 
+    def n_items(self):
+        """Number of items created so far"""
+        return len(self._item_factory)
+
+    def predict(self, symbol, start):
+        """Returns items for the rules rewriting `symbol` from `start` that could pass the slice of some span"""
+        floor = self._rules.floor(symbol)
+        # slice variables are negative, thus they never rule out rules scoring 0 (e.g. those of binarised symbols)
+        if floor < 0:
+            threshold = self.slice_vars.lower_bound(symbol, start, self._ends[start], floor)
+        else:
+            threshold = float('-inf')
+        return [self.get_item(rule, start)
+                for first in self._rules.first_of(symbol)
+                for rule in self._rules.iter_above(symbol, first, threshold)]
+
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
         return self.get_item(item.rule, dot, item.inner + (item.dot,))
@@ -48,7 +72,7 @@ class SlicedEarley(object):
             return True
         # otherwise add rewritings to the agenda
         self._predictions.add((symbol, start))
-        self._agenda.extend(self.get_item(rule, start) for rule in rules)
+        self._agenda.extend(self.predict(symbol, start))
         return True
 
     def prediction(self, item):
@@ -59,7 +83,7 @@ class SlicedEarley(object):
         if (item.next, item.dot) in self._predictions:  # prediction already happened
             return False
         self._predictions.add((item.next, item.dot))
-        new_items = [self.get_item(rule, item.dot) for rule in self._wcfg.get(item.next, frozenset())]
+        new_items = self.predict(item.next, item.dot)
         self._agenda.extend(new_items)
         return True
 
@@ -110,7 +134,8 @@ class SlicedEarley(object):
         self._agenda.extend(new_items)
         return len(new_items) > 0
 
-    def do(self, root='[S]', goal='[GOAL]'):
+    def forest(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected forest as a compact hypergraph (empty if deduction aborted)"""
 
         wfsa = self._wfsa
         wcfg = self._wcfg
@@ -120,6 +145,11 @@ class SlicedEarley(object):
         # GOAL -> * ROOT, where * is an intial state of the wfsa
         if not any(self.axioms(root, start) for start in wfsa.iterinitial()):
             raise ValueError('No rule for the start symbol %s' % root)
+        if not root_passes(root, wfsa, self._rules, self.slice_vars):
+            self.aborted = True
+            logging.debug('Aborting: no rule rewriting the root passes the slice')
+            return self.get_forest(goal, root)
+
         new_roots = set()
 
         while agenda:
@@ -155,50 +185,27 @@ class SlicedEarley(object):
                         if not self.prediction(item):  # try to predict, otherwise try to complete itself
                             self.complete_itself(item)
                         agenda.make_passive(item)
-        # converts complete items into rules
+        # converts complete items into hyperedges
         logging.debug('Making forest...')
-        return self.get_cfg(goal, root)
+        return self.get_forest(goal, root)
+
+    def do(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected CFG"""
+        return self.forest(root, goal).to_wcfg()
 
-    def get_intersected_rule(self, item):
-        lhs = make_symbol(item.rule.lhs, item.start, item.dot)
-        positions = item.inner + (item.dot,)
-        rhs = [make_symbol(sym, positions[i], positions[i + 1]) for i, sym in enumerate(item.rule.rhs)]
-        return Rule(lhs, rhs, item.rule.log_prob)
+    def get_forest(self, goal, root):
+        """
+        Constructs the intersected forest by visiting complete items in a top-down fashion (see agenda.get_forest).
+        Goal edges have weight 0 (in log-domain) because there is no slice variable for the goal symbol.
+        """
+        return make_hypergraph(goal,
+                               get_goal_items(root, self._wfsa, self._agenda, final_weight=lambda q: 0.0),
+                               self._agenda.itercomplete)
 
     def get_cfg(self, goal, root):
         """
         Constructs the CFG by visiting complete items in a top-down fashion.
         This is effectively a reachability test and it serves the purpose of filtering nonterminal symbols
         that could never be reached from the root.
-        Note that bottom-up intersection typically does enumerate a lot of useless (unreachable) items.
-        This is the recursive procedure described in the paper (Nederhof and Satta, 2008).
         """
-
-        G = WCFG()
-        processed = set()
-        fsa = self._wfsa
-        itergenerating = self._agenda.itergenerating
-        itercomplete = self._agenda.itercomplete
-
-        def make_rules(lhs, start, end):
-            if (start, lhs, end) in processed:
-                return
-            processed.add((lhs, start, end))
-            for item in itercomplete(lhs, start, end):
-                G.add(self.get_intersected_rule(item))
-                fsa_states = item.inner + (item.dot,)
-                for i, sym in itertools.ifilter(lambda (_, s): is_nonterminal(s), enumerate(item.rule.rhs)):
-                    if (sym, fsa_states[i], fsa_states[
-                            i + 1]) not in processed:  # Nederhof does not perform this test, but in python it turned out crucial
-                        make_rules(sym, fsa_states[i], fsa_states[i + 1])
-
-        # create goal items
-        for start, ends in itergenerating(root):
-            if not fsa.is_initial(start):
-                continue
-            for end in itertools.ifilter(lambda q: fsa.is_final(q), ends):
-                make_rules(root, start, end)
-                G.add(Rule(make_symbol(goal, None, None),
-                           [make_symbol(root, start, end)], 0.0))
-
-        return G
+        return self.get_forest(goal, root).to_wcfg()
@@ -0,0 +1,91 @@
+"""
+Slice sampling without redoing the intersection at every iteration.
+
+The unsliced forest is computed once (with either Nederhof or Earley),
+then, at every iteration, the sliced forest is obtained by filtering that forest:
+    1) an edge survives the slice if the log probability of its rule is above the slice variable of its head node
+       (edges rooted by the goal node always survive)
+    2) a node survives if it is productive (it derives a string with surviving edges only, bottom-up)
+       and reachable (from the goal node, top-down)
+This is the forest the sliced parsers (see sliced_nederhof and sliced_earley) would produce for the same slice variables,
+because a sliced chart only differs from the unsliced one in the complete items it rejects.
+Both passes are max-times inside and outside passes over 0/-inf edge weights, thus they are vectorised.
+
+:Authors: - Wilker Aziz
+"""
+
+import logging
+import numpy as np
+from inference import inside, outside, edge_inside
+from semiring import ViterbiSemiring
+
+
+class IncrementalSlicedParser(object):
+    """
+    A drop-in replacement for SlicedNederhof/SlicedEarley that is meant to be reused across iterations:
+    each call to `forest` returns the forest sliced by the current assignment of the slice variables.
+    """
+
+    def __init__(self, wcfg, wfsa, slice_vars, intersection='nederhof'):
+        self._wcfg = wcfg
+        self._wfsa = wfsa
+        self._intersection = intersection
+        self.slice_vars = slice_vars
+        self.aborted = False  # slicing a forest is never aborted (see SlicedNederhof)
+        self._full = {}  # (root, goal) -> (unsliced forest, rule log probabilities, nodes with slice variables)
+
+    def _unsliced(self, root, goal):
+        """Computes the unsliced forest (only once) along with what we need to slice it"""
+        key = (root, goal)
+        if key not in self._full:
+            if self._intersection == 'nederhof':
+                from nederhof import Nederhof
+                parser = Nederhof(self._wcfg, self._wfsa)
+            elif self._intersection == 'earley':
+                from earley import Earley
+                parser = Earley(self._wcfg, self._wfsa)
+            else:
+                raise NotImplementedError('I do not know this algorithm: %s' % self._intersection)
+            forest = parser.forest(root, goal)
+            logging.debug('Unsliced forest: nodes=%d edges=%d', forest.n_nodes, forest.n_edges)
+            # sliced forests weigh edges by their rules (goal rules carry the final weights)
+            theta = np.array([forest.rule(e).log_prob for e in xrange(forest.n_edges)], dtype=float)
+            # every node but the goal that is rewritten by some edge has a slice variable
+            heads = np.unique(forest.head[forest.head != forest.goal]) if forest else np.zeros(0, dtype=np.int64)
+            self._full[key] = (forest, theta, heads)
+        return self._full[key]
+
+    def intersect(self, root='[S]', goal='[GOAL]'):
+        """
+        Computes the unsliced forest ahead of the first iteration
+        (e.g. before chains are forked, then they all share it), and returns it.
+        """
+        return self._unsliced(root, goal)[0]
+
+    def n_items(self):
+        """Number of edges examined per iteration (those of the unsliced forests)"""
+        return sum(forest.n_edges for forest, _, _ in self._full.itervalues())
+
+    def forest(self, root='[S]', goal='[GOAL]'):
+        """Returns the forest sliced by the current slice variables as a compact hypergraph"""
+        forest, theta, heads = self._unsliced(root, goal)
+        if not forest:
+            return forest
+        semiring = ViterbiSemiring()
+        u = np.full(forest.n_nodes, -np.inf)  # the goal node (as well as leaves) is not sliced
+        u[heads] = self.slice_vars.assign([forest.node(v) for v in heads])
+        mask = np.where(theta > u[forest.head], semiring.one, semiring.zero)
+        # productive nodes have non-zero inside weight
+        inside_prob = inside(forest, omega=mask, semiring=semiring)
+        if inside_prob[forest.goal] == semiring.zero:
+            return forest.subgraph([])
+        # edges made of productive nodes and rooted by a reachable node have non-zero posterior
+        outside_prob = outside(forest, inside_prob, omega=mask, semiring=semiring)
+        score = edge_inside(forest, inside_prob, mask, semiring) + outside_prob[forest.head]
+        edges = np.flatnonzero(score > semiring.zero)
+        logging.debug('Sliced forest: edges=%d/%d', len(edges), forest.n_edges)
+        return forest.subgraph(edges, weight=theta[edges])
+
+    def do(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected CFG"""
+        return self.forest(root, goal).to_wcfg()
@@ -17,33 +17,52 @@ This is an implementation of the bottom-up intersection by Nederhof and Satta (2
     - Iason
 """
 
-from collections import defaultdict, deque
+from collections import deque
+from functools import partial
 from itertools import ifilter
-from agenda import Agenda, ActiveQueue, get_cfg
+from agenda import Agenda, PriorityQueue, get_forest
 from item import ItemFactory
 from symbol import is_terminal, make_symbol, is_nonterminal
 from rule import Rule
-from wcfg import WCFG
+from wcfg import WCFG, SortedRules
 import logging
 from slice_variable import SliceVariable
+from feasibility import Feasibility, root_passes
 
 
 class SlicedNederhof(object):
     """
     This is an implementation of the CKY-inspired intersection due to Nederhof and Satta (2008).
+
+    Items are processed in order of width, thus spans become final as deduction goes,
+    and deduction is aborted as soon as the goal can no longer be reached (see feasibility).
     """
 
-    def __init__(self, wcfg, wfsa, slice_vars):
+    def __init__(self, wcfg, wfsa, slice_vars, rules=None):
+        """
+        :param rules: the grammar rules indexed by LHS and first RHS symbol (see wcfg.SortedRules),
+            pass it in order to reuse it across iterations (otherwise the index is computed here)
+        """
         self._wcfg = wcfg
         self._wfsa = wfsa
-        self._agenda = Agenda(active_container_type=ActiveQueue)
-        self._firstsym = defaultdict(set)  # index rules by their first RHS symbol
+        # narrower items first (ties are broken in order of arrival)
+        self._agenda = Agenda(active_container_type=partial(PriorityQueue, priority=lambda item: item.start - item.dot))
+        self.aborted = False  # whether deduction stopped because the goal could no longer be reached
+        self._rules = rules if rules is not None else SortedRules(wcfg)
+        self._feasibility = Feasibility(self._rules, wfsa)
+        self._ends = wfsa.reachable()  # state -> states that may end a span starting at it
+        if self._rules.has_empty:  # epsilon rules also span from a state to itself
+            self._ends = [sorted(set(ends) | set([state])) for state, ends in enumerate(self._ends)]
         self._item_factory = ItemFactory()
         self.slice_vars = slice_vars
 
     def get_item(self, rule, dot, inner=[]):
         return self._item_factory.get_item(rule, dot, inner)
     
+    def n_items(self):
+        """Number of items created so far"""
+        return len(self._item_factory)
+
     def advance(self, item, dot):
         """returns a new item whose dot has been advanced"""
         return self.get_item(item.rule, dot, item.inner + (item.dot,))
@@ -64,9 +83,17 @@ class SlicedNederhof(object):
             self._agenda.add(self.advance(item, sto))
 
         # you may interpret this as a delayed axiom
-        # every compatible rule in the grammar
-        for r in self._firstsym.get(sym, set()):  
-            self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
+        # every compatible rule in the grammar that could pass the slice variable of some span starting at `sfrom`
+        rules = self._rules
+        for lhs in rules.lhs_of(sym):
+            floor = rules.floor(lhs)
+            # slice variables are negative, thus they never rule out rules scoring 0 (e.g. those of binarised symbols)
+            if floor < 0:
+                threshold = self.slice_vars.lower_bound(lhs, sfrom, self._ends[sfrom], floor)
+            else:
+                threshold = float('-inf')
+            for r in rules.iter_above(lhs, sym, threshold):
+                self._agenda.add(self.get_item(r, sto, inner=(sfrom,)))  # can be interpreted as a lazy axiom
 
         return True
 
@@ -74,9 +101,7 @@ class SlicedNederhof(object):
         """
         The axioms of the program are based on the FSA transitions. 
         """
-        # you may interpret the following as a sort of lazy axiom (based on grammar rules)
-        for r in self._wcfg:
-            self._firstsym[r.rhs[0]].add(r)
+        # grammar rules are instantiated lazily (see add_symbol)
         # these are axioms based on the transitions of the automaton
         for sfrom, sto, sym, w in self._wfsa.iterarcs():
             self.add_symbol(sym, sfrom, sto)  
@@ -84,14 +109,23 @@ class SlicedNederhof(object):
     def inference(self):
         """Exhausts the queue of active items"""
         agenda = self._agenda
+        feasibility = self._feasibility
+        width = 0  # spans narrower than this are final
         while agenda:
             item = agenda.pop()  # always returns an ACTIVE item
+            if item.dot - item.start > width:
+                width = item.dot - item.start
+                if not feasibility.finish_width(width - 1):
+                    self.aborted = True
+                    logging.debug('Aborting: the goal cannot be reached (width=%d)', width)
+                    break
             # complete other items (by calling add_symbol), in case the input item is complete
             if item.is_complete():
                 u = self.slice_vars.get(item.rule.lhs, item.start, item.dot)
                 # check whether the probability of the current completed item is above the threshold determined by
                 # the slice variable
                 if item.rule.log_prob > u:
+                    feasibility.prove(item.start, item.dot)
                     self.add_symbol(item.rule.lhs, item.start, item.dot)  # prove the symbol
                     agenda.make_complete(item)  # mark the item as complete
             else:
@@ -100,8 +134,16 @@ class SlicedNederhof(object):
                 for sto in agenda.itercompletions(item.next, item.dot):
                     agenda.add(self.advance(item, sto))  # move the dot forward
 
+    def forest(self, root='[S]', goal='[GOAL]'):
+        """Runs the program and returns the intersected forest as a compact hypergraph (empty if deduction aborted)"""
+        if not root_passes(root, self._wfsa, self._rules, self.slice_vars):
+            self.aborted = True
+            logging.debug('Aborting: no rule rewriting the root passes the slice')
+        else:
+            self.axioms()
+            self.inference()
+        return get_forest(goal, root, self._wfsa, self._agenda)
+
     def do(self, root='[S]', goal='[GOAL]'):
         """Runs the program and returns the intersected CFG"""
-        self.axioms()
-        self.inference()
-        return get_cfg(goal, root, self._wfsa, self._agenda)
+        return self.forest(root, goal).to_wcfg()
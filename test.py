@@ -5,6 +5,20 @@ from wfsa import WDFSA, make_linear_fsa
 from symbol import make_nonterminal, make_terminal
 
 from reader import load_grammar
+from rule import Rule
+from wcfg import WCFG, count_derivations
+from inference import inside, outside, viterbi, posteriors, kbest, _inside_loop
+from semiring import CountingSemiring, LogSemiring, ViterbiSemiring, KBestSemiring
+from heuristic import OutsideHeuristic
+from generalisedSampling import GeneralisedSampling
+from itg import make_itg_forest, UniformSampler, permutation, count_derivations_of, yield_counts, sample_yields
+from treeformat import bracketed_tree, bracketed_rules, make_nltk_tree, inlinetree
+import random
+import numpy as np
+import os
+import math
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'examples')
 
 def test_final_weights():
   # Load the grammar 
@@ -46,6 +60,467 @@ def test_intersection_weights():
   forest = parser.do('[S]', '[GOAL]')
   if forest.get('[NN,0-0]')[1].log_prob == -1.7039:
     print "Succeed, the earley intersection correctly changes the weight for a unigram automata"
+
+def test_deep_forest():
+  # a right-branching grammar whose derivations are deeper than python's recursion limit
+  wcfg = WCFG([Rule('[S]', ['a', '[S]'], -0.1), Rule('[S]', ['b'], -0.1)])
+  wfsa = make_linear_fsa(' '.join(['a'] * 2000 + ['b']))
+  for parser in [Earley(wcfg, wfsa), Nederhof(wcfg, wfsa)]:
+    forest = parser.forest('[S]', '[GOAL]')
+    assert forest.n_edges == 2002
+    # nodes come out topologically sorted: children before parents
+    assert all(max(forest.children(e)) < forest.head[e] for e in xrange(forest.n_edges))
+    assert forest.node(forest.goal) == ('[GOAL]', None, None)
+    # the vectorised inside pass handles one level per node
+    assert abs(inside(forest)[forest.goal] - _inside_loop(forest, forest.weight, LogSemiring())[forest.goal]) < 1e-9
+  print "Succeed, forest extraction does not depend on the recursion limit"
+
+def test_semirings():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  forest = Nederhof(wcfg, wfsa).forest('[S]', '[GOAL]')
+  # a single pass of the counting semiring agrees with the enumeration of derivations
+  n = inside(forest, semiring=CountingSemiring())[forest.goal]
+  assert n == sum(count_derivations(forest.to_wcfg(), '[GOAL]')['d'].itervalues())
+  # the viterbi derivation scores as much as the viterbi inside weight
+  d, best = viterbi(forest)
+  assert abs(sum(forest.weight[e] for e in d) - best[forest.goal]) < 1e-9
+  assert best[forest.goal] <= inside(forest)[forest.goal]
+  print "Succeed, %d derivations and viterbi score %s" % (n, best[forest.goal])
+
+def test_vectorised_inside():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  for Parser in [Nederhof, Earley]:
+    forest = Parser(wcfg, wfsa).forest('[S]', '[GOAL]')
+    # level-by-level inside agrees with the node-by-node recursion
+    for semiring in [LogSemiring(), ViterbiSemiring()]:
+      expected = _inside_loop(forest, forest.weight, semiring)
+      assert max(abs(a - b) for a, b in zip(inside(forest, semiring=semiring), expected)) < 1e-9
+  print "Succeed, vectorised inside over %d levels" % len(forest.levels())
+
+def test_posteriors():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  forest = Nederhof(wcfg, wfsa).forest('[S]', '[GOAL]')
+  node_posterior, edge_posterior = posteriors(forest)
+  # every derivation contains the goal node and every word
+  assert all(abs(node_posterior[v] - 1.0) < 1e-9 for v in xrange(forest.n_nodes) if forest.is_terminal(v))
+  assert abs(node_posterior[forest.goal] - 1.0) < 1e-9
+  # a node is used in a derivation through exactly one of its incoming edges
+  for v in xrange(forest.n_nodes):
+    if not forest.is_terminal(v):
+      assert abs(sum(edge_posterior[e] for e in forest.iterincoming(v)) - node_posterior[v]) < 1e-9
+  # in the max-times semiring, inside times outside peaks at the viterbi score
+  best = inside(forest, semiring=ViterbiSemiring())
+  assert abs(max(best + outside(forest, best, semiring=ViterbiSemiring())) - best[forest.goal]) < 1e-9
+  print "Succeed, posteriors of %d nodes and %d edges" % (forest.n_nodes, forest.n_edges)
+
+def test_sampling_tables():
+  # the inside weight of long sentences underflows in probability space
+  wcfg = WCFG([Rule('[S]', ['[A]', '[S]'], -2.0), Rule('[S]', ['[B]', '[S]'], -2.0), Rule('[S]', ['b'], -2.0),
+               Rule('[A]', ['a'], -1.0), Rule('[B]', ['a'], -3.0)])
+  forest = Nederhof(wcfg, make_linear_fsa(' '.join(['a'] * 400 + ['b']))).forest('[S]', '[GOAL]')
+  inside_prob = inside(forest)
+  assert math.exp(inside_prob[forest.goal]) == 0.0
+  sampler = GeneralisedSampling(forest, inside_prob)
+  random.seed(1)
+  n = 2000
+  # the first word is tagged [A] with probability e^-1 / (e^-1 + e^-3)
+  top = forest.fetch('[S]', 0, 401)
+  hits = 0
+  for _ in xrange(n):
+    hits += forest.node(forest.children(sampler.select(top))[0])[0] == '[A]'
+  expected = math.exp(-1) / (math.exp(-1) + math.exp(-3))
+  assert abs(float(hits) / n - expected) < 0.03, float(hits) / n
+  print "Succeed, sampling tables do not underflow (%.3f vs %.3f)" % (float(hits) / n, expected)
+
+def test_batch_sampling():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  forest = Nederhof(wcfg, make_linear_fsa('the dog drinks milk')).forest('[S]', '[GOAL]')
+  inside_prob = inside(forest)
+  np.random.seed(1)
+  counts = GeneralisedSampling(forest, inside_prob).sample_counts(20000, batch_size=3000)
+  assert counts.total() == 20000 and len(counts) == 3
+  for d, n in counts.most_common():
+    # derivations come out top-down
+    assert forest.head[d[0]] == forest.goal
+    assert abs(float(n) / 20000 - math.exp(forest.weight[d].sum() - inside_prob[forest.goal])) < 0.01
+  print "Succeed, %d distinct derivations in %d samples" % (len(counts), counts.total())
+
+def test_parallel_sampling():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  forest = Nederhof(wcfg, make_linear_fsa('the dog drinks milk')).forest('[S]', '[GOAL]')
+  sampler = GeneralisedSampling(forest, inside(forest))
+  # for a fixed seed, the counts do not depend on the number of workers
+  results = [[(d.tolist(), n) for d, n in sampler.parallel_sample_counts(5000, workers, 11, 1000).most_common()]
+             for workers in [1, 2, 3]]
+  assert results[0] == results[1] == results[2]
+  print "Succeed, parallel sampling is reproducible"
+
+def test_kbest():
+  # an ambiguous grammar: binary bracketings of a string
+  wcfg = WCFG([Rule('[S]', ['[S]', '[S]'], -0.5), Rule('[S]', ['[S]', '[S]', '[S]'], -0.7),
+               Rule('[S]', ['a'], -0.1), Rule('[S]', ['a'], -0.2)])
+  forest = Nederhof(wcfg, make_linear_fsa('a a a a a')).forest('[S]', '[GOAL]')
+  derivations = kbest(forest, 50)
+  assert len(set(tuple(d) for _, d in derivations)) == 50
+  # scores agree with the k-best semiring and with the derivations themselves
+  expected = inside(forest, semiring=KBestSemiring(50))[forest.goal]
+  assert all(abs(score - e) < 1e-9 for (score, _), e in zip(derivations, expected))
+  assert all(abs(score - sum(forest.weight[d])) < 1e-9 for score, d in derivations)
+  # asking for more derivations than there are
+  n = inside(forest, semiring=CountingSemiring())[forest.goal]
+  assert len(kbest(forest, n + 10)) == n
+  print "Succeed, %d best out of %d derivations" % (len(derivations), n)
+
+def test_bracketed_trees():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  forest = Nederhof(wcfg, make_linear_fsa('the dog drinks milk')).forest('[S]', '[GOAL]')
+  # trees are written exactly as nltk would print them inline
+  for _, d in kbest(forest, 3):
+    expected = inlinetree(make_nltk_tree([forest.make_rule(e) for e in d]))
+    assert bracketed_tree(forest, d) == expected
+    assert bracketed_rules([forest.make_rule(e) for e in d]) == expected
+  print "Succeed, %s" % expected
+
+def test_lazy_imports():
+  import subprocess
+  import sys
+  # the command line tools do not load heavy modules they might not need
+  here = os.path.dirname(os.path.abspath(__file__))
+  for script in ['parse', 'mcmcparse']:
+    loaded = subprocess.check_output([sys.executable, '-c', 'import sys, %s; print " ".join(sorted(sys.modules))' % script], cwd=here).split()
+    assert not set(['nltk', 'scipy', 'multiprocessing']) & set(loaded), script
+  print "Succeed, neither nltk nor scipy are loaded at startup"
+
+def test_astar():
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  h = OutsideHeuristic(wcfg, '[S]')
+  # best-first intersection finds a best derivation as good as that of exhaustive intersection
+  for Parser in [Nederhof, Earley]:
+    exhaustive = viterbi(Parser(wcfg, wfsa).forest('[S]', '[GOAL]'))[1][-1]
+    astar = viterbi(Parser(wcfg, wfsa, heuristic=h).forest('[S]', '[GOAL]'))[1][-1]
+    assert abs(exhaustive - astar) < 1e-9, '%s: %s != %s' % (Parser.__name__, exhaustive, astar)
+  print "Succeed, A* viterbi score %s" % astar
+
+def test_cyclic_forest():
+  # unary cycle S -> A -> S: infinitely many derivations of "a"
+  p1, p2, p3, p4 = 0.4, 0.6, 0.5, 0.5
+  wcfg = WCFG([Rule('[S]', ['a'], math.log(p1)), Rule('[S]', ['[A]'], math.log(p2)),
+               Rule('[A]', ['[S]'], math.log(p3)), Rule('[A]', ['a'], math.log(p4))])
+  expected = (p1 + p2 * p4) / (1 - p2 * p3)
+  for Parser in [Nederhof, Earley]:
+    forest = Parser(wcfg, make_linear_fsa('a')).forest('[S]', '[GOAL]')
+    assert not forest.is_acyclic()
+    values = inside(forest)
+    assert abs(math.exp(values[forest.goal]) - expected) < 1e-6, Parser.__name__
+    # the most frequent derivation is S -> a
+    np.random.seed(1)
+    counts = GeneralisedSampling(forest, values).sample_counts(5000)
+    d, n = counts.most_common(1)[0]
+    assert len(d) == 2 and bracketed_tree(forest, d, breadth_first=True).endswith(' a))')
+    assert abs(n / 5000. - p1 / expected) < 0.03
+  print "Succeed, inside of a cyclic forest %s" % math.exp(values[forest.goal])
+
+def test_itg_counting():
+  wcfg = WCFG([Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['[X]', '[X]'], 0.0)] + [Rule('[X]', [str(i)], 0.0) for i in range(1, 6)])
+  forest = make_itg_forest(Earley(wcfg, make_linear_fsa('1 2 3 4 5')).forest('[S]', '[GOAL]'))
+  # dynamic programming agrees with enumeration
+  expected = count_derivations(forest.to_wcfg(), '[GOAL]')
+  derivations, permutations = UniformSampler(forest), UniformSampler(forest, normal_form=True)
+  assert derivations.total == sum(expected['d'].itervalues()) == inside(forest, semiring=CountingSemiring())[forest.goal]
+  assert permutations.total == len(expected['p'])
+  # each permutation has exactly one normal-form derivation
+  perms = [permutation(forest, permutations.unrank(i)) for i in xrange(permutations.total)]
+  assert set(perms) == set(tuple(int(x) for x in p) for p in expected['p'])
+  assert all(count_derivations_of(forest, p) == expected['p'][tuple(str(x) for x in p)] for p in perms)
+  print "Succeed, %d permutations and %d derivations" % (permutations.total, derivations.total)
+
+def test_itg_grammars():
+  bracketing = [Rule('[S]', ['[X]'], 0.0), Rule('[X]', ['[X]', '[X]'], 0.0)] + [Rule('[X]', [str(i)], 0.0) for i in range(1, 5)]
+  # a second nonterminal derives the same permutations in more than one normal-form derivation
+  multi = WCFG(bracketing + [Rule('[X]', ['[Z]'], 0.0), Rule('[Z]', ['[X]', '[X]'], 0.0)])
+  forest = make_itg_forest(Earley(multi, make_linear_fsa('1 2 3')).forest('[S]', '[GOAL]'))
+  try:
+    UniformSampler(forest, normal_form=True)
+    assert False, 'the normal form should reject a grammar with several nonterminals'
+  except ValueError:
+    pass
+  expected = count_derivations(forest.to_wcfg(), '[GOAL]')['p']
+  assert dict(yield_counts(forest)) == dict(expected) and len(expected) == 6
+  assert all(p in expected for p, n in sample_yields(forest, 20, random.Random(1)))
+  # with repeated words, permutations sharing a yield are merged (as in the enumeration)
+  forest = make_itg_forest(Earley(WCFG(bracketing), make_linear_fsa('1 2 1 3')).forest('[S]', '[GOAL]'))
+  assert dict(yield_counts(forest)) == dict(count_derivations(forest.to_wcfg(), '[GOAL]')['p'])
+  print "Succeed, %d permutations without the normal form" % len(expected)
+
+def test_slice_variables():
+  from slice_variable import SliceVariable
+  from sliced_nederhof import SlicedNederhof
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  np.random.seed(3)
+  slice_vars = SliceVariable(a=0.1, b=1.0)
+  for _ in range(100):  # until the slice admits a derivation
+    forest = SlicedNederhof(wcfg, make_linear_fsa('the dog drinks milk'), slice_vars).forest('[S]', '[GOAL]')
+    if forest:
+      break
+    slice_vars.reset()
+  assert forest
+  # vectorised reweighting agrees with reweighting edge by edge
+  omega = slice_vars.weights(forest)
+  for e in xrange(forest.n_edges):
+    if forest.head[e] == forest.goal:
+      assert omega[e] == 0.0
+    else:
+      sym, start, end = forest.node(forest.head[e])
+      assert abs(omega[e] - slice_vars.weight(sym, start, end, forest.weight[e])) < 1e-9
+  print "Succeed, %d edges reweighted" % forest.n_edges
+
+def test_incremental_slicing():
+  from slice_variable import SliceVariable
+  from sliced_nederhof import SlicedNederhof
+  from sliced_earley import SlicedEarley
+  from sliced_incremental import IncrementalSlicedParser
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  np.random.seed(5)
+  # given the same slice variables, slicing the unsliced forest gives the forest of the sliced parsers
+  for name, Parser in [('nederhof', SlicedNederhof), ('earley', SlicedEarley)]:
+    slice_vars = SliceVariable(a=0.1, b=1.0)
+    incremental = IncrementalSlicedParser(wcfg, wfsa, slice_vars, name)
+    for _ in range(20):
+      slice_vars.reset()
+      expected = Parser(wcfg, wfsa, slice_vars).forest('[S]', '[GOAL]')
+      forest = incremental.forest('[S]', '[GOAL]')
+      assert sorted(map(str, expected.to_wcfg())) == sorted(map(str, forest.to_wcfg())), name
+  print "Succeed, incremental slicing matches sliced intersection"
+
+def test_early_abort():
+  from slice_variable import SliceVariable
+  from sliced_nederhof import SlicedNederhof
+  from sliced_earley import SlicedEarley
+  from sliced_incremental import IncrementalSlicedParser
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  np.random.seed(7)
+  # tight slices: deduction is aborted only if the goal is unreachable, and the forest is unaffected
+  aborted = 0
+  for name, Parser in [('nederhof', SlicedNederhof), ('earley', SlicedEarley)]:
+    slice_vars = SliceVariable(a=1.0, b=1.0)
+    incremental = IncrementalSlicedParser(wcfg, wfsa, slice_vars, name)
+    for _ in range(50):
+      slice_vars.reset()
+      parser = Parser(wcfg, wfsa, slice_vars)
+      expected = incremental.forest('[S]', '[GOAL]')
+      forest = parser.forest('[S]', '[GOAL]')
+      assert not (parser.aborted and expected), name
+      assert sorted(map(str, expected.to_wcfg())) == sorted(map(str, forest.to_wcfg())), name
+      aborted += parser.aborted
+  assert aborted > 0
+  print "Succeed, %d out of 100 sliced intersections aborted early" % aborted
+
+def test_epsilon_slicing():
+  from slice_variable import SliceVariable
+  from sliced_earley import SlicedEarley
+  from sliced_incremental import IncrementalSlicedParser
+  # [B] may span nothing, also at the final state, where no other span starts
+  wcfg = WCFG([Rule('[S]', ['[B]', 'a', '[B]'], -0.1), Rule('[B]', [], -0.5), Rule('[B]', ['b'], -0.7),
+               Rule('[B]', ['[B]', 'b'], -0.3)])
+  wfsa = make_linear_fsa('a b')
+  np.random.seed(1)
+  slice_vars = SliceVariable(a=0.3, b=1.0)
+  incremental = IncrementalSlicedParser(wcfg, wfsa, slice_vars, 'earley')
+  found = 0
+  for _ in range(50):
+    slice_vars.reset()
+    expected = incremental.forest('[S]', '[GOAL]')
+    forest = SlicedEarley(wcfg, wfsa, slice_vars).forest('[S]', '[GOAL]')
+    assert sorted(map(str, expected.to_wcfg())) == sorted(map(str, forest.to_wcfg()))
+    found += bool(forest)
+  assert found > 0
+  print "Succeed, %d out of 50 sliced forests with epsilon rules" % found
+
+def test_viterbi_initialisation():
+  from slice_variable import SliceVariable
+  from sliced_nederhof import SlicedNederhof
+  from mcmcparse import initialise, sliced_sample
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  wfsa = make_linear_fsa('the dog drinks milk')
+  conditions = initialise(wcfg, wfsa, '[S]', '[GOAL]')
+  d, best = viterbi(Nederhof(wcfg, wfsa).forest('[S]', '[GOAL]'))
+  assert len(conditions) == len(d)
+  # tight slices would often rule out every derivation, but not the conditioned one
+  np.random.seed(3)
+  slice_vars = SliceVariable(a=0.9, b=1.0, conditions=conditions)
+  for _ in range(20):
+    slice_vars.reset()
+    assert sliced_sample('[S]', '[GOAL]', SlicedNederhof(wcfg, wfsa, slice_vars)) is not None
+  print "Succeed, initial conditions from a derivation of score %s" % best[-1]
+
+def test_parallel_chains():
+  from mcmcparse import SlicedParsers, Chain, run_chains
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  parsers = SlicedParsers(wcfg, make_linear_fsa('the dog drinks milk'), '[S]', '[GOAL]')
+  # chains own their random states, thus running them in separate processes does not change their counts
+  jobs = lambda: [(Chain(cid, a=[0.3, 0.3], n_burn=2, seed=5), 20, 100) for cid in range(3)]
+  parallel = run_chains(parsers, jobs())
+  sequential = [run_chains(parsers, [job])[0] for job in jobs()]
+  assert [c.counts for c in parallel] == [c.counts for c in sequential]
+  assert all(c.n_samples == 20 and 0 < c.acceptance <= 1 for c in parallel)
+  assert all(c.trace is None for c in parallel)  # no stopping rule, no trace
+  print "Succeed, 3 chains with acceptance rates %s" % ' '.join('%.2f' % c.acceptance for c in parallel)
+
+def test_convergence_stopping():
+  from mcmcparse import SlicedParsers, Chain, run_until_converged
+  from diagnostics import effective_sample_size, split_rhat
+  # an autocorrelated trace has fewer effective samples than draws, chains stuck apart do not pass R-hat
+  rng = np.random.RandomState(0)
+  x = np.zeros(2000)
+  for i in range(1, len(x)):
+    x[i] = 0.9 * x[i - 1] + rng.normal()
+  assert effective_sample_size(x) < 0.2 * len(x) < 0.8 * len(x) < effective_sample_size(rng.normal(size=len(x)))
+  assert split_rhat([x[:1000], x[1000:]]) < 1.1 < split_rhat([x[:1000], x[1000:] + 5])
+  # chains stop as soon as the estimates are stable (rather than after --max iterations)
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  parsers = SlicedParsers(wcfg, make_linear_fsa('the dog drinks milk'), '[S]', '[GOAL]')
+  chains = run_until_converged(parsers, [Chain(cid, a=[0.3, 0.3], seed=2) for cid in range(2)], 1000,
+                               every=20, tolerance=0.05)
+  assert all(chain.iterations < 1000 and len(chain.trace) == chain.n_samples for chain in chains)
+  print "Succeed, converged after %d iterations per chain" % chains[0].iterations
+
+def test_adaptive_beta():
+  from mcmcparse import SlicedParsers, Chain
+  from slice_variable import AdaptiveBeta
+  # a budget smaller than the forests tightens the slices during burn-in, then the parameters are frozen
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  parsers = SlicedParsers(wcfg, make_linear_fsa('the dog drinks milk'), '[S]', '[GOAL]')
+  chain = Chain(0, a=[0.1, 0.1], n_burn=20, seed=3, adaptive=AdaptiveBeta(edges=8, rate=0.5))
+  while chain.n_burn > 0:
+    chain.step(parsers)
+  frozen = list(chain.a)
+  assert frozen[1] > 0.1
+  chain.run(parsers, 20, 1000)
+  assert chain.a == frozen and chain.n_samples == 20
+  print "Succeed, adapted a=%s during burn-in" % frozen
+
+def test_checkpoint_resume():
+  import tempfile, shutil
+  from functools import partial
+  from mcmcparse import SlicedParsers, Chain, run_in_rounds
+  from checkpoint import save_checkpoint, load_checkpoint
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  parsers = SlicedParsers(wcfg, make_linear_fsa('the dog drinks milk'), '[S]', '[GOAL]')
+  make_chains = lambda: [Chain(cid, a=[0.3, 0.3], n_burn=5, seed=4, trace=True) for cid in range(2)]
+  expected = run_in_rounds(parsers, make_chains(), [60, 60], 1000, 1000)
+  # a run interrupted after its second checkpoint continues exactly where it stopped
+  class Interrupted(Exception):
+    pass
+  def interrupt(path, chains, previous):
+    save_checkpoint(path, {'chains': chains})
+    if chains[0].iterations >= 30:
+      raise Interrupted()
+  tmp = tempfile.mkdtemp()
+  path = os.path.join(tmp, 'run.ckpt')
+  try:
+    try:
+      run_in_rounds(parsers, make_chains(), [60, 60], 1000, 15, partial(interrupt, path))
+      assert False, 'the run should have been interrupted'
+    except Interrupted:
+      pass
+    chains = load_checkpoint(path)['chains']
+    assert [chain.iterations for chain in chains] == [30, 30]
+    resumed = run_in_rounds(parsers, chains, [60, 60], 1000, 15)
+  finally:
+    shutil.rmtree(tmp)
+  assert [chain.counts for chain in resumed] == [chain.counts for chain in expected]
+  assert [chain.trace for chain in resumed] == [chain.trace for chain in expected]
+  print "Succeed, resumed from a checkpoint with the same samples"
+
+def test_jsonl_output():
+  import sys, json
+  from StringIO import StringIO
+  from parse import exact_sample
+  # every distinct derivation is written once per snapshot, and the final estimates cover every sample
+  wcfg = load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float)
+  stdout, sys.stdout = sys.stdout, StringIO()
+  try:
+    exact_sample(wcfg, make_linear_fsa('the dog drinks milk'), n=2500, batch_size=500, seed=1,
+                 jsonl=True, sid=7, report_every=1000)
+    records = [json.loads(line) for line in sys.stdout.getvalue().splitlines()]
+  finally:
+    sys.stdout = stdout
+  assert sorted(set((r['final'], r['samples']) for r in records)) == [(False, 1000), (False, 2000), (True, 2500)]
+  final = [r for r in records if r['final']]
+  assert all(r['sentence'] == 7 for r in records) and len(set(r['tree'] for r in final)) == len(final)
+  assert sum(r['count'] for r in final) == 2500 and abs(sum(r['estimate'] for r in final) - 1) < 1e-9
+  print "Succeed, %d records (%d derivations)" % (len(records), len(final))
+
+def test_generating_containers():
+  from agenda import GeneratingSets, GeneratingBitsets
+  edges = lambda forest: sorted((forest.node(forest.head[e]), tuple(forest.node(c) for c in forest.children(e)),
+                                 forest.weight[e]) for e in xrange(forest.n_edges))
+  cyclic = WCFG([Rule('[S]', ['a'], -0.9), Rule('[S]', ['[A]'], -0.5), Rule('[A]', ['[S]'], -0.7), Rule('[A]', ['a'], -0.7)])
+  # bitsets are an optimisation: both containers yield the same forests
+  for wcfg, sentence in [(load_grammar(os.path.join(EXAMPLES, 'cfg'), 'bar', transform=float), 'the dog drinks milk'),
+                         (cyclic, 'a')]:
+    for Parser in [Nederhof, Earley]:
+      sets = Parser(wcfg, make_linear_fsa(sentence), generating_type=GeneratingSets).forest('[S]', '[GOAL]')
+      bitsets = Parser(wcfg, make_linear_fsa(sentence), generating_type=GeneratingBitsets).forest('[S]', '[GOAL]')
+      assert sets.n_edges > 0 and edges(sets) == edges(bitsets), Parser.__name__
+  print "Succeed, generating sets and bitsets yield the same forests"
+
+def test_benchmark_compare():
+  import sys
+  from StringIO import StringIO
+  from benchmark import compare
+  measures = lambda seconds, peak_mb, parsing: {'seconds': seconds, 'peak_mb': peak_mb, 'sentences': [],
+                                                'stages': {'parsing': {'seconds': parsing, 'peak_mb': peak_mb}}}
+  baseline = {'wsj/mc/nederhof': measures(1.0, 100.0, 0.8),
+              'wsj/mc/earley': measures(0.05, 50.0, 0.04),
+              'wsj/mcmc/nederhof': measures(1.0, 100.0, 0.8)}
+  results = {'wsj/mc/nederhof': measures(2.0, 100.0, 1.7),
+             # slower by 80%, but by less than the minimum amount, and 4% more memory (under the threshold)
+             'wsj/mc/earley': measures(0.09, 52.0, 0.07),
+             'wsj/mcmc/nederhof': {'error': 'exit status 1'}}
+  stdout, sys.stdout = sys.stdout, StringIO()
+  try:
+    regressions = compare(baseline, results, 0.2)
+    table = sys.stdout.getvalue()
+  finally:
+    sys.stdout = stdout
+  assert regressions == [('wsj/mc/nederhof', 'seconds'), ('wsj/mc/nederhof', 'parsing.seconds')]
+  # configurations that failed are not compared
+  assert 'wsj/mc/earley' in table and 'wsj/mcmc/nederhof' not in table
+  print "Succeed, %d regressions" % len(regressions)
+
 if __name__ == "__main__":
   test_final_weights()
   test_intersection_weights()
+  test_deep_forest()
+  test_semirings()
+  test_vectorised_inside()
+  test_posteriors()
+  test_sampling_tables()
+  test_batch_sampling()
+  test_parallel_sampling()
+  test_kbest()
+  test_bracketed_trees()
+  test_lazy_imports()
+  test_astar()
+  test_cyclic_forest()
+  test_itg_counting()
+  test_itg_grammars()
+  test_slice_variables()
+  test_incremental_slicing()
+  test_early_abort()
+  test_epsilon_slicing()
+  test_viterbi_initialisation()
+  test_parallel_chains()
+  test_convergence_stopping()
+  test_adaptive_beta()
+  test_checkpoint_resume()
+  test_jsonl_output()
+  test_generating_containers()
+  test_benchmark_compare()
@@ -8,6 +8,8 @@ from collections import defaultdict, deque
 def top_sort(forest):
     """
     Partial ordering of nodes in the forest.
+    Nodes that take part in cycles cannot be sorted, they come out grouped by strongly connected component
+    (see `strongly_connected_components`), each component after all the nodes it depends on.
     :return: list of nodes ordered from leaves to root
     """
 
@@ -44,5 +46,68 @@ def top_sort(forest):
                         sorting.append(parent)
                         del dependencies[parent]
 
+    if dependencies:  # some nodes are part of (or depend on) cycles
+        done = set(ordered)
+        symbols = sorted(set(dependencies.iterkeys()) | set(s for deps in dependencies.itervalues() for s in deps)
+                         - done)
+        index = dict((sym, i) for i, sym in enumerate(symbols))
+        successors = lambda i: [index[s] for r in forest.get(symbols[i], []) for s in r.rhs if s in index]
+        for component in strongly_connected_components(len(symbols), successors):
+            ordered.extend(symbols[i] for i in component)
+
     return ordered
 
+
+def strongly_connected_components(n, successors):
+    """
+    Tarjan's algorithm (iterative, thus not bound by Python's recursion limit).
+
+    >>> graph = {0: [1], 1: [2], 2: [1, 3], 3: [], 4: [4, 0]}
+    >>> strongly_connected_components(5, graph.get)
+    [[3], [2, 1], [0], [4]]
+
+    :param n: number of vertices (0 ... n - 1)
+    :param successors: a function that returns the successors of a vertex
+    :return: the list of components (lists of vertices), each component comes after all components reachable from it
+    """
+    index = [-1] * n
+    lowlink = [0] * n
+    on_stack = [False] * n
+    stack = []
+    components = []
+    counter = 0
+    for root in xrange(n):
+        if index[root] != -1:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, iter(successors(root)))]
+        while work:
+            v, children = work[-1]
+            for w in children:
+                if index[w] == -1:  # visit w
+                    index[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, iter(successors(w))))
+                    break
+                elif on_stack[w]:
+                    lowlink[v] = min(lowlink[v], index[w])
+            else:  # all successors of v have been visited
+                work.pop()
+                if work:
+                    u = work[-1][0]
+                    lowlink[u] = min(lowlink[u], lowlink[v])
+                if lowlink[v] == index[v]:  # v is the root of a component
+                    component = []
+                    while True:
+                        w = stack.pop()
+                        on_stack[w] = False
+                        component.append(w)
+                        if w == v:
+                            break
+                    components.append(component)
+    return components
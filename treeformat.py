@@ -0,0 +1,134 @@
+"""
+Bracketed trees written directly from derivations.
+
+The output is identical to printing an nltk Tree inline (see `inlinetree`),
+but we never construct nltk objects (nor import nltk) unless explicitly asked to (see `make_nltk_tree`).
+
+:Authors: - Wilker Aziz
+"""
+
+import re
+
+
+# markers for the writer's stack (tuples, thus distinct from any node)
+_CLOSE = (')',)
+_SPACE = (' ',)
+
+
+def bracketed(root, expand):
+    """
+    Writes a tree in bracketed format, e.g. "(S (A a) b)", a node without children is written "(X )".
+    The tree is visited with an explicit stack, thus we are not bound by Python's recursion limit.
+
+    :param root: the root node
+    :param expand: a function that maps a node to a pair (label, children), where children is None for leaves
+    :returns: a string
+
+    >>> tree = {'S': ('S', ['A', 'b']), 'A': ('A', ['a']), 'b': ('b', None), 'a': ('a', None)}
+    >>> bracketed('S', tree.get)
+    '(S (A a) b)'
+    >>> bracketed('X', {'X': ('X', [])}.get)
+    '(X )'
+    """
+    out = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if node is _CLOSE or node is _SPACE:
+            out.append(node[0])
+            continue
+        label, children = expand(node)
+        if children is None:
+            out.append(label)
+            continue
+        out.append('(%s ' % label)
+        stack.append(_CLOSE)
+        for i, child in enumerate(reversed(children)):
+            if i > 0:
+                stack.append(_SPACE)
+            stack.append(child)
+    return ''.join(out)
+
+
+def bracketed_tree(forest, derivation, breadth_first=False):
+    """
+    Writes a derivation given as a sequence of edge ids of a forest.
+    The structure of the tree is recovered from the order of the edges, thus a node may occur more than once
+    (as it happens in cyclic forests).
+
+    :param forest: a hypergraph (see hypergraph.Hypergraph)
+    :param derivation: a sequence of edge ids in pre-order (left to right), or in breadth-first order
+    :param breadth_first: whether edges are in breadth-first order (as produced by batch sampling)
+    """
+    # each child is either a terminal node or the position (in the derivation) of the edge that rewrites it
+    positions = _match_children([forest.children(e) for e in derivation], forest.is_terminal, breadth_first)
+
+    def expand(x):
+        if isinstance(x, int):
+            return str(forest.label(forest.head[derivation[x]])), positions[x]
+        return str(forest.label(x[0])), None
+
+    return bracketed(0, expand)
+
+
+def bracketed_rules(derivation):
+    """
+    Writes a derivation given as a sequence of annotated rules in pre-order (left to right).
+    :param derivation: a sequence of Rule objects
+    """
+    nonterminals = set(r.lhs for r in derivation)
+    positions = _match_children([r.rhs for r in derivation], lambda sym: sym not in nonterminals, False)
+
+    def expand(x):
+        if isinstance(x, int):
+            return str(derivation[x].lhs), positions[x]
+        return str(x[0]), None
+
+    return bracketed(0, expand)
+
+
+def _match_children(children, is_leaf, breadth_first):
+    """
+    Matches each nonterminal child occurrence with the position of the rule (or edge) that rewrites it.
+    :param children: for each rule in the derivation, the sequence of children
+    :param is_leaf: a function that tells whether a child is a leaf
+    :param breadth_first: whether rules are in breadth-first order (rather than in pre-order)
+    :returns: for each rule, a list whose elements are either a position or a tuple (leaf,)
+    """
+    positions = [[(c,) if is_leaf(c) else None for c in rhs] for rhs in children]
+    if breadth_first:
+        k = 1
+        for slots in positions:
+            for j, slot in enumerate(slots):
+                if slot is None:
+                    slots[j] = k
+                    k += 1
+    else:
+        k = 1
+        pending = [(0, j) for j in reversed(xrange(len(positions[0]))) if positions[0][j] is None]
+        while pending:
+            i, j = pending.pop()
+            positions[i][j] = k
+            pending.extend((k, jj) for jj in reversed(xrange(len(positions[k]))) if positions[k][jj] is None)
+            k += 1
+    return positions
+
+
+def make_nltk_tree(derivation):
+    """
+    Recursively constructs an nlt Tree from a list of rules.
+    @param top: index to the top rule (0 and -1 are the most common values)
+    """
+    from nltk import Tree
+    d = dict((r.lhs, r) for r in derivation)
+
+    def make_tree(sym):
+        r = d[sym]
+        return Tree(str(r.lhs), (str(child) if child not in d else make_tree(child) for child in r.rhs))
+    return make_tree(derivation[0].lhs)
+
+
+def inlinetree(t):
+    """Prints an nltk Tree in a single line"""
+    s = str(t).replace('\n','')
+    return re.sub(' +', ' ', s)
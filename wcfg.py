@@ -6,6 +6,7 @@ from collections import defaultdict, deque
 from symbol import is_terminal
 from rule import Rule
 from math import log
+from bisect import bisect_left
 
 
 class WCFG(object):
@@ -71,6 +72,76 @@ class WCFG(object):
         return '\n'.join(lines)
 
 
+class SortedRules(object):
+    """
+    Rules grouped by LHS and first RHS symbol and sorted by decreasing log probability within a group,
+    this supports threshold queries such as "which rules could pass a slice variable".
+
+    >>> rules = SortedRules([Rule('[X]', ['[X]', '[X]'], -0.5), Rule('[X]', ['[X]', 'a'], -2.0), Rule('[X]', ['[X]'], -1.0), Rule('[Y]', ['[X]'], -3.0)])
+    >>> [str(r) for r in rules.iter_above('[X]', '[X]', -1.5)]
+    ['[X] -> [X] [X] (-0.5)', '[X] -> [X] (-1.0)']
+    >>> rules.any_above('[Y]', '[X]', -3.0), rules.any_above('[Y]', '[X]', -3.5)
+    (False, True)
+    >>> sorted(rules.lhs_of('[X]'))
+    ['[X]', '[Y]']
+    >>> rules.max_length, rules.has_empty, rules.has_mixed
+    (2, False, True)
+    >>> rules.floor('[X]'), rules.floor('[Z]')
+    (-2.0, inf)
+    """
+
+    def __init__(self, rules):
+        groups = defaultdict(list)
+        self.max_length = 0  # longest RHS
+        self.has_empty = False  # whether some RHS is empty
+        self.has_mixed = False  # whether some RHS mixes a terminal with other symbols
+        for rule in rules:
+            rhs = rule.rhs
+            groups[(rule.lhs, rhs[0] if rhs else None)].append(rule)
+            self.max_length = max(self.max_length, len(rhs))
+            if not rhs:
+                self.has_empty = True
+            elif len(rhs) > 1 and not self.has_mixed:
+                self.has_mixed = any(is_terminal(sym) for sym in rhs)
+        self._rules = {}  # (lhs, first) -> rules sorted by decreasing log probability
+        self._keys = {}  # (lhs, first) -> negated log probabilities (thus increasing)
+        self._firsts = defaultdict(list)  # lhs -> first symbols
+        self._lhss = defaultdict(list)  # first symbol -> LHS symbols
+        self._floors = {}  # lhs -> lowest log probability
+        for (lhs, first), group in groups.iteritems():
+            group.sort(key=lambda r: -r.log_prob)
+            self._rules[(lhs, first)] = group
+            self._keys[(lhs, first)] = [-r.log_prob for r in group]
+            self._firsts[lhs].append(first)
+            self._lhss[first].append(lhs)
+            self._floors[lhs] = min(self._floors.get(lhs, float('inf')), group[-1].log_prob)
+
+    def first_of(self, lhs):
+        """First RHS symbols of the rules rewriting a given LHS"""
+        return self._firsts.get(lhs, [])
+
+    def lhs_of(self, first):
+        """LHS symbols of the rules whose RHS starts with a given symbol"""
+        return self._lhss.get(first, [])
+
+    def floor(self, lhs):
+        """Lowest log probability amongst the rules rewriting a given LHS (a threshold below it prunes nothing)"""
+        return self._floors.get(lhs, float('inf'))
+
+    def any_above(self, lhs, first, threshold):
+        """Whether some rule (lhs -> first ...) has log probability strictly above the threshold"""
+        keys = self._keys.get((lhs, first), None)
+        return keys is not None and -keys[0] > threshold
+
+    def iter_above(self, lhs, first, threshold):
+        """Iterates through the rules (lhs -> first ...) whose log probabilities are strictly above the threshold"""
+        keys = self._keys.get((lhs, first), None)
+        if keys is None:
+            return iter([])
+        rules = self._rules[(lhs, first)]
+        return (rules[i] for i in xrange(bisect_left(keys, -threshold)))
+
+
 def count_derivations(wcfg, root):
     
     def recursion(derivation, projection, Q, wcfg, counts):
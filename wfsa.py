@@ -3,6 +3,7 @@
 """
 
 from collections import defaultdict
+from semiring import LogSemiring
 
 
 class WDFSA(object):
@@ -81,6 +82,27 @@ class WDFSA(object):
             raise ValueError('Origin state %d does not exist' % origin)
         return list(self._arcs[origin].get(symbol, {}).iteritems())
 
+    def reachable(self):
+        """
+        Returns, for each state, the sorted list of states reachable from it through one or more arcs.
+
+        >>> make_linear_fsa('a b c').reachable()
+        [[1, 2, 3], [2, 3], [3], []]
+        """
+        successors = [set(sto for w_by_sto in arcs_by_sym.itervalues() for sto in w_by_sto)
+                      for arcs_by_sym in self._arcs]
+        reachable = []
+        for state in xrange(len(self._arcs)):
+            seen = set()
+            stack = list(successors[state])
+            while stack:
+                q = stack.pop()
+                if q not in seen:
+                    seen.add(q)
+                    stack.extend(successors[q])
+            reachable.append(sorted(seen))
+        return reachable
+
     def is_initial(self, state):
         """Whether or not a state is initial."""
         return state in self._initial_states
@@ -109,17 +131,11 @@ class WDFSA(object):
         """Get the weight of a final state. If the state is not a final one, throw exception"""
         return self._final_states_weight[final]
 
-    def path_weight(self, path, semiring):
+    def path_weight(self, path, semiring=LogSemiring()):
         """Returns the weight of a path given by a sequence of tuples of the kind (origin, destination, sym)"""
         total = semiring.one
-        for (origin, destination, sym) in arcs:
-            arcs = self._arcs[origin].get(sym, None)
-            if arcs is None:
-                raise ValueError('Invalid transition origin=%s sym=%s' % (origin, sym))
-            w = arcs.get(destination, None)
-            if w is None:
-                raise ValueError('Invalid transition origin=%s destination=%s sym=%s' % (origin, destination, sym))
-            total = semiring.times(total, w)
+        for (origin, destination, sym) in path:
+            total = semiring.times(total, semiring.from_log(self.arc_weight(origin, destination, sym)))
         return total
 
     def arc_weight(self, origin, destination, sym):